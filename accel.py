@@ -0,0 +1,21 @@
+import os
+
+# numba is optional: when it is installed the hot loops are compiled, otherwise
+# every caller falls back to its NumPy implementation
+# set DITHER_DISABLE_JIT=1 to force the fallbacks
+try:
+    if os.environ.get('DITHER_DISABLE_JIT'):
+        raise ImportError('jit disabled through DITHER_DISABLE_JIT')
+    import numba
+except ImportError:
+    numba = None
+
+available = numba is not None
+
+
+def jit(function):
+    # compile function in nopython mode without the GIL, or return None when
+    # numba is not available so the caller can pick its fallback
+    if numba is None:
+        return None
+    return numba.njit(cache=True, nogil=True)(function)
@@ -0,0 +1,176 @@
+from collections import OrderedDict
+import hashlib
+import numpy
+
+import palette
+import utils
+
+DEBUGMODE = False
+
+# palettes are extracted from a random subset of at most this many pixels,
+# which keeps the cost flat whatever the image size
+default_samples = 65536
+
+
+def sample_pixels(image_matrix, max_samples=default_samples, seed=0):
+    # (N, 3) float64 pixels in [0, 1], a random subset of the image's pixels
+    # once it has more than max_samples
+    pixels = numpy.asarray(image_matrix).reshape(-1, 3)
+    if pixels.shape[0] > max_samples:
+        rng = numpy.random.default_rng(seed)
+        pixels = pixels[rng.choice(pixels.shape[0], max_samples, replace=False)]
+    return utils.unit_float(pixels).astype(numpy.float64)
+
+
+def median_cut(pixels, n_colors, seed=0):
+    # Heckbert's median cut: split the box with the longest side, weighted
+    # by its pixel count, at the median of that side until there are
+    # n_colors boxes; each box gives its mean color
+    def scored(box):
+        sides = numpy.ptp(box, axis=0) if box.shape[0] > 1 else numpy.zeros(3)
+        return (sides.max() * box.shape[0], int(numpy.argmax(sides)), box)
+
+    boxes = [scored(pixels)]
+    while len(boxes) < n_colors:
+        b_i = max(range(len(boxes)), key=lambda i: boxes[i][0])
+        score, channel, box = boxes[b_i]
+        if score <= 0:
+            break
+        del boxes[b_i]
+        order = numpy.argsort(box[:, channel], kind='stable')
+        half = box.shape[0] // 2
+        boxes.extend([scored(box[order[:half]]), scored(box[order[half:]])])
+    return numpy.array([box.mean(axis=0) for score, channel, box in boxes])
+
+
+def _mean_colors(pixels, labels):
+    # mean color of the pixels with every distinct label
+    ids, inverse, counts = numpy.unique(labels, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    sums = numpy.stack([numpy.bincount(inverse, pixels[:, c], ids.size) for c in range(3)], axis=1)
+    return sums / counts[:, numpy.newaxis]
+
+
+def octree(pixels, n_colors, seed=0):
+    # octree quantization: a pixel's node at depth d is given by the top d
+    # bits of its channels; take the deepest level with at most n_colors
+    # nodes, then split its most populated nodes into their children while
+    # there is room, lumping the smallest children back into their parent
+    # when not all of them fit; each leaf gives its mean color
+    values = numpy.minimum(pixels * 256, 255).astype(numpy.int64)
+
+    def node_ids(depth):
+        shift = 8 - depth
+        r, g, b = (values >> shift).T
+        return (r << (2 * depth)) | (g << depth) | b
+
+    depth = 0
+    while depth < 8 and numpy.unique(node_ids(depth + 1)).size <= n_colors:
+        depth += 1
+
+    leaves = node_ids(depth)
+    if depth < 8:
+        # children get ids past every parent id
+        children = node_ids(depth + 1) + (1 << (3 * depth))
+        parents, counts = numpy.unique(leaves, return_counts=True)
+        n_leaves = parents.size
+        new_leaves = leaves.copy()
+        for parent in parents[numpy.argsort(-counts, kind='stable')]:
+            room = n_colors - n_leaves
+            if room <= 0:
+                break
+            members = leaves == parent
+            child_ids, child_counts = numpy.unique(children[members], return_counts=True)
+            if child_ids.size <= 1:
+                continue
+            if child_ids.size - 1 <= room:
+                keep = child_ids
+                n_leaves += child_ids.size - 1
+            else:
+                keep = child_ids[numpy.argsort(-child_counts, kind='stable')[:room]]
+                n_leaves += room
+            moved = members & numpy.isin(children, keep)
+            new_leaves[moved] = children[moved]
+        leaves = new_leaves
+    return _mean_colors(pixels, leaves)
+
+
+def kmeans(pixels, n_colors, seed=0, batch_size=1024, iterations=100):
+    # mini-batch k-means (Sculley 2010) seeded with k-means++: every step
+    # moves the centers towards the mean of their pixels in a random batch,
+    # with a learning rate that shrinks as a center sees more pixels
+    rng = numpy.random.default_rng(seed)
+    n_colors = min(n_colors, pixels.shape[0])
+
+    # k-means++ seeding on a smaller subset, which is good enough to start
+    # from and keeps the seeding cost independent of the sample size
+    seeds = pixels[rng.choice(pixels.shape[0], min(pixels.shape[0], 32 * n_colors), replace=False)]
+    centers = numpy.empty((n_colors, 3))
+    centers[0] = seeds[rng.integers(seeds.shape[0])]
+    dist = numpy.sum((seeds - centers[0])**2, axis=1)
+    for c_i in range(1, n_colors):
+        total = dist.sum()
+        if total <= 0:
+            centers = centers[:c_i]
+            break
+        centers[c_i] = seeds[rng.choice(seeds.shape[0], p=dist / total)]
+        dist = numpy.minimum(dist, numpy.sum((seeds - centers[c_i])**2, axis=1))
+
+    seen = numpy.zeros(centers.shape[0])
+    for iteration in range(iterations):
+        batch = pixels[rng.integers(pixels.shape[0], size=min(batch_size, pixels.shape[0]))]
+        nearest = utils.nearest_indices(batch, centers)
+        counts = numpy.bincount(nearest, minlength=centers.shape[0])
+        sums = numpy.stack([numpy.bincount(nearest, batch[:, c], centers.shape[0]) for c in range(3)], axis=1)
+        hit = counts > 0
+        seen[hit] += counts[hit]
+        rate = counts[hit] / seen[hit]
+        centers[hit] += rate[:, numpy.newaxis] * (sums[hit] / counts[hit, numpy.newaxis] - centers[hit])
+    return numpy.clip(centers, 0.0, 1.0)
+
+
+algorithms = OrderedDict([
+        ('median_cut', median_cut),
+        ('octree', octree),
+        ('kmeans', kmeans),
+])
+
+
+def extract_palette(image_matrix, n_colors=16, algorithm='median_cut', max_samples=default_samples, seed=0):
+    # up to n_colors colors for the image, snapped to 8 bits per channel,
+    # without duplicates and ordered from dark to light
+    if n_colors < 1:
+        raise ValueError('a palette needs at least one color')
+    pixels = sample_pixels(image_matrix, max_samples, seed)
+    colors = algorithms[algorithm](pixels, n_colors, seed)
+    colors = numpy.unique(numpy.round(colors * 255), axis=0) / 255.
+    luminance = colors @ numpy.array([0.299, 0.587, 0.114])
+    return colors[numpy.argsort(luminance, kind='stable')]
+
+
+def adaptive_palette(image_matrix, n_colors=16, algorithm='median_cut', max_samples=default_samples, seed=0):
+    # extract a palette and register it; the generated name carries a hash of
+    # the colors, so the same palette always gets the same name
+    colors = extract_palette(image_matrix, n_colors, algorithm, max_samples, seed)
+    digest = hashlib.sha1(numpy.ascontiguousarray(colors).tobytes()).hexdigest()[:10]
+    palette_name = '{}{}_{}'.format(algorithm, n_colors, digest)
+    palette.register_palette(palette_name, colors)
+    if DEBUGMODE:
+        print(f'registered {palette_name} with {colors.shape[0]} colors')
+    return palette_name
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('image_filename', help='Path to an image file to take the palette from')
+    parser.add_argument('-n', '--colors', type=int, default=16, help='Number of colors')
+    parser.add_argument('-a', '--algorithm', type=str, default='median_cut', choices=list(algorithms), help='Palette extraction algorithm')
+    args = parser.parse_args()
+
+    image_matrix = utils.pil2numpy(utils.open_image(args.image_filename), numpy.uint8)
+    palette_name = adaptive_palette(image_matrix, args.colors, args.algorithm)
+    print(palette_name)
+    for color in palette.palettes[palette_name]:
+        print('#{:02x}{:02x}{:02x}'.format(*numpy.uint8(color * 255)))
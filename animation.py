@@ -0,0 +1,208 @@
+from PIL import Image, ImageSequence
+import numpy
+import os
+
+import batch
+import color_metrics
+import dither
+import error_diffusion
+import instrument
+import ordered_dithering
+import palette
+import randomized
+import utils
+
+DEBUGMODE = False
+
+# frames are compared in square tiles of this many pixels
+TILE = 64
+
+# display time of frames that do not carry their own, e.g. from a directory
+default_duration = 100
+
+
+def read_frames(source, duration=default_duration):
+    # yield (uint8 (H, W, 3) frame, duration in ms) from an animated GIF or
+    # PNG, any other image PIL can open, or a directory of frame images
+    if os.path.isdir(source):
+        for filename in batch.collect_inputs([source]):
+            yield numpy.asarray(utils.open_image(filename)), duration
+        return
+    with Image.open(source) as image:
+        for frame in ImageSequence.Iterator(image):
+            with instrument.stage('decode', frame.size[0] * frame.size[1]):
+                matrix = numpy.asarray(frame.convert('RGB'))
+            yield matrix, frame.info.get('duration', duration)
+
+
+def changed_tiles(frame, previous, tile=TILE, tolerance=0):
+    # (rows, cols) mask of tiles holding at least one pixel whose channels
+    # moved by more than tolerance; edge tiles may be smaller
+    height, width = frame.shape[:2]
+    moved = numpy.abs(frame.astype(numpy.int16) - previous.astype(numpy.int16)).max(axis=2) > tolerance
+    n_rows, n_cols = -(-height // tile), -(-width // tile)
+    padded = numpy.zeros((n_rows * tile, n_cols * tile), dtype=bool)
+    padded[:height, :width] = moved
+    return padded.reshape(n_rows, tile, n_cols, tile).any(axis=(1, 3))
+
+
+def _tile_pixels(tiles, height, width, tile=TILE):
+    return numpy.repeat(numpy.repeat(tiles, tile, axis=0), tile, axis=1)[:height, :width]
+
+
+class FrameDitherer(object):
+    # dithers the frames of an animation one after the other; only tiles
+    # that changed since the previous frame are dithered again, the others
+    # keep their previous output so still areas do not flicker
+    #
+    # threshold, ordered and random dithering are per pixel (random with a
+    # noise pattern fixed for the whole animation), so only the changed
+    # pixels are computed at all. error diffusion diffuses again from the
+    # first changed band of tiles, starting from the error carried into that
+    # band last time, and keeps the result in the changed tiles. any other
+    # method dithers the whole frame and keeps the changed tiles.
+
+    def __init__(self, width, height, method, palette_name, dtype='float64', seed=0,
+            tile=TILE, tolerance=0, metric=color_metrics.default_metric):
+        self.width = width
+        self.height = height
+        self.method = method
+        self.palette_name = palette_name
+        self.dtype = dtype
+        self.seed = seed
+        self.tile = tile
+        self.tolerance = tolerance
+        self.metric = metric
+        self.previous = None
+        self.indices = numpy.zeros((height, width),
+                dtype=utils.index_dtype(len(palette.palettes[palette_name])))
+
+        work_dtype = utils.unit_float(numpy.zeros(1, dtype=dtype)).dtype
+        self.offset = None
+        if method in ordered_dithering._available_methods:
+            self.offset = ('map', ordered_dithering._tiled_map(ordered_dithering.threshold_map(method),
+                    height, width, 0, work_dtype))
+        elif method == 'random':
+            self.offset = ('noise', randomized._Noise(seed).rows(0, (height, width, 3), work_dtype))
+
+        self.diffuser = None
+        if method in error_diffusion._available_methods:
+            self.diffuser = error_diffusion.make_diffuser(width, palette_name, method, metric=metric)
+            self.checkpoints = []
+
+    def _pointwise(self, matrix, mask):
+        pixels = utils.unit_float(matrix[mask])
+        if self.offset is not None:
+            kind, offset = self.offset
+            if kind == 'map':
+                pixels = pixels + pixels * offset[mask][:, numpy.newaxis]
+            else:
+                pixels = numpy.clip(pixels + offset[mask], 0.0, 1.0)
+        indices, new_matrix = utils.quantize(pixels, self.palette_name, metric=self.metric)
+        return indices
+
+    def _diffuse(self, matrix, tiles):
+        # the error carried into every band of tiles is kept, so diffusion
+        # can start again at the first band that changed
+        first_band = int(numpy.argmax(tiles.any(axis=1)))
+        if first_band < len(self.checkpoints):
+            self.diffuser.restore(self.checkpoints[first_band])
+            del self.checkpoints[first_band:]
+        y0 = first_band * self.tile
+        out = numpy.empty((self.height - y0, self.width), dtype=self.indices.dtype)
+        for y in range(y0, self.height, self.tile):
+            self.checkpoints.append(self.diffuser.checkpoint())
+            out[y-y0:y-y0+self.tile] = self.diffuser.process(matrix[y:y+self.tile])
+        return y0, out
+
+    def process(self, frame):
+        # dither the next uint8 (H, W, 3) frame, returning its palette indices
+        frame = numpy.asarray(frame, dtype=numpy.uint8)
+        if self.previous is None:
+            tiles = numpy.ones((-(-self.height // self.tile), -(-self.width // self.tile)), dtype=bool)
+        else:
+            tiles = changed_tiles(frame, self.previous, self.tile, self.tolerance)
+        n_changed = int(numpy.count_nonzero(tiles))
+        instrument.count('tiles_dithered', n_changed)
+        instrument.count('tiles_reused', tiles.size - n_changed)
+        if DEBUGMODE:
+            print(f'{n_changed} of {tiles.size} tiles changed')
+
+        self.previous = frame
+        if n_changed == 0:
+            return self.indices.copy()
+
+        indices = self.indices.copy()
+        mask = _tile_pixels(tiles, self.height, self.width, self.tile)
+        matrix = utils.pil2numpy(frame, self.dtype)
+        with instrument.stage('dither', int(numpy.count_nonzero(mask))):
+            if self.method == 'threshold' or self.offset is not None:
+                indices[mask] = self._pointwise(matrix, mask)
+            elif self.diffuser is not None:
+                y0, out = self._diffuse(matrix, tiles)
+                indices[y0:][mask[y0:]] = out[mask[y0:]]
+            else:
+                method_args = {'seed': self.seed} if self.method in randomized._available_methods else {}
+                if self.metric != color_metrics.default_metric:
+                    method_args['metric'] = self.metric
+                full = dither.available_methods[self.method](matrix, self.palette_name,
+                        return_indices=True, **method_args)
+                indices[mask] = full[mask]
+        self.indices = indices
+        return indices.copy()
+
+
+def dither_animation(source, output, method, palette_name, dtype='float64', seed=0,
+        tile=TILE, tolerance=0, duration=default_duration, loop=0, metric=color_metrics.default_metric):
+    # dither every frame of source into output: an animated GIF or PNG with
+    # one shared palette, or a directory that gets one PNG per frame;
+    # returns the number of frames
+    ditherer = None
+    images = []
+    durations = []
+    n_frames = 0
+    to_directory = os.path.splitext(output)[1] == ''
+    if to_directory:
+        os.makedirs(output, exist_ok=True)
+
+    for f_i, (frame, frame_duration) in enumerate(read_frames(source, duration)):
+        if ditherer is None:
+            height, width = frame.shape[:2]
+            ditherer = FrameDitherer(width, height, method, palette_name, dtype, seed, tile, tolerance, metric)
+        image = utils.indices2pil(ditherer.process(frame), palette_name)
+        n_frames += 1
+        if to_directory:
+            with instrument.stage('save'):
+                image.save(os.path.join(output, 'frame_{:05d}.png'.format(f_i)))
+        else:
+            images.append(image)
+            durations.append(frame_duration)
+
+    if not to_directory and images:
+        # frames share the palette, so the encoder only has to store the
+        # bounding box of what changed from one frame to the next
+        with instrument.stage('save'):
+            images[0].save(output, save_all=True, append_images=images[1:], duration=durations, loop=loop)
+    return n_frames
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('source', help='Animated GIF or PNG, or a directory of frames')
+    parser.add_argument('output', help='Animated GIF or PNG to write, or a directory for PNG frames')
+    palette_help_str = 'Name of palette to use. Can be one of: ' + ', '.join(palette.available_palettes)
+    method_help_str = 'Method to use. Can be one of: ' + ', '.join(dither.available_methods)
+    parser.add_argument('-p', '--palette', type=str, default=dither.default_palette, help=palette_help_str)
+    parser.add_argument('-m', '--method', type=str, default=dither.default_method, help=method_help_str)
+    parser.add_argument('--dtype', type=str, default='float64', choices=['float64', 'float32', 'uint8'], help='Pixel type to dither in')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the noise shared by all frames')
+    parser.add_argument('--tile', type=int, default=TILE, help='Size of the tiles compared between frames')
+    parser.add_argument('--tolerance', type=int, default=0, help='Channel change (0-255) a pixel may have and still count as unchanged')
+    parser.add_argument('--duration', type=int, default=default_duration, help='Frame time in ms for frames that have none')
+    parser.add_argument('--metric', type=str, default=color_metrics.default_metric, choices=color_metrics.available_metrics, help='Color distance used to pick palette colors')
+    args = parser.parse_args()
+
+    dither_animation(args.source, args.output, args.method, args.palette, args.dtype, args.seed,
+            args.tile, args.tolerance, args.duration, metric=args.metric)
@@ -0,0 +1,209 @@
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import glob
+import os
+import re
+import string
+import time
+
+import color_metrics
+import dither
+import error_diffusion
+import palette
+import palette_index
+import randomized
+import registry
+import result_cache
+import streaming
+import utils
+
+DEBUGMODE = False
+default_template = '{dir}/{stem}_{method}_{palette}.png'
+
+image_extensions = ('.bmp', '.gif', '.jpeg', '.jpg', '.pgm', '.png', '.ppm', '.tif', '.tiff', '.webp')
+
+
+def output_pattern(template):
+    # regular expression matching every path the template renders to, for
+    # any input, method and palette
+    fields = {
+        'dir': '.*',
+        'name': '[^/]+',
+        'stem': '[^/]+',
+        'ext': r'(\.[^/.]*)?',
+        'method': '|'.join(re.escape(m) for m in sorted(dither.available_methods, key=len, reverse=True)),
+        'palette': '|'.join(re.escape(p) for p in sorted(palette.available_palettes, key=len, reverse=True)),
+    }
+    pattern = ''
+    for literal, field, spec, conversion in string.Formatter().parse(template):
+        pattern += re.escape(literal)
+        if field is not None:
+            pattern += '(?:{})'.format(fields[field])
+    return re.compile(pattern)
+
+
+def collect_inputs(sources, recursive=False, template=None):
+    # expand directories, glob patterns and @list files (one path per line)
+    # into a sorted list of image files without duplicates; with template,
+    # files it renders to are left out, so earlier outputs written next to
+    # their inputs are not dithered again
+    found = []
+    for source in sources:
+        if source.startswith('@'):
+            with open(source[1:]) as lf:
+                found.extend(line.strip() for line in lf if line.strip())
+        elif os.path.isdir(source):
+            if recursive:
+                for root, dirs, files in os.walk(source):
+                    found.extend(os.path.join(root, f) for f in files)
+            else:
+                found.extend(os.path.join(source, f) for f in os.listdir(source))
+        elif any(c in source for c in '*?['):
+            found.extend(glob.glob(source, recursive=True))
+        else:
+            found.append(source)
+    images = [f for f in found if os.path.splitext(f)[1].lower() in image_extensions]
+    if template is not None:
+        outputs = output_pattern(template)
+        rendered = [f for f in images if outputs.fullmatch(f) or outputs.fullmatch(os.path.join('.', f))]
+        if DEBUGMODE and rendered:
+            print(f'leaving out {len(rendered)} earlier outputs')
+        rendered = set(rendered)
+        images = [f for f in images if f not in rendered]
+    return sorted(set(images))
+
+
+def output_path(template, input_filename, method, palette_name):
+    # template fields: {dir} {name} {stem} {ext} {method} {palette}
+    directory, name = os.path.split(input_filename)
+    stem, ext = os.path.splitext(name)
+    return template.format(dir=directory or '.', name=name, stem=stem, ext=ext,
+            method=method, palette=palette_name)
+
+
+def up_to_date(input_filename, output_filename):
+    return (os.path.exists(output_filename)
+            and os.stat(output_filename).st_mtime >= os.stat(input_filename).st_mtime)
+
+
+def _warm(palette_name, method=None, metric=color_metrics.default_metric):
+    # load the palette and the tables the method quantizes with once per
+    # process instead of once per file: the palette index, which builds a
+    # lookup table only for the palettes it needs one for, and an error
+    # diffuser's own table. the parent warms first so that a table is
+    # compiled and cached once rather than by every worker at the same time
+    palette_index.get_index(palette_name, metric)
+    if method in error_diffusion._available_methods:
+        error_diffusion.make_diffuser(1, palette_name, method, metric=metric)
+
+
+def _dither_file(job):
+    input_filename, output_filename, method, palette_name, dtype, indexed, use_cache, engine, method_args = job
+    start = time.perf_counter()
+    image = utils.open_image(input_filename)
+    cache = result_cache.ResultCache() if use_cache else None
+    dither_image = dither.dither_image(image, method, palette_name, dtype, indexed, cache, engine, **method_args)
+    directory = os.path.dirname(output_filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    dither_image.save(output_filename)
+    width, height = image.size
+    return width * height, time.perf_counter() - start
+
+
+def run_batch(sources, template, method, palette_name, dtype='float64', indexed=False,
+        workers=None, max_in_flight=None, force=False, recursive=False, report=print, cache=False,
+        engine=None, method_args=None):
+    # dither every input through a persistent pool of worker processes,
+    # keeping at most max_in_flight files queued; returns a summary dict
+    # with cache set, results are shared through the on-disk result cache.
+    # engine and method_args (seed, metric, workers, block_size) are as for
+    # dither.dither_image; workers takes an engine
+    method_args = method_args or {}
+    inputs = collect_inputs(sources, recursive, template)
+    workers = workers or os.cpu_count()
+    max_in_flight = max_in_flight or 2 * workers
+
+    jobs = []
+    skipped = 0
+    for input_filename in inputs:
+        output_filename = output_path(template, input_filename, method, palette_name)
+        if not force and up_to_date(input_filename, output_filename):
+            skipped += 1
+            continue
+        jobs.append((input_filename, output_filename, method, palette_name, dtype, indexed, cache, engine, method_args))
+
+    summary = {'files': 0, 'skipped': skipped, 'failed': 0, 'pixels': 0, 'seconds': 0.0}
+    start = time.perf_counter()
+    pending = {}
+    queue = iter(jobs)
+
+    warm_args = (palette_name, method, method_args.get('metric', color_metrics.default_metric))
+    if jobs:
+        _warm(*warm_args)
+    with ProcessPoolExecutor(workers, initializer=_warm, initargs=warm_args) as pool:
+        while jobs:
+            for job in queue:
+                pending[pool.submit(_dither_file, job)] = job
+                if len(pending) >= max_in_flight:
+                    break
+            if not pending:
+                break
+            done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = pending.pop(future)
+                try:
+                    pixels, seconds = future.result()
+                except Exception as e:
+                    summary['failed'] += 1
+                    report('{} failed: {}'.format(job[0], e))
+                    continue
+                summary['files'] += 1
+                summary['pixels'] += pixels
+                report('{} -> {}: {:.2f} Mpx in {:.3f} s ({:.2f} Mpx/s)'.format(
+                    job[0], job[1], pixels / 1e6, seconds, pixels / 1e6 / max(seconds, 1e-9)))
+
+    summary['seconds'] = time.perf_counter() - start
+    elapsed = max(summary['seconds'], 1e-9)
+    report('{} files ({} skipped, {} failed), {:.2f} Mpx in {:.2f} s: {:.2f} files/s, {:.2f} Mpx/s'.format(
+        summary['files'], summary['skipped'], summary['failed'], summary['pixels'] / 1e6,
+        summary['seconds'], summary['files'] / elapsed, summary['pixels'] / 1e6 / elapsed))
+    return summary
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sources', nargs='+', help='Image files, directories, glob patterns or @file lists')
+    palette_help_str = 'Name of palette to use. Can be one of: ' + ', '.join(palette.available_palettes)
+    method_help_str = 'Method to use. Can be one of: ' + ', '.join(dither.available_methods)
+    template_help_str = 'Output path template using {dir} {name} {stem} {ext} {method} {palette}'
+    parser.add_argument('-p', '--palette', type=str, default=dither.default_palette, help=palette_help_str)
+    parser.add_argument('-m', '--method', type=str, default=dither.default_method, help=method_help_str)
+    parser.add_argument('-o', '--output', type=str, default=default_template, help=template_help_str)
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Worker processes (default: all cores)')
+    parser.add_argument('--max-in-flight', type=int, default=None, help='Files queued at once (default: twice the workers)')
+    parser.add_argument('-f', '--force', action='store_true', help='Redo outputs that are already up to date')
+    parser.add_argument('-r', '--recursive', action='store_true', help='Descend into subdirectories')
+    parser.add_argument('--dtype', type=str, default='float64', choices=['float64', 'float32', 'uint8'], help='Pixel type to dither in')
+    parser.add_argument('-i', '--indexed', action='store_true', help='Write palette ("P" mode) images')
+    parser.add_argument('--cache', action='store_true', help='Reuse results from the on-disk result cache')
+    parser.add_argument('--engine', type=str, default='auto', choices=['auto'] + registry.engines, help='How the method is run, see registry.py')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='Cores every file is dithered with')
+    parser.add_argument('--seed', type=int, default=None, help='Seed for the randomized methods')
+    parser.add_argument('--block-size', type=streaming.parse_shape, default=None, help='Block size for block_random, as N or H,W')
+    parser.add_argument('--metric', type=str, default=color_metrics.default_metric, choices=color_metrics.available_metrics, help='Color distance used to pick palette colors')
+    args = parser.parse_args()
+
+    method_args = {}
+    if args.workers is not None:
+        method_args['workers'] = args.workers
+    if args.seed is not None and args.method in randomized._available_methods:
+        method_args['seed'] = args.seed
+    if args.block_size is not None and args.method == 'block_random':
+        method_args['block_size'] = args.block_size
+    if args.metric != color_metrics.default_metric:
+        method_args['metric'] = args.metric
+    run_batch(args.sources, args.output, args.method, args.palette, args.dtype, args.indexed,
+            args.jobs, args.max_in_flight, args.force, args.recursive, cache=args.cache,
+            engine=args.engine, method_args=method_args)
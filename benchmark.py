@@ -0,0 +1,327 @@
+from collections import OrderedDict
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import numpy
+
+import accel
+import dither
+import error_diffusion
+import palette
+import palette_index
+import randomized
+import registry
+import utils
+
+# flat colors the mean color check dithers, and how far the mean of the
+# dithered colors may drift from them, as the error leaving the image at
+# its edges is lost
+mean_colors = [(0.8, 0.2, 0.2), (0.1, 0.5, 0.93), (0.5, 0.5, 0.5), (0.25, 0.75, 0.05)]
+MEAN_TOLERANCE = 0.01
+
+# corpus image sizes for the methods suite, from a thumbnail to 4K UHD
+corpus_sizes = [(64, 64), (256, 256), (1024, 1024), (3840, 2160)]
+corpus_photo = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'images', 'parrot.jpg')
+
+
+def _best_time(function, repeat):
+    best = float('inf')
+    for r in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_palette_index(n_pixels=10**6, sizes=(4, 16, 64, 216, 256, 1024, 4096), repeat=3, seed=0):
+    # query cost of the palette index against a brute force scan for random
+    # palettes of growing size; both must agree on every pixel
+    rng = numpy.random.default_rng(seed)
+    pixels = rng.random((n_pixels, 3))
+    results = []
+
+    for size in sizes:
+        colors = rng.random((size, 3))
+        start = time.perf_counter()
+        index = palette_index.PaletteIndex(colors)
+        build_time = time.perf_counter() - start
+
+        if not numpy.array_equal(index.query(pixels), utils.nearest_indices(pixels, colors)):
+            raise RuntimeError('palette index disagrees with brute force for {} colors'.format(size))
+
+        results.append({
+            'colors': size,
+            'strategy': index.strategy,
+            'build_s': build_time,
+            'index_s': _best_time(lambda: index.query(pixels), repeat),
+            'brute_s': _best_time(lambda: utils.nearest_indices(pixels, colors), repeat),
+        })
+    return results
+
+
+def _print_palette_index(results, n_pixels):
+    print('{:>8} {:>8} {:>10} {:>12} {:>12} {:>8}'.format(
+        'colors', 'strategy', 'build s', 'index Mpx/s', 'brute Mpx/s', 'speedup'))
+    for r in results:
+        print('{:>8} {:>8} {:>10.3f} {:>12.2f} {:>12.2f} {:>7.1f}x'.format(
+            r['colors'], r['strategy'], r['build_s'],
+            n_pixels / r['index_s'] / 1e6, n_pixels / r['brute_s'] / 1e6,
+            r['brute_s'] / r['index_s']))
+
+
+def bench_wavefront(width=1920, height=1080, kernel_name='floyd_steinberg', palette_name='ega_default',
+        workers=None, repeat=3, seed=0):
+    # wavefront error diffusion at growing thread counts; every run must be
+    # bit-identical to the serial one
+    if not accel.available:
+        raise RuntimeError('the wavefront scheduler needs numba')
+    if workers is None:
+        workers = [1]
+        while workers[-1] * 2 <= os.cpu_count():
+            workers.append(workers[-1] * 2)
+        if workers[-1] != os.cpu_count():
+            workers.append(os.cpu_count())
+    image = numpy.random.default_rng(seed).random((height, width, 3))
+
+    def run(n):
+        return error_diffusion.ErrorDiffuser(width, palette_name, kernel_name).process(image, n)
+
+    reference = run(1)
+    results = []
+    for n in workers:
+        if not numpy.array_equal(run(n), reference):
+            raise RuntimeError('wavefront result with {} workers differs from the serial one'.format(n))
+        results.append({'workers': n, 'time_s': _best_time(lambda: run(n), repeat)})
+    return results
+
+
+def _print_wavefront(results, n_pixels):
+    print('{:>8} {:>10} {:>10} {:>8}'.format('workers', 'time s', 'Mpx/s', 'speedup'))
+    for r in results:
+        print('{:>8} {:>10.3f} {:>10.2f} {:>7.2f}x'.format(r['workers'], r['time_s'],
+            n_pixels / r['time_s'] / 1e6, results[0]['time_s'] / r['time_s']))
+
+
+def check_mean_color(methods=None, palettes=('websafe',), size=96, colors=mean_colors,
+        dtypes=('float64', 'uint8')):
+    # error diffusion of a flat color must keep the image's mean color; the
+    # palettes must span the whole color cube for every color to be reached,
+    # and kernels that pass on only part of the error, as atkinson's does,
+    # are left out
+    methods = methods or list(error_diffusion._method_names)
+    results = []
+    for method in methods:
+        kernel_name, options = error_diffusion._method_kernels[method]
+        if not numpy.isclose(error_diffusion._stencils[kernel_name][0].sum(), 1.0):
+            continue
+        for palette_name in palettes:
+            if not registry.methods[method].accepts(palette_name):
+                continue
+            for color in colors:
+                flat = numpy.full((size, size, 3), numpy.round(numpy.multiply(color, 255)), dtype=numpy.uint8)
+                for dtype in dtypes:
+                    image_matrix = utils.pil2numpy(flat, dtype)
+                    dithered = dither.available_methods[method](image_matrix, palette_name)
+                    drift = numpy.abs(utils.unit_float(dithered).reshape(-1, 3).mean(axis=0)
+                            - utils.unit_float(image_matrix[0, 0]))
+                    if drift.max() > MEAN_TOLERANCE:
+                        raise RuntimeError('{} on {} moves the mean of {} ({}) by {}'.format(
+                            method, palette_name, color, dtype, numpy.round(drift, 4)))
+                    results.append({'method': method, 'palette': palette_name, 'color': color,
+                        'dtype': dtype, 'drift': float(drift.max())})
+    return results
+
+
+def _print_mean_color(results):
+    print('{:<28} {:<10} {:<20} {:<8} {:>8}'.format('method', 'palette', 'color', 'dtype', 'drift'))
+    for r in results:
+        print('{:<28} {:<10} {:<20} {:<8} {:>8.4f}'.format(r['method'], r['palette'],
+            ','.join(str(c) for c in r['color']), r['dtype'], r['drift']))
+
+
+def make_corpus(sizes=corpus_sizes, photo=corpus_photo, seed=0):
+    # synthetic gradient and noise images at every size, plus a photo; the
+    # same seed always gives the same uint8 (H, W, 3) matrices
+    rng = numpy.random.default_rng(seed)
+    corpus = OrderedDict()
+    for width, height in sizes:
+        y, x = numpy.mgrid[0:height, 0:width]
+        gradient = numpy.stack([x / max(1, width - 1), y / max(1, height - 1),
+            (x + y) / max(1, width + height - 2)], axis=2)
+        corpus['gradient_{}x{}'.format(width, height)] = numpy.uint8(gradient * 255)
+        corpus['noise_{}x{}'.format(width, height)] = rng.integers(0, 256, (height, width, 3), dtype=numpy.uint8)
+    if photo:
+        corpus[os.path.splitext(os.path.basename(photo))[0]] = numpy.asarray(utils.open_image(photo))
+    return corpus
+
+
+def _reset_peak_rss():
+    # linux lets the high water mark of the resident set be reset, which
+    # makes the peak below per run instead of per process
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss():
+    # peak resident set size in bytes
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def bench_methods(corpus, methods=None, palettes=None, repeat=3, dtype='float64'):
+    # throughput and memory of every method with every palette on every
+    # corpus image; randomized methods get a fixed seed
+    methods = methods or list(dither.available_methods)
+    palettes = palettes or list(palette.available_palettes)
+    results = []
+
+    for image_name, image in corpus.items():
+        image_matrix = utils.pil2numpy(image, dtype)
+        height, width = image_matrix.shape[:2]
+        for method in methods:
+            method_args = {'seed': 0} if method in randomized._available_methods else {}
+            for palette_name in palettes:
+                if not registry.methods[method].accepts(palette_name):
+                    continue
+
+                def run():
+                    return dither.available_methods[method](image_matrix, palette_name, **method_args)
+
+                # warm up once so that one-off palette, lookup table and jit
+                # compilation costs are not counted
+                run()
+                time_s = _best_time(run, repeat)
+
+                _reset_peak_rss()
+                tracemalloc.start()
+                run()
+                alloc_peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+                results.append({
+                    'image': image_name,
+                    'width': width,
+                    'height': height,
+                    'method': method,
+                    'palette': palette_name,
+                    'time_s': time_s,
+                    'mpx_s': width * height / time_s / 1e6,
+                    'peak_rss_mb': _peak_rss() / 2**20,
+                    'alloc_peak_mb': alloc_peak / 2**20,
+                })
+    return results
+
+
+def _print_methods(results):
+    print('{:<20} {:<16} {:<18} {:>9} {:>9} {:>9} {:>9}'.format(
+        'image', 'method', 'palette', 'time s', 'Mpx/s', 'RSS MB', 'alloc MB'))
+    for r in results:
+        print('{:<20} {:<16} {:<18} {:>9.4f} {:>9.2f} {:>9.1f} {:>9.1f}'.format(
+            r['image'], r['method'], r['palette'], r['time_s'], r['mpx_s'],
+            r['peak_rss_mb'], r['alloc_peak_mb']))
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'numba': accel.available,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def save_results(filename, suite, results):
+    with open(filename, 'w') as f:
+        json.dump({'suite': suite, 'environment': environment(), 'results': results}, f, indent=1)
+
+
+def compare(results, baseline, tolerance=0.1):
+    # runs whose throughput fell, or whose allocation peak grew, by more than
+    # the tolerance relative to the baseline run of the same case
+    key = lambda r: (r['image'], r['method'], r['palette'])
+    previous = {key(r): r for r in baseline}
+    regressions = []
+    for r in results:
+        old = previous.get(key(r))
+        if old is None:
+            continue
+        if r['mpx_s'] < old['mpx_s'] * (1 - tolerance):
+            regressions.append((r, old, 'mpx_s'))
+        if r['alloc_peak_mb'] > old['alloc_peak_mb'] * (1 + tolerance):
+            regressions.append((r, old, 'alloc_peak_mb'))
+    return regressions
+
+
+def _print_regressions(regressions, tolerance):
+    if not regressions:
+        print('no regressions beyond {:.0%}'.format(tolerance))
+        return
+    print('{} regressions beyond {:.0%}:'.format(len(regressions), tolerance))
+    for r, old, field in regressions:
+        print('  {} {} {}: {} {:.2f} -> {:.2f}'.format(
+            r['image'], r['method'], r['palette'], field, old[field], r[field]))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('suite', choices=['palette_index', 'wavefront', 'methods', 'mean_color'], help='Benchmark to run')
+    parser.add_argument('-n', '--pixels', type=int, default=10**6, help='Number of pixels per query')
+    parser.add_argument('-s', '--size', type=str, default='1920x1080', help='Image size for the wavefront benchmark')
+    parser.add_argument('-w', '--workers', type=int, nargs='*', default=None, help='Thread counts for the wavefront benchmark')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Timing repetitions, the best one is kept')
+    parser.add_argument('--sizes', type=str, nargs='*', default=None, help='Corpus image sizes for the methods benchmark, e.g. 64x64 3840x2160')
+    parser.add_argument('--no-photo', action='store_true', help='Leave the photo out of the methods corpus')
+    parser.add_argument('-m', '--methods', type=str, nargs='*', default=None, help='Methods to benchmark (default: all)')
+    parser.add_argument('-p', '--palettes', type=str, nargs='*', default=None, help='Palettes to benchmark (default: all)')
+    parser.add_argument('--dtype', type=str, default='float64', choices=['float64', 'float32', 'uint8'], help='Pixel type to dither in')
+    parser.add_argument('--json', type=str, default=None, help='Write the results to this JSON file')
+    parser.add_argument('--baseline', type=str, default=None, help='JSON results of an earlier methods run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Relative slowdown or allocation growth reported as a regression')
+    args = parser.parse_args()
+
+    if args.suite == 'palette_index':
+        results = bench_palette_index(args.pixels, repeat=args.repeat)
+        _print_palette_index(results, args.pixels)
+    elif args.suite == 'wavefront':
+        width, height = [int(v) for v in args.size.split('x')]
+        results = bench_wavefront(width, height, workers=args.workers, repeat=args.repeat)
+        _print_wavefront(results, width * height)
+    elif args.suite == 'methods':
+        sizes = corpus_sizes
+        if args.sizes is not None:
+            sizes = [tuple(int(v) for v in size.split('x')) for size in args.sizes]
+        corpus = make_corpus(sizes, None if args.no_photo else corpus_photo)
+        results = bench_methods(corpus, args.methods, args.palettes, args.repeat, args.dtype)
+        _print_methods(results)
+    elif args.suite == 'mean_color':
+        results = check_mean_color(args.methods, args.palettes or ('websafe',))
+        _print_mean_color(results)
+
+    if args.json:
+        save_results(args.json, args.suite, results)
+    if args.baseline:
+        if args.suite != 'methods':
+            parser.error('--baseline compares methods runs only')
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        _print_regressions(regressions, args.tolerance)
+        if regressions:
+            sys.exit(1)
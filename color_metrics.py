@@ -0,0 +1,137 @@
+from collections import OrderedDict
+import numpy
+
+import accel
+import palette
+
+DEBUGMODE = False
+
+# every metric is a euclidean distance after a transform of the sRGB pixels
+# into some space; the spaces are shifted and uniformly scaled so that the
+# sRGB cube lands inside the unit cube, which keeps the nearest color the
+# same while letting the palette indices and lookup tables work unchanged
+#
+#   rgb           plain distance on gamma encoded sRGB
+#   weighted_rgb  sRGB channels weighted by their luma share
+#   linear_rgb    distance on linear light values
+#   lab           CIELAB under D65, i.e. delta E 1976
+#   oklab         Ottosson's OKLab
+metric_ids = OrderedDict([
+        ('rgb', 0),
+        ('weighted_rgb', 1),
+        ('linear_rgb', 2),
+        ('lab', 3),
+        ('oklab', 4),
+])
+available_metrics = list(metric_ids)
+default_metric = 'rgb'
+
+# luma weights, divided by the largest so that green keeps its full range
+_WEIGHTS = (0.299 / 0.587, 1.0, 0.114 / 0.587)
+
+# linear sRGB to XYZ (D65), and the D65 white point
+_XYZ = ((0.4124564, 0.3575761, 0.1804375),
+        (0.2126729, 0.7151522, 0.0721750),
+        (0.0193339, 0.1191920, 0.9503041))
+_WHITE = (0.95047, 1.0, 1.08883)
+
+# L in [0, 100], a in about [-86, 98] and b in about [-108, 95]
+_LAB_OFFSET = (0.0, 90.0, 110.0)
+_LAB_SCALE = 1. / 210.
+
+# linear sRGB to LMS, and cube rooted LMS to OKLab
+_LMS = ((0.4122214708, 0.5363325363, 0.0514459929),
+        (0.2119034982, 0.6806995451, 0.1073969566),
+        (0.0883024619, 0.2817188376, 0.6299787005))
+_OKLAB = ((0.2104542553, 0.7936177850, -0.0040720468),
+          (1.9779984951, -2.4285922050, 0.4505937099),
+          (0.0259040371, 0.7827717662, -0.8086757660))
+
+# L in [0, 1], a in about [-0.23, 0.28] and b in about [-0.31, 0.2]
+_OKLAB_OFFSET = (0.0, 0.24, 0.32)
+
+
+def _linear(c):
+    if c <= 0.04045:
+        return c / 12.92
+    return ((c + 0.055) / 1.055) ** 2.4
+
+
+def _lab_f(t):
+    if t > 0.008856451679035631:  # (6/29)**3
+        return t ** (1. / 3.)
+    return t / 0.12841854934601665 + 4. / 29.  # 3 * (6/29)**2
+
+
+def _to_space_kernel(v0, v1, v2, metric):
+    # one sRGB pixel, already clamped to [0, 1], into the metric's space; the
+    # per pixel twin of to_space, used inside the diffusion loops
+    if metric == 1:
+        return v0 * _WEIGHTS[0] ** 0.5, v1 * _WEIGHTS[1] ** 0.5, v2 * _WEIGHTS[2] ** 0.5
+    r = _linear(v0)
+    g = _linear(v1)
+    b = _linear(v2)
+    if metric == 2:
+        return r, g, b
+    if metric == 3:
+        fx = _lab_f((_XYZ[0][0] * r + _XYZ[0][1] * g + _XYZ[0][2] * b) / _WHITE[0])
+        fy = _lab_f((_XYZ[1][0] * r + _XYZ[1][1] * g + _XYZ[1][2] * b) / _WHITE[1])
+        fz = _lab_f((_XYZ[2][0] * r + _XYZ[2][1] * g + _XYZ[2][2] * b) / _WHITE[2])
+        return ((116. * fy - 16. + _LAB_OFFSET[0]) * _LAB_SCALE,
+                (500. * (fx - fy) + _LAB_OFFSET[1]) * _LAB_SCALE,
+                (200. * (fy - fz) + _LAB_OFFSET[2]) * _LAB_SCALE)
+    l = (_LMS[0][0] * r + _LMS[0][1] * g + _LMS[0][2] * b) ** (1. / 3.)
+    m = (_LMS[1][0] * r + _LMS[1][1] * g + _LMS[1][2] * b) ** (1. / 3.)
+    s = (_LMS[2][0] * r + _LMS[2][1] * g + _LMS[2][2] * b) ** (1. / 3.)
+    return (_OKLAB[0][0] * l + _OKLAB[0][1] * m + _OKLAB[0][2] * s + _OKLAB_OFFSET[0],
+            _OKLAB[1][0] * l + _OKLAB[1][1] * m + _OKLAB[1][2] * s + _OKLAB_OFFSET[1],
+            _OKLAB[2][0] * l + _OKLAB[2][1] * m + _OKLAB[2][2] * s + _OKLAB_OFFSET[2])
+
+if accel.available:
+    _linear = accel.jit(_linear)
+    _lab_f = accel.jit(_lab_f)
+_to_space_jit = accel.jit(_to_space_kernel)
+
+
+def to_space(pixels, metric):
+    # (..., 3) sRGB pixels into the metric's space in one vectorized pass, in
+    # the pixels' float type; pixels outside [0, 1] are clamped first
+    if metric_ids[metric] == 0:
+        return pixels
+    dtype = pixels.dtype if pixels.dtype in (numpy.float32, numpy.float64) else numpy.float64
+    values = numpy.clip(numpy.asarray(pixels, dtype=numpy.float64), 0.0, 1.0)
+    if metric == 'weighted_rgb':
+        return (values * numpy.sqrt(_WEIGHTS)).astype(dtype)
+    linear = numpy.where(values <= 0.04045, values / 12.92, ((values + 0.055) / 1.055) ** 2.4)
+    if metric == 'linear_rgb':
+        return linear.astype(dtype)
+    if metric == 'lab':
+        xyz = linear @ numpy.array(_XYZ).T / numpy.array(_WHITE)
+        f = numpy.where(xyz > 0.008856451679035631, xyz ** (1. / 3.), xyz / 0.12841854934601665 + 4. / 29.)
+        lab = numpy.stack([116. * f[..., 1] - 16., 500. * (f[..., 0] - f[..., 1]),
+            200. * (f[..., 1] - f[..., 2])], axis=-1)
+        return ((lab + numpy.array(_LAB_OFFSET)) * _LAB_SCALE).astype(dtype)
+    lms = (linear @ numpy.array(_LMS).T) ** (1. / 3.)
+    return (lms @ numpy.array(_OKLAB).T + numpy.array(_OKLAB_OFFSET)).astype(dtype)
+
+
+_palette_spaces = {}
+
+def palette_in_space(palette_name, metric):
+    # palette colors in the metric's space, converted once per process
+    key = (palette_name, metric)
+    if key not in _palette_spaces:
+        colors = numpy.asarray(palette.palettes[palette_name], dtype=numpy.float64)
+        space = to_space(colors, metric)
+        space.flags.writeable = False
+        _palette_spaces[key] = space
+    return _palette_spaces[key]
+
+
+if __name__ == '__main__':
+    # how far the spaces reach over the sRGB cube; all must stay in [0, 1]
+    grid = numpy.linspace(0., 1., 33)
+    cube = numpy.stack(numpy.meshgrid(grid, grid, grid, indexing='ij'), axis=-1).reshape(-1, 3)
+    for metric in available_metrics:
+        space = to_space(cube, metric)
+        print('{:>12}: min {} max {}'.format(metric, numpy.round(space.min(axis=0), 3), numpy.round(space.max(axis=0), 3)))
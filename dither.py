@@ -1,35 +1,173 @@
 from PIL import Image
-from collections import OrderedDict
+import asyncio
+import contextlib
+import functools
 import numpy
+import os
 import random
 import sys
 
+import color_metrics
+import instrument
 import palette
 import utils
 
-import error_diffusion
-import ordered_dithering
 import randomized
-import threshold
+import registry
+import streaming
 
 DEBUGMODE = False
 default_method = 'bayer4x4'
 default_palette = 'cga_mode4_2_high'
 
-available_methods = OrderedDict()
+# every method registered with registry.register_method, built in or not
+available_methods = registry.available_methods
 
-available_methods.update(threshold._available_methods)
-available_methods.update(randomized._available_methods)
-available_methods.update(ordered_dithering._available_methods)
-available_methods.update(error_diffusion._available_methods)
+def _method_function(method, engine):
+    # the plain method, or the method run through registry.run on engine
+    # ('auto' to let the cost model pick); every engine gives the same result
+    if engine is None:
+        return available_methods[method]
+    return registry.method_function(method, engine)
+
+def dither_image(image, method, palette_name, dtype='float64', indexed=False, cache=None, engine=None, **method_args):
+    # dither a PIL image, returning a PIL image: rgb, or "P" mode with the
+    # palette attached when indexed is set; with a result_cache.ResultCache
+    # a repeated call is served from the cached index map
+    image_matrix = utils.pil2numpy(image, dtype)
+    method_function = _method_function(method, engine)
+    with instrument.stage('dither', image_matrix.shape[0] * image_matrix.shape[1]):
+        if cache is not None:
+            indices = cache.indices(method_function, image_matrix, method, palette_name, **method_args)
+            if not indexed:
+                dither_matrix = utils.dither_result(indices, palette_name, image_matrix)
+        elif indexed:
+            indices = method_function(image_matrix, palette_name, return_indices=True, **method_args)
+        else:
+            dither_matrix = method_function(image_matrix, palette_name, **method_args)
+    if indexed:
+        return utils.indices2pil(indices, palette_name)
+    return utils.numpy2pil(dither_matrix)
+
+# pixels whose colors dither_array gathers at once
+_GATHER_PIXELS = 1 << 16
+
+def _as_image_matrix(source, shape=None, buffer_dtype=numpy.uint8):
+    # an (H, W, 3) view of source without copying where possible: numpy
+    # arrays as they are, PIL images through their array interface, and
+    # other buffer protocol objects as shape-d arrays of buffer_dtype
+    if isinstance(source, Image.Image):
+        if source.mode != 'RGB':
+            source = source.convert('RGB')
+        matrix = numpy.asarray(source)
+    elif isinstance(source, numpy.ndarray):
+        matrix = source
+    elif shape is not None:
+        matrix = numpy.frombuffer(source, dtype=buffer_dtype).reshape(shape)
+    else:
+        matrix = numpy.asarray(memoryview(source))
+    if shape is not None and matrix.shape != tuple(shape):
+        matrix = matrix.reshape(shape)
+    if matrix.ndim != 3 or matrix.shape[2] not in (3, 4):
+        raise ValueError('expected an (H, W, 3) or (H, W, 4) image, got shape {}'.format(matrix.shape))
+    if matrix.dtype not in (numpy.uint8, numpy.float32, numpy.float64):
+        raise ValueError('expected uint8, float32 or float64 pixels, got {}'.format(matrix.dtype))
+    # alpha is ignored
+    return matrix[:, :, :3]
+
+def dither_array(source, method=default_method, palette_name=default_palette, out=None,
+        indices=False, shape=None, buffer_dtype=numpy.uint8, engine=None, **method_args):
+    # dither an image held in memory and return the result in a numpy array
+    #
+    # source is an (H, W, 3) (or (H, W, 4), alpha ignored) numpy array of
+    # uint8 (0-255) or float32/float64 ([0, 1]) pixels, a PIL image, or any
+    # buffer protocol object; flat buffers need shape (and buffer_dtype when
+    # not uint8). arrays and buffers are viewed rather than converted to
+    # float64; the methods take them in their own dtype, error diffusion
+    # reading uint8 pixels as they are and the other methods making a float32
+    # working copy of uint8 input (utils.unit_float)
+    #
+    # the result is the (H, W) palette index map when indices is set, else
+    # the (H, W, 3) palette colors in the source's dtype. with out, the
+    # result is written into that caller owned array instead: an (H, W)
+    # integer array gets the indices, an (H, W, 3) uint8 or float array the
+    # colors in its own dtype. method_args go to the method (seed, metric,
+    # workers); engine is as for dither_image
+    matrix = _as_image_matrix(source, shape, buffer_dtype)
+    height, width = matrix.shape[:2]
+    if out is not None:
+        indices = out.ndim == 2
+        if out.shape[:2] != (height, width) or (not indices and out.shape != (height, width, 3)):
+            raise ValueError('out has shape {}, expected ({}, {}) or ({}, {}, 3)'.format(
+                out.shape, height, width, height, width))
+
+    with instrument.stage('dither', height * width):
+        index_map = _method_function(method, engine)(matrix, palette_name, return_indices=True, **method_args)
+    if indices:
+        if out is None:
+            return index_map
+        out[...] = index_map
+        return out
+
+    # palette colors are gathered straight into the output, a block of rows
+    # at a time since take widens the indices it is given to intp
+    if out is None:
+        out = numpy.empty((height, width, 3), dtype=utils.output_dtype(matrix))
+    colors = utils.palette_array(palette_name, out.dtype)
+    step = max(1, _GATHER_PIXELS // width)
+    for y in range(0, height, step):
+        numpy.take(colors, index_map[y:y+step], axis=0, out=out[y:y+step], mode='clip')
+    return out
+
+async def dither_array_async(source, method=default_method, palette_name=default_palette, out=None,
+        executor=None, **kwargs):
+    # dither_array run in an executor (the event loop's default thread pool
+    # unless given), so a coroutine can await it without blocking the loop;
+    # the compiled kernels and numpy release the GIL while they work
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(dither_array, source, method,
+        palette_name, out, **kwargs))
+
+# the collage workers attach to two shared memory blocks: the uint8 source
+# image and the uint8 canvas every tile is written into, so neither the image
+# nor the results are ever pickled
+_collage_source = None
+_collage_canvas = None
+_collage_blocks = []
+
+def _attach_collage(source_name, source_shape, canvas_name, canvas_shape):
+    global _collage_source, _collage_canvas
+    from multiprocessing import shared_memory
+
+    source_block = shared_memory.SharedMemory(name=source_name)
+    canvas_block = shared_memory.SharedMemory(name=canvas_name)
+    # keep the blocks referenced for as long as the views are in use
+    _collage_blocks[:] = [source_block, canvas_block]
+    _collage_source = numpy.ndarray(source_shape, dtype=numpy.uint8, buffer=source_block.buf)
+    _collage_canvas = numpy.ndarray(canvas_shape, dtype=numpy.uint8, buffer=canvas_block.buf)
 
 def _do_work(work_args):
-    image_offset, image_matrix, method, palette_name = work_args
+    image_offset, method, palette_name = work_args
+    x, y = image_offset
+    height, width = _collage_source.shape[:2]
+
+    try:
+        dither_matrix = available_methods[method](utils.pil2numpy(_collage_source), palette_name)
+    except Exception as e:
+        return (method, palette_name, str(e))
+    # same rounding as utils.numpy2pil
+    _collage_canvas[y:y+height, x:x+width] = numpy.uint8(dither_matrix*255)
 
-    dither_matrix = available_methods[method](image_matrix, palette_name)
-    dither_image = utils.numpy2pil(dither_matrix)
+    return (method, palette_name, None)
 
-    return (image_offset, dither_image)
+def _collage_cost(method, palette_name):
+    # relative cost of one tile, used to hand out the slowest tiles first so
+    # that no worker is left with a long one at the end
+    return registry.pixel_cost(method, len(palette.palettes[palette_name]), registry.cost_model())
+
+def _text_size(font, text):
+    left, top, right, bottom = font.getbbox(text)
+    return right - left, bottom - top
 
 def _get_font(image_size):
     from PIL import ImageFont
@@ -38,6 +176,7 @@ def _get_font(image_size):
     fontnames = ['DejaVuSans.ttf', 'Arial.ttf']
     goodname = ''
     fontsize = 1
+    font = None
 
     for fontname in fontnames:
         try:
@@ -49,7 +188,7 @@ def _get_font(image_size):
     if font is not None:
         longest_palette_name = max(palette.available_palettes, key=len)
         longest_method_name  = max(available_methods, key=len)
-        while font.getsize(longest_palette_name)[0] < constraint and font.getsize(longest_method_name)[0] < constraint:
+        while _text_size(font, longest_palette_name)[0] < constraint and _text_size(font, longest_method_name)[0] < constraint:
             fontsize += 1
             font = ImageFont.truetype(goodname, size=fontsize)
         font = ImageFont.truetype(goodname, size=max(1, fontsize-1))
@@ -58,56 +197,87 @@ def _get_font(image_size):
 
     return font
 
-def create_collage(image_filename):
-    from multiprocessing import Pool, cpu_count
+def create_collage(image_filename, output_filename='collage.png', workers=None, tile_size=None):
+    # with tile_size, a (width, height) the tiles fit in, every tile dithers
+    # a proxy of the image (see preview.py) rather than the full image
+    from multiprocessing import Pool, cpu_count, shared_memory
     from PIL import ImageDraw
 
     image = utils.open_image(image_filename)
+    if tile_size is not None:
+        import preview
+
+        image = Image.fromarray(preview.proxy_matrix(numpy.asarray(image), tile_size))
     width, height = image.size
 
     n_palettes = len(palette.available_palettes)
     n_methods  = len(available_methods)
 
-    canvas_size = (width * (n_palettes + 1), height * (n_methods + 1))
-    canvas = Image.new('RGB', canvas_size)
-    canvas.paste(image, (0, 0))
-    drawer = ImageDraw.Draw(canvas)
-    font   = _get_font(image.size)
-    font_color = (255, 255, 255, 255)
+    source_shape = (height, width, 3)
+    canvas_shape = (height * (n_methods + 1), width * (n_palettes + 1), 3)
+    source_block = shared_memory.SharedMemory(create=True, size=int(numpy.prod(source_shape)))
+    canvas_block = shared_memory.SharedMemory(create=True, size=int(numpy.prod(canvas_shape)))
+
+    try:
+        source = numpy.ndarray(source_shape, dtype=numpy.uint8, buffer=source_block.buf)
+        source[:] = numpy.asarray(image)
+        canvas = numpy.ndarray(canvas_shape, dtype=numpy.uint8, buffer=canvas_block.buf)
+        canvas[:] = 0
+        canvas[:height, :width] = source
 
-    image_matrix = utils.pil2numpy(image)
+        work_objects = []
+        for p_i, p in enumerate(palette.available_palettes):
+            for m_i, m in enumerate(available_methods):
+                if not registry.methods[m].accepts(p):
+                    continue
+                image_offset = ((p_i + 1) * width, (m_i + 1) * height)
+                work_objects.append( (image_offset, m, p) )
+        work_objects.sort(key=lambda w: _collage_cost(w[1], w[2]), reverse=True)
 
-    work_objects = []
+        with Pool(workers or cpu_count(), initializer=_attach_collage,
+                initargs=(source_block.name, source_shape, canvas_block.name, canvas_shape)) as pool:
+            for m, p, error in pool.imap_unordered(_do_work, work_objects):
+                if error is not None:
+                    print(f'{m} with {p} failed: {error}', file=sys.stderr)
+                elif DEBUGMODE:
+                    print(f'{m} with {p} done')
 
+        collage = Image.fromarray(canvas)
+        del source, canvas
+    finally:
+        source_block.close()
+        source_block.unlink()
+        canvas_block.close()
+        canvas_block.unlink()
+
+    # the header row and column get their labels once the tiles are in
+    drawer = ImageDraw.Draw(collage)
+    font   = _get_font(image.size)
+    font_color = (255, 255, 255, 255)
     for p_i, p in enumerate(palette.available_palettes):
-        text_width, text_height = font.getsize(p)
+        text_width, text_height = _text_size(font, p)
         text_pos = ((p_i + 1) * width + (width - text_width) / 2, (height - text_height) / 2)
         drawer.text(text_pos, p, font=font, fill=font_color)
-        for m_i, m in enumerate(available_methods):
-            if p_i == 0:
-                text_width, text_height = font.getsize(m)
-                text_pos = ((width - text_width) / 2, (m_i + 1) * height + (height - text_height) / 2)
-                drawer.text(text_pos, m, font=font, fill=font_color)
-            image_offset = ((p_i + 1) * width, (m_i + 1) * height)
-            work_objects.append( (image_offset, image_matrix, m, p) )
+    for m_i, m in enumerate(available_methods):
+        text_width, text_height = _text_size(font, m)
+        text_pos = ((width - text_width) / 2, (m_i + 1) * height + (height - text_height) / 2)
+        drawer.text(text_pos, m, font=font, fill=font_color)
     del drawer
 
-    pool = Pool(cpu_count())
-
-    results = pool.map(_do_work, work_objects)
-
-    for r in results:
-        image_offset, dither_image = r
-        canvas.paste(dither_image, image_offset)
-
-    canvas.save('collage.png')
-    canvas.show()
+    collage.save(output_filename)
+    return collage
 
 if __name__ == '__main__':
     import argparse
 
+    if sys.argv[1:2] == ['serve']:
+        import server
+
+        server.main(sys.argv[2:])
+        sys.exit()
+
     parser = argparse.ArgumentParser()
-    parser.add_argument('image_filename', help='Path to an image file to dither')
+    parser.add_argument('image_filename', nargs='+', help='Path to an image file to dither (with --batch: files, directories, globs or @lists)')
     palette_help_str = 'Name of palette to use. Can be one of: ' + ', '.join(palette.available_palettes)
     method_help_str = 'Method to use. Can be one of: ' + ', '.join(available_methods)
     all_help_str = 'Create a collage using all palettes and all dithering methods'
@@ -116,19 +286,142 @@ if __name__ == '__main__':
     parser.add_argument('-m', '--method', type=str, default=default_method, help=method_help_str)
     parser.add_argument('-o', '--output', type=str, default='', help=output_help_str)
     parser.add_argument('-a', '--all', action='store_true', help=all_help_str)
+    stream_help_str = 'Dither the image strip by strip straight into the output file to bound memory use; PPM, .npy and raw inputs are also read strip by strip, other formats are decoded whole first'
+    parser.add_argument('-s', '--stream', action='store_true', help=stream_help_str)
+    parser.add_argument('--strip-height', type=int, default=None, help='Rows per strip when streaming')
+    raw_help_str = 'Shape (H,W or H,W,C) of a headerless raw input file; .npy and raw inputs and outputs are memory mapped and streamed'
+    parser.add_argument('--raw-shape', type=streaming.parse_shape, default=None, help=raw_help_str)
+    parser.add_argument('--raw-dtype', type=str, default='uint8', choices=['uint8', 'uint16', 'float32', 'float64'], help='Value type of a raw input file')
+    dtype_help_str = 'Pixel type to dither in: float64 (default), float32, or uint8 with integer error diffusion'
+    parser.add_argument('--dtype', type=str, default='float64', choices=['float64', 'float32', 'uint8'], help=dtype_help_str)
+    indexed_help_str = 'Produce a palette ("P" mode) image instead of an RGB one'
+    parser.add_argument('-i', '--indexed', action='store_true', help=indexed_help_str)
+    workers_help_str = 'Cores to dither with, all of them by default; error diffusion runs on several only with numba'
+    parser.add_argument('-w', '--workers', type=int, default=None, help=workers_help_str)
+    engine_help_str = 'How the method is run: ' + ', '.join(registry.engines) + ', or auto (default) for the fastest one for the image, palette and cores, see registry.py'
+    parser.add_argument('--engine', type=str, default='auto', choices=['auto'] + registry.engines, help=engine_help_str)
+    calibrate_help_str = 'Measure the per pixel costs of this machine that --engine auto picks engines by, and keep them in the cache; until then fixed defaults are used'
+    parser.add_argument('--calibrate', action='store_true', help=calibrate_help_str)
+    seed_help_str = 'Seed for the randomized methods, the same seed gives the same image'
+    parser.add_argument('--seed', type=int, default=None, help=seed_help_str)
+    block_help_str = 'Block size in pixels for block_random, N or H,W; by default a 50x50 grid of blocks'
+    parser.add_argument('--block-size', type=streaming.parse_shape, default=None, help=block_help_str)
+    metric_help_str = 'Color distance used to pick palette colors: ' + ', '.join(color_metrics.available_metrics)
+    parser.add_argument('--metric', type=str, default=color_metrics.default_metric, choices=color_metrics.available_metrics, help=metric_help_str)
+    batch_help_str = 'Dither many images with a process pool; -o is then an output template, see batch.py'
+    parser.add_argument('-b', '--batch', action='store_true', help=batch_help_str)
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Worker processes in batch and collage mode')
+    adaptive_help_str = 'Dither to the best N colors for the image instead of a fixed palette'
+    parser.add_argument('--adaptive', type=int, default=None, metavar='N', help=adaptive_help_str)
+    parser.add_argument('--adaptive-algorithm', type=str, default='median_cut', choices=['median_cut', 'octree', 'kmeans'], help='How the adaptive palette is found')
+    cache_help_str = 'Keep the result in an on-disk cache and reuse it when the same image is dithered the same way again'
+    parser.add_argument('--cache', action='store_true', help=cache_help_str)
+    animate_help_str = 'Dither every frame of an animated GIF/PNG or a directory of frames, redoing only what changed; -o is an animation or a directory'
+    parser.add_argument('--animate', action='store_true', help=animate_help_str)
+    profile_help_str = 'Print the time spent in every stage (decode, convert, dither, quantize, diffuse, encode, save) and cache counters'
+    parser.add_argument('--profile', action='store_true', help=profile_help_str)
+    preview_help_str = 'Dither a proxy that fits in WxH instead of the full image; with -a, the size of the collage tiles'
+    parser.add_argument('--preview', type=str, default=None, metavar='WxH', help=preview_help_str)
+    roi_help_str = 'Dither only the box X0,Y0,X1,Y1 of the image, exactly as it comes out of the full image'
+    parser.add_argument('--roi', type=str, default=None, metavar='X0,Y0,X1,Y1', help=roi_help_str)
     args = parser.parse_args()
 
-    if args.all:
-        create_collage(args.image_filename)
-    else:
-        image = utils.open_image(args.image_filename)
-        image_matrix = utils.pil2numpy(image)
+    if args.preview is not None or args.roi is not None:
+        import preview
+
+        args.preview = preview.parse_size(args.preview) if args.preview is not None else None
+        args.roi = preview.parse_box(args.roi) if args.roi is not None else None
+
+    if args.calibrate:
+        registry.recalibrate()
+
+    method_info = registry.methods.get(args.method)
+    if method_info is not None and args.adaptive is None and not args.all and not method_info.accepts(args.palette):
+        parser.error('method {} cannot dither to {}'.format(args.method, args.palette))
 
-        dither_matrix = available_methods[args.method](image_matrix, args.palette)
-        dither_image = utils.numpy2pil(dither_matrix)
+    method_args = {}
+    if args.workers is not None:
+        method_args['workers'] = args.workers
+    if args.seed is not None and args.method in randomized._available_methods:
+        method_args['seed'] = args.seed
+    if args.block_size is not None and args.method == 'block_random':
+        method_args['block_size'] = args.block_size
+    if args.metric != color_metrics.default_metric:
+        method_args['metric'] = args.metric
 
-        if args.output == '':
-            dither_image.show()
+    if args.batch:
+        import batch
+
+        batch.run_batch(args.image_filename, args.output or batch.default_template, args.method,
+                args.palette, args.dtype, args.indexed, args.jobs, cache=args.cache,
+                engine=args.engine, method_args=method_args)
+        sys.exit()
+    if len(args.image_filename) > 1:
+        parser.error('only one image can be dithered at a time without --batch')
+    args.image_filename = args.image_filename[0]
+
+    # the collage workers run in other processes and are not profiled
+    with instrument.profile() if args.profile else contextlib.nullcontext() as profile:
+        if args.all:
+            collage = create_collage(args.image_filename, args.output or 'collage.png', args.jobs, args.preview)
+            if args.output == '':
+                collage.show()
+        elif args.animate:
+            import animation
+
+            if args.output == '':
+                parser.error('--animate needs an output file or directory')
+            animation.dither_animation(args.image_filename, args.output, args.method, args.palette,
+                    args.dtype, args.seed if args.seed is not None else 0, metric=args.metric)
+        elif (args.stream or args.raw_shape is not None
+                or os.path.splitext(args.image_filename)[1].lower() in streaming.array_extensions
+                or os.path.splitext(args.output)[1].lower() in streaming.array_extensions):
+            if args.output == '':
+                parser.error('--stream needs an output file')
+            if args.method not in streaming.strip_methods:
+                parser.error('method {} cannot be streamed, use one of: {}'.format(args.method,
+                        ', '.join(streaming.strip_methods)))
+            stream_args = {}
+            if args.seed is not None and args.method in randomized._available_methods:
+                stream_args['seed'] = args.seed
+            streaming.dither_file(args.image_filename, args.output, args.method, args.palette,
+                    args.strip_height, args.dtype, args.metric, args.raw_shape, args.raw_dtype, **stream_args)
         else:
-            dither_image.save(args.output)
+            image = utils.open_image(args.image_filename)
+
+            if args.adaptive is not None:
+                import adaptive
+
+                args.palette = adaptive.adaptive_palette(utils.pil2numpy(image, numpy.uint8),
+                        args.adaptive, args.adaptive_algorithm)
+                if not registry.methods[args.method].accepts(args.palette):
+                    parser.error('method {} cannot dither to an adaptive palette'.format(args.method))
+
+            cache = None
+            if args.cache:
+                import result_cache
+
+                cache = result_cache.ResultCache()
+
+            if args.preview is not None or args.roi is not None:
+                region = preview.RegionDitherer(image, args.method, args.palette, args.dtype, **method_args)
+                if args.preview is not None:
+                    indices = region.proxy(args.preview, args.roi)
+                else:
+                    indices = region.render(args.roi)
+                if args.indexed:
+                    result = utils.indices2pil(indices, args.palette)
+                else:
+                    result = utils.numpy2pil(utils.palette_array(args.palette, numpy.uint8)[indices])
+            else:
+                result = dither_image(image, args.method, args.palette, args.dtype, args.indexed, cache,
+                        args.engine, **method_args)
+
+            if args.output == '':
+                result.show()
+            else:
+                with instrument.stage('save'):
+                    result.save(args.output)
 
+    if profile is not None:
+        print(profile.summary(), file=sys.stderr)
@@ -2,98 +2,794 @@ from PIL import Image
 from collections import OrderedDict
 import numpy
 import sys
+import threading
 
+import accel
+import color_metrics
+import instrument
+import lut
 import palette
+import palette_index
 import utils
 
 DEBUGMODE = False
 default_palette = 'cga_mode_4_2_hi'
 
+# diffusion weights per kernel; the first row spreads error to the pixels
+# right of the current one, every following row is centered on the current
+# pixel one scanline further down
 _diffusion_matrices = {
-        'floyd_steinberg' : numpy.array([
+        'floyd_steinberg' : [
             [7./16],
             [3./16,5./16,1./16]
-        ], dtype=object),
-        'jajuni' : numpy.array([
+        ],
+        'jajuni' : [
             [7./48,5./48],
             [1./16,5./48,7./48,5./48,1./16],
             [1./48,1./16,5./48,1./16,1./48]
-        ], dtype=object),
-        'fan' : numpy.array([
+        ],
+        'fan' : [
             [7./16],
             [1./16,3./16,5./16,0.,0.]
-        ], dtype=object),
-        'stucki' : numpy.array([
+        ],
+        'stucki' : [
             [4./21,2./21],
             [1./21,2./21,4./21,2./21,1./21],
             [1./42,1./21,2./21,1./21,1./42]
-        ], dtype=object),
-        'burkes' : numpy.array([
+        ],
+        'burkes' : [
             [.25,.125],
             [.0625,.125,.25,.125,.0625]
-        ], dtype=object),
-        'sierra' : numpy.array([
+        ],
+        'sierra' : [
             [5./32,3./32],
             [1./16,1./8,5./32,1./8,1./16],
             [1./16,3./32,1./16]
-        ], dtype=object),
-        'two_row_sierra' : numpy.array([
+        ],
+        'two_row_sierra' : [
             [1./4,3./16],
             [1./16,1./8,3./16,1./8,1./16]
-        ], dtype=object),
-        'sierra_lite' : numpy.array([
+        ],
+        'sierra_lite' : [
             [0.5],
             [0.25,0.25,0]
-        ], dtype=object),
-        'atkinson' : numpy.array([
+        ],
+        'atkinson' : [
             [0.125,0.125],
             [0.125,0.125,0.125],
             [0.125]
-        ], dtype=object)
+        ]
 }
 
-def _error_diffusion(image_matrix, palette_name, diffusion_matrix):
-    new_matrix = numpy.copy(image_matrix)
-    cols, rows, depth = image_matrix.shape
+def _build_stencil(matrix):
+    # turn a ragged diffusion matrix into a dense (kernel height, kernel width)
+    # stencil; column pad of the stencil lines up with the current pixel
+    offsets = [len(row) // 2 for row in matrix[1:]]
+    pad = max(offsets + [0])
+    right = max([len(matrix[0])] + [len(row) - 1 - o for row, o in zip(matrix[1:], offsets)])
+    stencil = numpy.zeros((len(matrix), pad + 1 + right), dtype=numpy.float64)
+    for ci, coeff in enumerate(matrix[0]):
+        stencil[0, pad + ci + 1] = coeff
+    for di, (row, offset) in enumerate(zip(matrix[1:], offsets)):
+        for ci, coeff in enumerate(row):
+            stencil[di + 1, pad + ci - offset] = coeff
+    return stencil, pad
+
+def _integer_stencil(stencil):
+    # the same weights as integer numerators over the smallest common
+    # denominator, for diffusing uint8 images with int16 error
+    for denominator in range(1, 257):
+        scaled = stencil * denominator
+        if numpy.all(numpy.abs(scaled - numpy.round(scaled)) < 1e-9):
+            return numpy.round(scaled).astype(numpy.int64), denominator
+    raise ValueError('diffusion weights have no small common denominator')
+
+def _symmetric_stencil(stencil, pad):
+    # the stencil padded with zero columns so that the current pixel sits in
+    # its middle column, which lets serpentine scans mirror it in place
+    kh, kw = stencil.shape
+    half = max(pad, kw - 1 - pad)
+    wide = numpy.zeros((kh, 2 * half + 1), dtype=stencil.dtype)
+    wide[:, half - pad:half - pad + kw] = stencil
+    return wide, half
+
+_stencils = dict((name, _build_stencil(matrix)) for name, matrix in _diffusion_matrices.items())
+_integer_stencils = dict((name, _integer_stencil(stencil)) for name, (stencil, pad) in _stencils.items())
+
+# palettes with more colors than this are matched through their lookup table
+# inside the diffusion loop instead of a scan over every color
+_LUT_COLORS = 16
+
+
+def _nearest_kernel(v0, v1, v2, colors, resolution, lut_index, lut_offsets, lut_candidates):
+    # same answer as utils.nearest_indices for a single pixel
+    n_colors = colors.shape[0]
+    first = 0
+    last = n_colors
+    candidates = False
+    if resolution > 0 and 0.0 <= v0 <= 1.0 and 0.0 <= v1 <= 1.0 and 0.0 <= v2 <= 1.0:
+        cr = min(int(v0 * resolution), resolution - 1)
+        cg = min(int(v1 * resolution), resolution - 1)
+        cb = min(int(v2 * resolution), resolution - 1)
+        cell = (cr * resolution + cg) * resolution + cb
+        first = lut_offsets[cell]
+        last = lut_offsets[cell + 1]
+        if first == last:
+            return lut_index[cell]
+        candidates = True
+    best = 0
+    best_dist = numpy.inf
+    for i in range(first, last):
+        ci = lut_candidates[i] if candidates else i
+        d0 = v0 - colors[ci, 0]
+        d1 = v1 - colors[ci, 1]
+        d2 = v2 - colors[ci, 2]
+        dist = d0 * d0 + d1 * d1 + d2 * d2
+        if dist < best_dist:
+            best = ci
+            best_dist = dist
+    return best
+
+_nearest_jit = accel.jit(_nearest_kernel)
+
+
+def _match_kernel(v0, v1, v2, metric, match_colors, resolution, lut_index, lut_offsets, lut_candidates):
+    # nearest palette color under a color metric: match_colors are the
+    # palette colors in the metric's space, and the pixel is moved into that
+    # space first; rgb (metric 0) matches the sRGB value as it is
+    if metric != 0:
+        v0, v1, v2 = color_metrics._to_space_jit(min(max(v0, 0.0), 1.0), min(max(v1, 0.0), 1.0),
+                min(max(v2, 0.0), 1.0), metric)
+    return _nearest_jit(v0, v1, v2, match_colors, resolution, lut_index, lut_offsets, lut_candidates)
+
+_match_jit = accel.jit(_match_kernel)
+
+
+def _nearest_level_kernel(v, levels, n_levels):
+    # index of the level nearest v among the first n_levels sorted levels
+    best = 0
+    best_dist = abs(v - levels[0])
+    for i in range(1, n_levels):
+        dist = abs(v - levels[i])
+        if dist < best_dist:
+            best = i
+            best_dist = dist
+    return best
+
+_nearest_level_jit = accel.jit(_nearest_level_kernel)
+
+
+def _nearest_sorted_kernel(v, levels, n_levels):
+    # _nearest_level_kernel by bisection, for the long level lists of
+    # single channel diffusion
+    lo = 0
+    hi = n_levels - 1
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if levels[mid] <= v:
+            lo = mid
+        else:
+            hi = mid
+    return hi if abs(v - levels[hi]) < abs(v - levels[lo]) else lo
+
+_nearest_sorted_jit = accel.jit(_nearest_sorted_kernel)
+
+
+def _diffuse_span_kernel(image, r, x0, x1, err, y, stencil, pad, reverse, colors, metric,
+        match_colors, resolution, lut_index, lut_offsets, lut_candidates, levels, level_counts,
+        level_index, out):
+    # quantize pixels x0 .. x1 - 1 of row r of image, which is scanline y,
+    # right to left when reverse is set
+    # err is a ring of scanlines indexed by y % len(err); column x + pad of a
+    # scanline holds the error accumulated so far for pixel x
+    # with per channel levels (level_counts[0] > 0) every channel is rounded
+    # to the nearest of its own levels and level_index gives the palette
+    # color of that combination of levels; the error is always taken against
+    # the palette color written out
+    kh, kw = stencil.shape
+    ring = err.shape[0]
+    slot = y % ring
+    per_channel = level_counts[0] > 0
+    for i in range(x0, x1):
+        x = x0 + x1 - 1 - i if reverse else i
+        v0 = image[r, x, 0] + err[slot, x + pad, 0]
+        v1 = image[r, x, 1] + err[slot, x + pad, 1]
+        v2 = image[r, x, 2] + err[slot, x + pad, 2]
+        if per_channel:
+            l0 = _nearest_level_jit(v0, levels[0], level_counts[0])
+            l1 = _nearest_level_jit(v1, levels[1], level_counts[1])
+            l2 = _nearest_level_jit(v2, levels[2], level_counts[2])
+            k = level_index[(l0 * level_counts[1] + l1) * level_counts[2] + l2]
+        else:
+            k = _match_jit(v0, v1, v2, metric, match_colors, resolution, lut_index, lut_offsets, lut_candidates)
+        e0 = v0 - colors[k, 0]
+        e1 = v1 - colors[k, 1]
+        e2 = v2 - colors[k, 2]
+        out[r, x] = k
+        for dy in range(kh):
+            target = (y + dy) % ring
+            for j in range(kw):
+                weight = stencil[dy, j]
+                if weight != 0.0:
+                    err[target, x + j, 0] += e0 * weight
+                    err[target, x + j, 1] += e1 * weight
+                    err[target, x + j, 2] += e2 * weight
+
+_diffuse_span_jit = accel.jit(_diffuse_span_kernel)
+
+
+def _diffuse_rows_kernel(image, err, y0, stencil, mirrored, serpentine, pad, colors, metric,
+        match_colors, resolution, lut_index, lut_offsets, lut_candidates, levels, level_counts,
+        level_index, out):
+    # quantize the rows of image, which start at scanline y0, in raster order
+    # or, with serpentine set, with odd scanlines right to left through the
+    # mirrored stencil
+    rows, cols = image.shape[0], image.shape[1]
+    ring = err.shape[0]
+    for r in range(rows):
+        reverse = serpentine and (y0 + r) % 2 == 1
+        _diffuse_span_jit(image, r, 0, cols, err, y0 + r, mirrored if reverse else stencil, pad,
+                reverse, colors, metric, match_colors, resolution, lut_index, lut_offsets,
+                lut_candidates, levels, level_counts, level_index, out)
+        # the finished scanline becomes scanline y + len(err)
+        err[(y0 + r) % ring, :, :] = 0.0
+
+_diffuse_rows_jit = accel.jit(_diffuse_rows_kernel)
+
+
+def _diffuse_rows_numpy(image, err, y0, stencil, mirrored, serpentine, pad, colors, metric,
+        match_colors, resolution, lut_index, lut_offsets, lut_candidates, levels, level_counts,
+        level_index, out):
+    # fallback for _diffuse_rows_kernel without numba, giving identical results
+    # the forward error of a scanline is carried serially in plain floats,
+    # then the downward error of the whole scanline is spread with a few
+    # vectorized adds; columns run against the scanline's direction in that
+    # step so every error cell sums its contributions in the same order as
+    # the compiled kernel
+    rows, cols = image.shape[0], image.shape[1]
+    kh, kw = stencil.shape
+    ring = err.shape[0]
+    color_list = colors.tolist()
+    match_list = match_colors.tolist()
+    if resolution > 0:
+        lut_index = lut_index.reshape(-1).tolist()
+        lut_offsets = lut_offsets.tolist()
+        lut_candidates = lut_candidates.tolist()
+    per_channel = level_counts[0] > 0
+    level_list = [levels[c, :level_counts[c]].tolist() for c in range(3)]
+    n1, n2 = int(level_counts[1]), int(level_counts[2])
+    level_index = level_index.tolist()
+    steps = {}
+    for reverse, s in ((False, stencil), (True, mirrored)):
+        order = range(kw) if reverse else range(kw - 1, -1, -1)
+        forward = [(j, w) for j, w in enumerate(s[0].tolist()) if w != 0.0]
+        downward = [(dy, j, s[dy, j]) for dy in range(1, kh) for j in order if s[dy, j] != 0.0]
+        xs = range(cols - 1, -1, -1) if reverse else range(cols)
+        steps[reverse] = (forward, downward, xs)
+    errors = numpy.empty((cols, 3), dtype=numpy.float64)
+
+    for r in range(rows):
+        y = y0 + r
+        slot = y % ring
+        forward, downward, xs = steps[serpentine and y % 2 == 1]
+        row = image[r].tolist()
+        carried = err[slot].tolist()
+        for x in xs:
+            p = row[x]
+            e = carried[x + pad]
+            v0 = p[0] + e[0]
+            v1 = p[1] + e[1]
+            v2 = p[2] + e[2]
+            if per_channel:
+                l0 = _nearest_level_python(v0, level_list[0])
+                l1 = _nearest_level_python(v1, level_list[1])
+                l2 = _nearest_level_python(v2, level_list[2])
+                k = level_index[(l0 * n1 + l1) * n2 + l2]
+            else:
+                k = _match_python(v0, v1, v2, metric, match_list, resolution,
+                        lut_index, lut_offsets, lut_candidates)
+            c = color_list[k]
+            e0 = v0 - c[0]
+            e1 = v1 - c[1]
+            e2 = v2 - c[2]
+            out[r, x] = k
+            errors[x] = (e0, e1, e2)
+            for j, w in forward:
+                target = carried[x + j]
+                target[0] += e0 * w
+                target[1] += e1 * w
+                target[2] += e2 * w
+        for dy, j, w in downward:
+            err[(y + dy) % ring, j:j + cols] += errors * w
+        err[slot] = 0.0
+
+
+def _diffuse_span_int_kernel(image, r, x0, x1, err, y, stencil, denominator, pad, reverse,
+        color_values, metric, match_colors, resolution, lut_index, lut_offsets, lut_candidates,
+        levels, level_counts, level_index, out):
+    # _diffuse_span_kernel for uint8 images: err holds int16 error scaled by
+    # the stencil denominator, so every contribution is an exact integer
+    # the error of one pixel is clamped so that a full set of contributions
+    # to one error cell still fits in int16
+    kh, kw = stencil.shape
+    ring = err.shape[0]
+    slot = y % ring
+    half = denominator // 2
+    limit = 32767 // denominator
+    per_channel = level_counts[0] > 0
+    for i in range(x0, x1):
+        x = x0 + x1 - 1 - i if reverse else i
+        v0 = image[r, x, 0] + (err[slot, x + pad, 0] + half) // denominator
+        v1 = image[r, x, 1] + (err[slot, x + pad, 1] + half) // denominator
+        v2 = image[r, x, 2] + (err[slot, x + pad, 2] + half) // denominator
+        if per_channel:
+            l0 = _nearest_level_jit(v0 / 255., levels[0], level_counts[0])
+            l1 = _nearest_level_jit(v1 / 255., levels[1], level_counts[1])
+            l2 = _nearest_level_jit(v2 / 255., levels[2], level_counts[2])
+            k = level_index[(l0 * level_counts[1] + l1) * level_counts[2] + l2]
+        else:
+            k = _match_jit(v0 / 255., v1 / 255., v2 / 255., metric, match_colors, resolution,
+                    lut_index, lut_offsets, lut_candidates)
+        e0 = min(max(v0 - color_values[k, 0], -limit), limit)
+        e1 = min(max(v1 - color_values[k, 1], -limit), limit)
+        e2 = min(max(v2 - color_values[k, 2], -limit), limit)
+        out[r, x] = k
+        for dy in range(kh):
+            target = (y + dy) % ring
+            for j in range(kw):
+                weight = stencil[dy, j]
+                if weight != 0:
+                    err[target, x + j, 0] += e0 * weight
+                    err[target, x + j, 1] += e1 * weight
+                    err[target, x + j, 2] += e2 * weight
+
+_diffuse_span_int_jit = accel.jit(_diffuse_span_int_kernel)
+
+
+def _diffuse_rows_int_kernel(image, err, y0, stencil, mirrored, serpentine, denominator, pad,
+        color_values, metric, match_colors, resolution, lut_index, lut_offsets, lut_candidates,
+        levels, level_counts, level_index, out):
+    rows, cols = image.shape[0], image.shape[1]
+    ring = err.shape[0]
+    for r in range(rows):
+        reverse = serpentine and (y0 + r) % 2 == 1
+        _diffuse_span_int_jit(image, r, 0, cols, err, y0 + r, mirrored if reverse else stencil,
+                denominator, pad, reverse, color_values, metric, match_colors, resolution,
+                lut_index, lut_offsets, lut_candidates, levels, level_counts, level_index, out)
+        err[(y0 + r) % ring, :, :] = 0
+
+_diffuse_rows_int_jit = accel.jit(_diffuse_rows_int_kernel)
+
+
+def _diffuse_rows_int_numpy(image, err, y0, stencil, mirrored, serpentine, denominator, pad,
+        color_values, metric, match_colors, resolution, lut_index, lut_offsets, lut_candidates,
+        levels, level_counts, level_index, out):
+    # fallback for _diffuse_rows_int_kernel; integer sums do not depend on
+    # their order, so the downward error is simply spread per scanline
+    rows, cols = image.shape[0], image.shape[1]
+    kh, kw = stencil.shape
+    ring = err.shape[0]
+    half = denominator // 2
+    limit = 32767 // denominator
+    match_list = match_colors.tolist()
+    value_list = color_values.astype(numpy.int64).tolist()
+    if resolution > 0:
+        lut_index = lut_index.reshape(-1).tolist()
+        lut_offsets = lut_offsets.tolist()
+        lut_candidates = lut_candidates.tolist()
+    per_channel = level_counts[0] > 0
+    level_list = [levels[c, :level_counts[c]].tolist() for c in range(3)]
+    n1, n2 = int(level_counts[1]), int(level_counts[2])
+    level_index = level_index.tolist()
+    steps = {}
+    for reverse, s in ((False, stencil), (True, mirrored)):
+        forward = [(j, w) for j, w in enumerate(s[0].tolist()) if w != 0]
+        downward = [(dy, j, int(s[dy, j])) for dy in range(1, kh) for j in range(kw) if s[dy, j] != 0]
+        xs = range(cols - 1, -1, -1) if reverse else range(cols)
+        steps[reverse] = (forward, downward, xs)
+    errors = numpy.empty((cols, 3), dtype=numpy.int64)
+
+    for r in range(rows):
+        y = y0 + r
+        slot = y % ring
+        forward, downward, xs = steps[serpentine and y % 2 == 1]
+        row = image[r].tolist()
+        carried = err[slot].tolist()
+        for x in xs:
+            p = row[x]
+            e = carried[x + pad]
+            v0 = p[0] + (e[0] + half) // denominator
+            v1 = p[1] + (e[1] + half) // denominator
+            v2 = p[2] + (e[2] + half) // denominator
+            if per_channel:
+                l0 = _nearest_level_python(v0 / 255., level_list[0])
+                l1 = _nearest_level_python(v1 / 255., level_list[1])
+                l2 = _nearest_level_python(v2 / 255., level_list[2])
+                k = level_index[(l0 * n1 + l1) * n2 + l2]
+            else:
+                k = _match_python(v0 / 255., v1 / 255., v2 / 255., metric, match_list, resolution,
+                        lut_index, lut_offsets, lut_candidates)
+            c = value_list[k]
+            e0 = min(max(v0 - c[0], -limit), limit)
+            e1 = min(max(v1 - c[1], -limit), limit)
+            e2 = min(max(v2 - c[2], -limit), limit)
+            out[r, x] = k
+            errors[x] = (e0, e1, e2)
+            for j, w in forward:
+                target = carried[x + j]
+                target[0] += e0 * w
+                target[1] += e1 * w
+                target[2] += e2 * w
+        for dy, j, w in downward:
+            err[(y + dy) % ring, j:j + cols] += errors * w
+        err[slot] = 0
+
+
+def _diffuse_band_kernel(band, levels, stencil, pad, out):
+    # error diffusion of a single (h, w) channel to the nearest of its sorted
+    # levels, writing the index of every pixel's level to out
+    rows, cols = band.shape
+    kh, kw = stencil.shape
+    n_levels = levels.shape[0]
+    err = numpy.zeros((kh, cols + kw - 1))
+    for y in range(rows):
+        slot = y % kh
+        for x in range(cols):
+            v = band[y, x] + err[slot, x + pad]
+            l = _nearest_sorted_jit(v, levels, n_levels)
+            out[y, x] = l
+            e = v - levels[l]
+            for dy in range(kh):
+                target = (y + dy) % kh
+                for j in range(kw):
+                    weight = stencil[dy, j]
+                    if weight != 0.0:
+                        err[target, x + j] += e * weight
+        err[slot, :] = 0.0
+
+_diffuse_band_jit = accel.jit(_diffuse_band_kernel)
+
+
+def _diffuse_band_numpy(band, levels, stencil, pad, out):
+    # fallback for _diffuse_band_kernel, giving identical results in the way
+    # _diffuse_rows_numpy does
+    rows, cols = band.shape
+    kh, kw = stencil.shape
+    level_list = levels.tolist()
+    n_levels = len(level_list)
+    forward = [(j, w) for j, w in enumerate(stencil[0].tolist()) if w != 0.0]
+    downward = [(dy, j, stencil[dy, j]) for dy in range(1, kh) for j in range(kw - 1, -1, -1) if stencil[dy, j] != 0.0]
+    err = numpy.zeros((kh, cols + kw - 1))
+    errors = numpy.empty(cols)
     for y in range(rows):
+        slot = y % kh
+        row = band[y].tolist()
+        carried = err[slot].tolist()
         for x in range(cols):
-            if DEBUGMODE:
-                print(f'<{x}, {y}>')
-                print(f'old = {new_matrix[{x}][{y}]}')
-
-            # calculate the new pixel value
-            old_pixel = numpy.array(new_matrix[x][y], dtype=numpy.float)
-            new_pixel = numpy.array(utils.closest_palette_color(old_pixel,
-                palette_name), dtype=numpy.float)
-            # replace the old pixel with the new value, and quantify the error
-            new_matrix[x][y] = new_pixel
-            quant_error = old_pixel - new_pixel
-
-            if DEBUGMODE:
-                print('new = {new_pixel}')
-                print('quant = {quant_error}')
-                print('-'*20)
-                if x > 5:
-                    sys.exit()
-
-            forward_diffusion = diffusion_matrix[0]
-            for ci, coeff in enumerate(forward_diffusion):
-                if x + ci + 1 < cols:
-                    new_matrix[x + (ci + 1)][y] += quant_error * coeff
-            for di, downward_diffusion in enumerate(diffusion_matrix[1:]):
-                if y + di + 1 < rows:
-                    offset = len(downward_diffusion) / 2
-                    for ci, coeff in enumerate(downward_diffusion):
-                        if 0 <= x + ci - offset < cols:
-                            new_matrix[x + ci - offset][y + di + 1] += quant_error * coeff
-    return new_matrix
-
-_method_names = [
+            v = row[x] + carried[x + pad]
+            l = _nearest_sorted_kernel(v, level_list, n_levels)
+            out[y, x] = l
+            e = v - level_list[l]
+            errors[x] = e
+            for j, w in forward:
+                carried[x + j] += e * w
+        for dy, j, w in downward:
+            err[(y + dy) % kh, j:j + cols] += errors * w
+        err[slot] = 0.0
+
+
+def diffuse_band(band, levels, kernel_name='floyd_steinberg'):
+    # the (h, w) indices into levels, a sorted 1d array, of a single channel
+    # band in [0, 1] diffused with one of the kernels
+    stencil, pad = _stencils[kernel_name]
+    levels = numpy.asarray(levels, dtype=numpy.float64)
+    out = numpy.empty(band.shape, dtype=utils.index_dtype(len(levels)))
+    diffuse = _diffuse_band_jit if _diffuse_band_jit is not None else _diffuse_band_numpy
+    with instrument.stage('diffuse', band.shape[0] * band.shape[1]):
+        diffuse(band, levels, stencil, pad, out)
+    return out
+
+
+def _nearest_level_python(v, levels):
+    best = 0
+    best_dist = abs(v - levels[0])
+    for i in range(1, len(levels)):
+        dist = abs(v - levels[i])
+        if dist < best_dist:
+            best = i
+            best_dist = dist
+    return best
+
+
+def _nearest_python(v0, v1, v2, colors, resolution, lut_index, lut_offsets, lut_candidates):
+    if resolution > 0 and 0.0 <= v0 <= 1.0 and 0.0 <= v1 <= 1.0 and 0.0 <= v2 <= 1.0:
+        cr = min(int(v0 * resolution), resolution - 1)
+        cg = min(int(v1 * resolution), resolution - 1)
+        cb = min(int(v2 * resolution), resolution - 1)
+        cell = (cr * resolution + cg) * resolution + cb
+        first = lut_offsets[cell]
+        last = lut_offsets[cell + 1]
+        if first == last:
+            return lut_index[cell]
+        candidates = lut_candidates[first:last]
+    else:
+        candidates = range(len(colors))
+    best = 0
+    best_dist = float('inf')
+    for ci in candidates:
+        c = colors[ci]
+        d0 = v0 - c[0]
+        d1 = v1 - c[1]
+        d2 = v2 - c[2]
+        dist = d0 * d0 + d1 * d1 + d2 * d2
+        if dist < best_dist:
+            best = ci
+            best_dist = dist
+    return best
+
+
+def _match_python(v0, v1, v2, metric, match_colors, resolution, lut_index, lut_offsets, lut_candidates):
+    if metric != 0:
+        v0, v1, v2 = color_metrics._to_space_kernel(min(max(v0, 0.0), 1.0), min(max(v1, 0.0), 1.0),
+                min(max(v2, 0.0), 1.0), metric)
+    return _nearest_python(v0, v1, v2, match_colors, resolution, lut_index, lut_offsets, lut_candidates)
+
+
+# width, in pixels, of the column blocks the wavefront scheduler hands out
+WAVEFRONT_BLOCK = 256
+
+
+def _wavefront(span, rows, cols, kw, workers, block_width):
+    # diffuse rows in parallel threads, each thread taking every workers-th
+    # row; a block of a row starts once the row above has finished the blocks
+    # that still feed error into it, and runs far enough ahead that no two
+    # running blocks touch the same error cells; every error cell therefore
+    # sums its contributions in serial order and the result is bit-identical
+    # to the serial kernel
+    # span(r, x0, x1) diffuses part of a row, clear(r) resets its scanline
+    span, clear = span
+    n_blocks = (cols + block_width - 1) // block_width
+    lead = 2 + (kw + block_width - 1) // block_width
+    progress = [0] * rows
+    failed = []
+    condition = threading.Condition()
+
+    def ready(r, needed):
+        return failed or progress[r] >= needed
+
+    def work(first):
+        try:
+            for r in range(first, rows, workers):
+                for c in range(n_blocks):
+                    if r > 0:
+                        needed = min(c + lead, n_blocks)
+                        with condition:
+                            condition.wait_for(lambda: ready(r - 1, needed))
+                        if failed:
+                            return
+                    span(r, c * block_width, min((c + 1) * block_width, cols))
+                    if c == n_blocks - 1:
+                        clear(r)
+                    with condition:
+                        progress[r] += 1
+                        condition.notify_all()
+        except BaseException as e:
+            with condition:
+                failed.append(e)
+                condition.notify_all()
+
+    threads = [threading.Thread(target=work, args=(w,)) for w in range(min(workers, rows))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if failed:
+        raise failed[0]
+
+
+def wavefront_ring(kernel_height, kernel_width, cols, block_width=WAVEFRONT_BLOCK):
+    # scanlines of error needed while the wavefront runs: a row's scanline can
+    # only be reused once the row has finished, and every row may start when
+    # the one above it is lead - 1 blocks along
+    n_blocks = (cols + block_width - 1) // block_width
+    lead = 2 + (kernel_width + block_width - 1) // block_width
+    return kernel_height + (n_blocks + lead - 2) // (lead - 1) + 1
+
+
+def channel_palette(palette_name):
+    # whether the palette holds every combination of its channel levels, as
+    # websafe does; only there is rounding every channel on its own the same
+    # as picking a palette color
+    colors = utils.palette_array(palette_name)
+    combinations = numpy.prod([len(numpy.unique(colors[:, c])) for c in range(3)])
+    return combinations == len(numpy.unique(colors, axis=0))
+
+
+class ErrorDiffuser(object):
+    # error diffusion over an image of a fixed width, fed one block of rows
+    # at a time; the error still owed to the next scanlines is kept in a ring
+    # of kernel height scanlines, so blocks can be as small as one row and the
+    # result is the same as diffusing the whole image at once
+    #
+    # float32 and float64 rows carry float64 error; uint8 rows (0-255) carry
+    # int16 error scaled by the kernel's common denominator
+    #
+    # under a color metric other than rgb every pixel is matched to the
+    # palette in the metric's space, while the error is still carried in sRGB
+    #
+    # serpentine scans odd scanlines right to left with the kernel mirrored;
+    # such rows depend on the whole row above, so they are never diffused by
+    # the wavefront. per_channel rounds every channel on its own to the
+    # palette's levels for that channel, which takes a palette holding every
+    # combination of its levels (see channel_palette)
+
+    def __init__(self, width, palette_name, kernel_name, metric=color_metrics.default_metric,
+            serpentine=False, per_channel=False):
+        self.width = width
+        self.kernel_name = kernel_name
+        self.serpentine = serpentine
+        self.per_channel = per_channel
+        stencil, pad = _stencils[kernel_name]
+        int_stencil, self.denominator = _integer_stencils[kernel_name]
+        if serpentine:
+            int_stencil, _ = _symmetric_stencil(int_stencil, pad)
+            stencil, pad = _symmetric_stencil(stencil, pad)
+        self.stencil, self.pad = stencil, pad
+        self.int_stencil = int_stencil
+        self.mirrored = numpy.ascontiguousarray(stencil[:, ::-1])
+        self.int_mirrored = numpy.ascontiguousarray(int_stencil[:, ::-1])
+        self.colors = utils.palette_array(palette_name)
+        self.color_values = utils.palette_array(palette_name, numpy.uint8)
+        self.err = None
+        self.y = 0
+
+        if self.colors.shape[0] > _LUT_COLORS and not per_channel:
+            table = lut.load_lut(palette_name, metric=metric)
+            self.lut = (table.resolution, numpy.asarray(table.index).reshape(-1),
+                    numpy.asarray(table.offsets), numpy.asarray(table.candidates))
+        else:
+            self.lut = (0, numpy.zeros(1, dtype=numpy.uint8),
+                    numpy.zeros(2, dtype=numpy.int64), numpy.zeros(1, dtype=numpy.uint8))
+
+        # what the kernels match pixels with: the metric, the palette in its
+        # space and the lookup table
+        if metric == color_metrics.default_metric:
+            match_colors = self.colors
+        else:
+            match_colors = numpy.ascontiguousarray(color_metrics.palette_in_space(palette_name, metric))
+        self.match = (color_metrics.metric_ids[metric], match_colors) + self.lut + self._channel_levels(palette_name)
+
+    def _channel_levels(self, palette_name):
+        # (levels, level_counts, level_index) for per channel diffusion:
+        # every channel's sorted levels, padded to the longest channel, and
+        # the palette index of every combination of levels; level_counts are
+        # zero when unused
+        if not self.per_channel:
+            return (numpy.zeros((3, 1)), numpy.zeros(3, dtype=numpy.int64), numpy.zeros(1, dtype=numpy.int64))
+        if not channel_palette(palette_name):
+            raise ValueError('per channel diffusion needs a palette holding every combination of its '
+                    'channel levels, {} does not'.format(palette_name))
+        channels = [numpy.unique(self.colors[:, c]) for c in range(3)]
+        level_counts = numpy.array([len(levels) for levels in channels], dtype=numpy.int64)
+        levels = numpy.zeros((3, level_counts.max()))
+        for c, channel in enumerate(channels):
+            levels[c, :len(channel)] = channel
+        grid = numpy.stack(numpy.meshgrid(*channels, indexing='ij'), axis=-1).reshape(-1, 3)
+        level_index = palette_index.get_index(palette_name).query(grid).astype(numpy.int64)
+        return levels, level_counts, level_index
+
+    def checkpoint(self):
+        # the carried error and position, to diffuse the following rows
+        # again later from the same state
+        return (self.y, None if self.err is None else self.err.copy())
+
+    def restore(self, checkpoint):
+        self.y, err = checkpoint
+        self.err = None if err is None else err.copy()
+
+    def _error_ring(self, integer):
+        kh, kw = self.stencil.shape
+        dtype = numpy.int16 if integer else numpy.float64
+        if self.err is None:
+            self.err = numpy.zeros((kh, self.width + kw - 1, 3), dtype=dtype)
+        elif self.err.dtype != dtype:
+            raise ValueError('cannot mix uint8 and float rows in one diffusion')
+        return self.err
+
+    def _process_wavefront(self, rows, integer, out, workers, block_width):
+        # the wavefront keeps more scanlines in flight than the serial ring
+        # holds, so the carried error moves to a larger ring and back
+        err = self.err
+        kh, kw = self.stencil.shape
+        n_rows, cols = rows.shape[0], rows.shape[1]
+        ring = wavefront_ring(kh, kw, cols, block_width)
+        wide = numpy.zeros((ring,) + err.shape[1:], dtype=err.dtype)
+        for dy in range(kh):
+            wide[(self.y + dy) % ring] = err[(self.y + dy) % kh]
+
+        y0 = self.y
+        if integer:
+            def span(r, x0, x1):
+                _diffuse_span_int_jit(rows, r, x0, x1, wide, y0 + r, self.int_stencil,
+                        self.denominator, self.pad, False, self.color_values, *self.match, out)
+        else:
+            def span(r, x0, x1):
+                _diffuse_span_jit(rows, r, x0, x1, wide, y0 + r, self.stencil, self.pad, False,
+                        self.colors, *self.match, out)
+        def clear(r):
+            wide[(y0 + r) % ring] = 0
+        _wavefront((span, clear), n_rows, cols, kw, workers, block_width)
+
+        for dy in range(kh):
+            err[(y0 + n_rows + dy) % kh] = wide[(y0 + n_rows + dy) % ring]
+
+    def process(self, rows, workers=1, block_width=WAVEFRONT_BLOCK):
+        # quantize the next block of (h, width, 3) rows, returning their
+        # (h, width) palette indices
+        # with workers > 1 and numba available the rows are diffused by a
+        # wavefront of threads, unless serpentine; the output is identical to
+        # the serial run
+        rows = numpy.asarray(rows)
+        integer = rows.dtype == numpy.uint8
+        if not integer and rows.dtype != numpy.float32:
+            rows = rows.astype(numpy.float64, copy=False)
+        rows = numpy.ascontiguousarray(rows)
+        err = self._error_ring(integer)
+        out = numpy.empty(rows.shape[:2], dtype=utils.index_dtype(self.colors.shape[0]))
+        n_pixels = rows.shape[0] * rows.shape[1]
+
+        # every pixel is matched to the palette inside the diffusion kernel
+        instrument.count('palette_lookups', n_pixels)
+        with instrument.stage('diffuse', n_pixels):
+            if workers > 1 and accel.available and rows.shape[0] > 1 and not self.serpentine:
+                self._process_wavefront(rows, integer, out, workers, block_width)
+            elif integer:
+                diffuse = _diffuse_rows_int_jit if _diffuse_rows_int_jit is not None else _diffuse_rows_int_numpy
+                diffuse(rows, err, self.y, self.int_stencil, self.int_mirrored, self.serpentine,
+                        self.denominator, self.pad, self.color_values, *self.match, out)
+            else:
+                diffuse = _diffuse_rows_jit if _diffuse_rows_jit is not None else _diffuse_rows_numpy
+                diffuse(rows, err, self.y, self.stencil, self.mirrored, self.serpentine, self.pad,
+                        self.colors, *self.match, out)
+        self.y += rows.shape[0]
+        return out
+
+
+_kernel_names = [
         'floyd_steinberg', 'jajuni', 'fan', 'stucki', 'burkes',
         'sierra', 'two_row_sierra', 'sierra_lite', 'atkinson'
 ]
+
+# every kernel as a method on its own and in each traversal variant
+_variants = OrderedDict([
+        ('', {}),
+        ('_serpentine', {'serpentine': True}),
+        ('_per_channel', {'per_channel': True}),
+])
+_method_kernels = OrderedDict(
+        [(kn + suffix, (kn, options)) for suffix, options in _variants.items() for kn in _kernel_names]
+)
+_method_names = list(_method_kernels)
+
+
+def make_diffuser(width, palette_name, method, **kwargs):
+    # an ErrorDiffuser for one of the method names, variants included
+    kernel_name, options = _method_kernels[method]
+    return ErrorDiffuser(width, palette_name, kernel_name, **dict(options, **kwargs))
+
+
+def _error_diffusion(image_matrix, palette_name, method, return_indices=False, workers=1,
+        metric=color_metrics.default_metric):
+    rows, cols, depth = image_matrix.shape
+    diffuser = make_diffuser(cols, palette_name, method, metric=metric)
+    indices = diffuser.process(image_matrix, workers)
+    return utils.dither_result(indices, palette_name, image_matrix, return_indices)
+
 _available_methods = OrderedDict(
-        [(mn, (lambda name: (lambda im, pal: _error_diffusion(im, pal, _diffusion_matrices[name])))(mn)) for mn in _method_names]
+        [(mn, (lambda name: (lambda im, pal, **kwargs: _error_diffusion(im, pal, name, **kwargs)))(mn)) for mn in _method_names]
+)
+_strip_methods = OrderedDict(
+        [(mn, (lambda name: (lambda width, pal, **kwargs: make_diffuser(width, pal, name, **kwargs).process))(mn)) for mn in _method_names]
 )
 
 if __name__ == '__main__':
@@ -109,7 +805,7 @@ if __name__ == '__main__':
     image = utils.open_image(args.image_filename)
     image_matrix = utils.pil2numpy(image)
 
-    dither_matrix = floyd_steinberg(image_matrix, args.palette)
+    dither_matrix = _available_methods['floyd_steinberg'](image_matrix, args.palette)
     dither_image = utils.numpy2pil(dither_matrix)
 
     dither_image.show()
@@ -0,0 +1,107 @@
+from collections import OrderedDict
+import contextlib
+import threading
+import time
+
+DEBUGMODE = False
+
+# the profile being recorded, if any; every hook checks this first so that
+# instrumentation costs one global lookup per stage when it is off
+_active = None
+
+_null_stage = contextlib.nullcontext()
+
+
+class Profile(object):
+    # wall time, calls and pixels per stage, plus named counters (palette
+    # lookups, cache hits, ...); callbacks get (stage, seconds, pixels) as
+    # every stage ends
+
+    def __init__(self, callback=None):
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        self.callbacks = [callback] if callback is not None else []
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds, pixels=0):
+        with self.lock:
+            entry = self.stages.setdefault(name, [0, 0.0, 0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] += pixels
+        for callback in self.callbacks:
+            callback(name, seconds, pixels)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def as_dict(self):
+        return {
+            'stages': OrderedDict((name, {'calls': calls, 'seconds': seconds, 'pixels': pixels})
+                for name, (calls, seconds, pixels) in self.stages.items()),
+            'counters': OrderedDict(self.counters),
+        }
+
+    def summary(self):
+        # stages nest (quantize runs inside dither), so their times overlap
+        lines = ['{:<12} {:>7} {:>10} {:>12} {:>10}'.format('stage', 'calls', 'seconds', 'pixels', 'Mpx/s')]
+        for name, (calls, seconds, pixels) in self.stages.items():
+            rate = '{:>10.2f}'.format(pixels / seconds / 1e6) if pixels and seconds > 0 else '{:>10}'.format('-')
+            lines.append('{:<12} {:>7} {:>10.4f} {:>12} {}'.format(name, calls, seconds, pixels, rate))
+        if self.counters:
+            lines.append('')
+            lines.append('{:<24} {:>12}'.format('counter', 'value'))
+            for name, value in self.counters.items():
+                lines.append('{:<24} {:>12}'.format(name, value))
+        return '\n'.join(lines)
+
+
+class _Stage(object):
+
+    def __init__(self, profile, name, pixels):
+        self.profile = profile
+        self.name = name
+        self.pixels = pixels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profile.record(self.name, time.perf_counter() - self.start, self.pixels)
+        return False
+
+
+def stage(name, pixels=0):
+    # context manager timing one stage of the work:
+    #     with instrument.stage('quantize', n_pixels):
+    #         ...
+    if _active is None:
+        return _null_stage
+    return _Stage(_active, name, pixels)
+
+
+def count(name, n=1):
+    if _active is not None:
+        _active.count(name, n)
+
+
+def enabled():
+    return _active is not None
+
+
+@contextlib.contextmanager
+def profile(callback=None):
+    # record every stage and counter hit inside the block:
+    #     with instrument.profile() as p:
+    #         dither.dither_image(...)
+    #     print(p.summary())
+    # profiles nest; the inner one records only its own block
+    global _active
+    previous = _active
+    _active = Profile(callback)
+    try:
+        yield _active
+    finally:
+        _active = previous
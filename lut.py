@@ -0,0 +1,241 @@
+from collections import namedtuple
+import hashlib, os
+import numpy
+
+import color_metrics
+import instrument
+import palette
+import utils
+
+DEBUGMODE = False
+
+# bump this whenever the on-disk layout or the compile step changes so that
+# stale tables are rebuilt instead of loaded
+LUT_VERSION = 3
+default_resolution = 64
+
+# palettes registered at run time, such as adaptive ones, are often used for
+# a single image: their tables are compiled at this resolution, which takes
+# milliseconds rather than seconds, and kept in memory only
+registered_resolution = 16
+
+# upper bound, in bytes, for the cells x colors blocks built while compiling
+COMPILE_MEMORY_BUDGET = 64 * 1024 * 1024
+
+# a compiled table: index holds the nearest palette index of every cell
+# center; cells where more than one palette color can be the nearest one for
+# some point inside the cell are ambiguous and list those colors, in palette
+# order, in candidates[offsets[cell]:offsets[cell+1]]
+PaletteLUT = namedtuple('PaletteLUT', ['resolution', 'index', 'offsets', 'candidates'])
+
+_table_parts = ('index', 'offsets', 'candidates')
+
+_luts = {}
+
+
+def lut_directory():
+    # the tables live in the palette cache directory
+    return os.path.join(palette.cache_directory(), 'palettes.lut')
+
+
+def palette_hash(colors, resolution):
+    digest = hashlib.sha1()
+    digest.update('{}:{}:'.format(LUT_VERSION, resolution).encode('ascii'))
+    digest.update(numpy.ascontiguousarray(colors, dtype=numpy.float64).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def _cell_bounds(resolution):
+    edges = numpy.arange(resolution + 1, dtype=numpy.float64) / resolution
+    r, g, b = numpy.meshgrid(numpy.arange(resolution), numpy.arange(resolution),
+            numpy.arange(resolution), indexing='ij')
+    cells = numpy.stack([r.ravel(), g.ravel(), b.ravel()], axis=1)
+    return edges[cells], edges[cells + 1]
+
+
+def ambiguous_cells(table):
+    return numpy.diff(table.offsets).reshape(table.index.shape) > 0
+
+
+def compile_lut(colors, resolution=default_resolution):
+    colors = numpy.asarray(colors, dtype=numpy.float64)
+    n_colors = colors.shape[0]
+    lo, hi = _cell_bounds(resolution)
+    centers = (lo + hi) / 2.
+    n_cells = centers.shape[0]
+
+    index = utils.nearest_indices(centers, colors)
+    counts = numpy.zeros(n_cells, dtype=numpy.int64)
+    candidates = []
+
+    # a color can only be the nearest one somewhere in a cell if its minimum
+    # distance to the cell is no larger than the smallest maximum distance of
+    # any color to that cell; cells with more than one such color need an
+    # exact search among them at lookup time
+    chunk = max(1, COMPILE_MEMORY_BUDGET // (n_colors * 3 * 8 * 4))
+    for start in range(0, n_cells, chunk):
+        block_lo = lo[start:start+chunk, numpy.newaxis, :]
+        block_hi = hi[start:start+chunk, numpy.newaxis, :]
+        below = block_lo - colors
+        above = colors - block_hi
+        d_min = numpy.maximum(numpy.maximum(below, above), 0.0)
+        d_min = numpy.sum(d_min * d_min, axis=2)
+        d_max = numpy.maximum(numpy.abs(below), numpy.abs(above))
+        d_max = numpy.sum(d_max * d_max, axis=2)
+        bound = numpy.min(d_max, axis=1)[:, numpy.newaxis]
+        # the slack keeps colors that only win through float32 rounding
+        mask = d_min <= bound + 1e-6
+        block_counts = numpy.count_nonzero(mask, axis=1)
+        mask[block_counts == 1] = False
+        block_counts[block_counts == 1] = 0
+        counts[start:start+chunk] = block_counts
+        # nonzero walks the mask row by row, so every cell's candidates come
+        # out contiguous and in palette order
+        candidates.append(numpy.nonzero(mask)[1])
+
+    offsets = numpy.zeros(n_cells + 1, dtype=numpy.int64)
+    numpy.cumsum(counts, out=offsets[1:])
+    candidates = numpy.concatenate(candidates).astype(utils.index_dtype(n_colors))
+
+    shape = (resolution, resolution, resolution)
+    return PaletteLUT(resolution, index.reshape(shape), offsets, candidates)
+
+
+def nearest_among(pixels, colors, candidates, memory_budget=None):
+    # nearest palette index for an (N, 3) array of pixels where row i may only
+    # pick from the palette indices in candidates[i]; the distance is summed in
+    # the same order as utils.nearest_indices so both agree on ties
+    if memory_budget is None:
+        memory_budget = utils.QUANTIZE_MEMORY_BUDGET
+    n_pixels, width = candidates.shape
+    indices = numpy.empty(n_pixels, dtype=candidates.dtype)
+
+    chunk = max(1, memory_budget // (width * 8 * 3))
+    for start in range(0, n_pixels, chunk):
+        block = pixels[start:start+chunk, numpy.newaxis, :]
+        block_candidates = candidates[start:start+chunk]
+        cand_colors = colors[block_candidates]
+        dist = block[:, :, 0] - cand_colors[:, :, 0]
+        dist *= dist
+        for c in (1, 2):
+            diff = block[:, :, c] - cand_colors[:, :, c]
+            diff *= diff
+            dist += diff
+        best = numpy.argmin(dist, axis=1)
+        indices[start:start+chunk] = numpy.take_along_axis(block_candidates,
+                best[:, numpy.newaxis], axis=1)[:, 0]
+    return indices
+
+
+def _refine(table, pixels, flat, colors, memory_budget=None):
+    starts = table.offsets[flat]
+    counts = table.offsets[flat + 1] - starts
+    # pad every candidate list to the longest one by repeating its last
+    # entry; argmin keeps the first of equal distances so padding never wins
+    width = int(counts.max())
+    steps = numpy.minimum(numpy.arange(width), (counts - 1)[:, numpy.newaxis])
+    candidates = table.candidates[starts[:, numpy.newaxis] + steps]
+    return nearest_among(pixels, colors, candidates, memory_budget)
+
+
+def _lut_paths(palette_name, colors, resolution):
+    stem = '{}.{}.{}'.format(palette_name, resolution, palette_hash(colors, resolution))
+    directory = lut_directory()
+    return [os.path.join(directory, '{}.{}.npy'.format(stem, part)) for part in _table_parts]
+
+
+def _remove_stale(palette_name, resolution, keep):
+    prefix = '{}.{}.'.format(palette_name, resolution)
+    directory = lut_directory()
+    for filename in os.listdir(directory):
+        path = os.path.join(directory, filename)
+        if filename.startswith(prefix) and path not in keep:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+def load_lut(palette_name, resolution=default_resolution, metric=color_metrics.default_metric):
+    # tables for a color metric other than rgb cover the palette's colors in
+    # that metric's space and are cached under '<palette>.<metric>'; tables
+    # of palettes that are not built in are never written to disk
+    builtin = palette.palettes.builtin(palette_name)
+    if not builtin and resolution == default_resolution:
+        resolution = registered_resolution
+    key = (palette_name, resolution, metric)
+    if key in _luts:
+        instrument.count('lut_hits')
+        return _luts[key]
+
+    if metric == color_metrics.default_metric:
+        table_name = palette_name
+        colors = utils.palette_array(palette_name)
+    else:
+        table_name = '{}.{}'.format(palette_name, metric)
+        colors = color_metrics.palette_in_space(palette_name, metric)
+    paths = _lut_paths(table_name, colors, resolution)
+
+    if builtin and all(os.access(path, os.R_OK) for path in paths):
+        # memory map the cached table so that every process shares its pages
+        instrument.count('lut_disk_loads')
+        table = PaletteLUT(resolution, *[numpy.load(path, mmap_mode='r') for path in paths])
+    else:
+        if DEBUGMODE:
+            print(f'compiling {resolution}^3 lut for {table_name}')
+        instrument.count('lut_compiles')
+        with instrument.stage('lut_compile', resolution**3):
+            table = compile_lut(colors, resolution)
+        if not builtin:
+            _luts[key] = table
+            return table
+        try:
+            os.makedirs(lut_directory(), exist_ok=True)
+            for path, part in zip(paths, _table_parts):
+                utils.save_array(path, getattr(table, part))
+            _remove_stale(table_name, resolution, paths)
+        except OSError:
+            # read-only cache location, keep the table in memory only
+            pass
+
+    _luts[key] = table
+    return table
+
+
+def lookup_table(table, pixels, colors, exact=True, memory_budget=None):
+    # nearest palette index for an (N, 3) array of pixels
+    # with exact=False every pixel gets the index of its cell center; with
+    # exact=True pixels in ambiguous cells are refined among the cell's
+    # candidates and pixels outside [0, 1] with a full search, so the result
+    # matches utils.nearest_indices
+    resolution = table.resolution
+    cells = numpy.clip((pixels * resolution).astype(numpy.intp), 0, resolution - 1)
+    flat = (cells[:, 0] * resolution + cells[:, 1]) * resolution + cells[:, 2]
+    indices = table.index.reshape(-1)[flat]
+
+    if exact:
+        outside = numpy.any((pixels < 0.0) | (pixels > 1.0), axis=1)
+        ambiguous = (table.offsets[flat + 1] > table.offsets[flat]) & ~outside
+        if numpy.any(ambiguous):
+            indices[ambiguous] = _refine(table, pixels[ambiguous], flat[ambiguous],
+                    colors, memory_budget)
+        if numpy.any(outside):
+            indices[outside] = utils.nearest_indices(pixels[outside], colors, memory_budget)
+    return indices
+
+
+def lookup(pixels, palette_name, exact=True, resolution=default_resolution):
+    table = load_lut(palette_name, resolution)
+    return lookup_table(table, pixels, utils.palette_array(palette_name), exact)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--resolution', type=int, default=default_resolution, help='Number of cells along each color axis')
+    args = parser.parse_args()
+
+    for pname in palette.available_palettes:
+        table = load_lut(pname, args.resolution)
+        print('{}: {:.1%} ambiguous cells'.format(pname, ambiguous_cells(table).mean()))
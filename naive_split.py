@@ -10,6 +10,28 @@ import utils
 DEBUGMODE = False
 default_palette = 'cga_mode4_2_high'
 
+def split_levels(palette_name):
+    # the gray levels every band is dithered to: the luminances of the
+    # palette colors, as PIL's 'L' mode gives them, so at most 256 of them
+    luminance = utils.palette_array(palette_name) @ numpy.array([0.299, 0.587, 0.114])
+    return numpy.unique(numpy.round(luminance * 255)) / 255.
+
+def naive_split(image_matrix, palette_name, kernel_name='floyd_steinberg', return_indices=False):
+    # dither every band of the image on its own to the gray levels of
+    # palette_name, one single channel pass per band. the result is the
+    # (H, W, 3) image of levels, or with return_indices the (H, W, 3) indices
+    # into split_levels(palette_name) of every band
+    levels = split_levels(palette_name)
+    indices = numpy.empty(image_matrix.shape[:2] + (3,), dtype=utils.index_dtype(len(levels)))
+    for b in range(3):
+        indices[:, :, b] = error_diffusion.diffuse_band(utils.unit_float(image_matrix[:, :, b]), levels, kernel_name)
+    if return_indices:
+        return indices
+    dtype = utils.output_dtype(image_matrix)
+    if dtype == numpy.uint8:
+        levels = numpy.round(levels * 255)
+    return levels.astype(dtype)[indices]
+
 if __name__ == '__main__':
     import argparse
 
@@ -18,17 +40,13 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('image_filename', help='Path to an image file to dither')
     parser.add_argument('-p', '--palette', type=str, default=default_palette, help=palette_help_str)
+    parser.add_argument('-k', '--kernel', type=str, default='floyd_steinberg', help='Diffusion kernel. Can be one of: ' + ', '.join(error_diffusion._kernel_names))
     args = parser.parse_args()
 
     image = utils.open_image(args.image_filename)
-    image_bands = list(image.split())
+    image_matrix = utils.pil2numpy(image)
 
-    for b in range(3):
-        image_bands[b] = image_bands[b].convert('RGB')
-        image_matrix = utils.pil2numpy(image_bands[b])
-        dither_matrix = error_diffusion._available_methods['floyd_steinberg'](image_matrix, args.palette)
-        image_bands[b] = utils.numpy2pil(dither_matrix)
-        image_bands[b] = image_bands[b].convert('L')
+    dither_matrix = naive_split(image_matrix, args.palette, args.kernel)
+    dither_image = utils.numpy2pil(dither_matrix)
 
-    dither_image = Image.merge('RGB', image_bands)
     dither_image.show()
@@ -1,9 +1,11 @@
 from PIL import Image
 from collections import OrderedDict
+import functools
 import numpy
-import random
+import os
 import sys
 
+import color_metrics
 import palette
 import utils
 
@@ -45,29 +47,162 @@ _diffusion_matrices = {
         ]),
 }
 
-def _ordered_dither(image_matrix, palette_name, map_to_use):
+# bump this whenever the generated maps change so that stale ones on disk are
+# rebuilt instead of loaded
+THRESHOLD_MAP_VERSION = 1
+
+def _normalize_ranks(ranks):
+    # ranks 0 .. n*n-1 to thresholds in (0, 1), like the 4x4 bayer map
+    return (ranks + 1.) / (ranks.size + 1.)
+
+@functools.lru_cache(maxsize=None)
+def bayer_map(size):
+    # bayer threshold map of any power of two size, built recursively from
+    # the 2x2 one: every quadrant is 4 * M(size/2) plus the 2x2 rank
+    if size < 1 or size & (size - 1):
+        raise ValueError('bayer maps need a power of two size, not {}'.format(size))
+    ranks = numpy.zeros((1, 1), dtype=numpy.int64)
+    while ranks.shape[0] < size:
+        ranks = numpy.block([[4 * ranks + 0, 4 * ranks + 2],
+                             [4 * ranks + 3, 4 * ranks + 1]])
+    thresholds = _normalize_ranks(ranks)
+    thresholds.flags.writeable = False
+    return thresholds
+
+def _void_and_cluster_ranks(size, sigma=1.5, seed=0):
+    # Ulichney's void-and-cluster method on a torus: the rank of every cell
+    # in the order it is switched on, each time in the largest void
+    n = size * size
+    offsets = numpy.minimum(numpy.arange(size), size - numpy.arange(size))
+    kernel = numpy.exp(-(offsets[:, numpy.newaxis]**2 + offsets[numpy.newaxis, :]**2) / (2 * sigma**2))
+
+    def toggle(energy, pattern, y, x, on):
+        pattern[y, x] = on
+        energy += (1 if on else -1) * numpy.roll(kernel, (y, x), axis=(0, 1))
+
+    def tightest_cluster(energy, pattern):
+        return numpy.unravel_index(numpy.argmax(numpy.where(pattern, energy, -numpy.inf)), pattern.shape)
+
+    def largest_void(energy, pattern):
+        return numpy.unravel_index(numpy.argmin(numpy.where(pattern, numpy.inf, energy)), pattern.shape)
+
+    # initial binary pattern: a tenth of the cells, then swap the tightest
+    # cluster into the largest void until that changes nothing
+    pattern = numpy.zeros((size, size), dtype=bool)
+    energy = numpy.zeros((size, size))
+    rng = numpy.random.default_rng(seed)
+    for cell in rng.choice(n, max(1, n // 10), replace=False):
+        toggle(energy, pattern, cell // size, cell % size, True)
+    while True:
+        cluster = tightest_cluster(energy, pattern)
+        toggle(energy, pattern, *cluster, False)
+        void = largest_void(energy, pattern)
+        if void == cluster:
+            toggle(energy, pattern, *cluster, True)
+            break
+        toggle(energy, pattern, *void, True)
+
+    ranks = numpy.zeros((size, size), dtype=numpy.int64)
+    ones = int(pattern.sum())
+
+    # ranks below the initial pattern: remove the tightest clusters
+    phase_pattern, phase_energy = pattern.copy(), energy.copy()
+    for rank in range(ones - 1, -1, -1):
+        cluster = tightest_cluster(phase_energy, phase_pattern)
+        toggle(phase_energy, phase_pattern, *cluster, False)
+        ranks[cluster] = rank
+
+    # ranks above it: fill the largest voids; past half full the tightest
+    # cluster of zeros is the same cell, as the two energies add up to a
+    # constant
+    for rank in range(ones, n):
+        void = largest_void(energy, pattern)
+        toggle(energy, pattern, *void, True)
+        ranks[void] = rank
+    return ranks
+
+def _threshold_map_directory():
+    return os.path.join(palette.cache_directory(), 'threshold_maps.v{}'.format(THRESHOLD_MAP_VERSION))
+
+@functools.lru_cache(maxsize=None)
+def blue_noise_map(size):
+    # void-and-cluster blue noise map; generating one takes a while, so it is
+    # built once and kept in the cache directory next to the palettes
+    path = os.path.join(_threshold_map_directory(), 'void_and_cluster{}.npy'.format(size))
+    try:
+        ranks = numpy.load(path)
+    except (OSError, ValueError):
+        if DEBUGMODE:
+            print(f'building {size}x{size} void-and-cluster map')
+        ranks = _void_and_cluster_ranks(size)
+        try:
+            os.makedirs(_threshold_map_directory(), exist_ok=True)
+            utils.save_array(path, ranks)
+        except OSError:
+            # read-only cache location, keep the map in memory only
+            pass
+    thresholds = _normalize_ranks(ranks)
+    thresholds.flags.writeable = False
+    return thresholds
+
+# maps that are generated on first use rather than written out above
+_generated_maps = OrderedDict([
+        ('bayer16x16', lambda: bayer_map(16)),
+        ('bayer32x32', lambda: bayer_map(32)),
+        ('bayer64x64', lambda: bayer_map(64)),
+        ('blue_noise64x64', lambda: blue_noise_map(64)),
+])
+
+def threshold_map(name):
+    if name in _diffusion_matrices:
+        return _diffusion_matrices[name]
+    return _generated_maps[name]()
+
+def _tiled_map(map_to_use, rows, cols, y_offset=0, dtype=numpy.float64):
+    # tile the threshold map over the whole image so that pixel (y, x) sees
+    # map_to_use[y % map_size][x % map_size]; y_offset is the scanline the
+    # matrix starts at, which keeps the map phase when dithering in strips.
+    # the map is rolled to that phase and repeated, so the cost does not
+    # depend on the map size
     map_size = map_to_use.shape[0]
-    new_matrix = numpy.copy(image_matrix)
-    cols, rows, depth = image_matrix.shape
-    for y in range(rows):
-        for x in range(cols):
-            if DEBUGMODE:
-                print(f'<{x}, {y}>')
-                print(f'old = {new_matrix[{x}][{y}]}')
-
-            old_pixel = numpy.array(new_matrix[x][y], dtype=numpy.float)
-            old_pixel += old_pixel * map_to_use[x % map_size][y % map_size]
-            new_pixel = numpy.array(utils.closest_palette_color(old_pixel,
-                palette_name), dtype=numpy.float)
-            new_matrix[x][y] = new_pixel
-    return new_matrix
+    phased = numpy.roll(map_to_use.astype(dtype), -(y_offset % map_size), axis=0)
+    reps = (-(-rows // map_size), -(-cols // map_size))
+    return numpy.tile(phased, reps)[:rows, :cols]
+
+def _ordered_quantize(image_matrix, palette_name, map_to_use, y_offset=0, metric=color_metrics.default_metric):
+    rows, cols, depth = image_matrix.shape
+    pixels = utils.unit_float(image_matrix)
+    tiled_map = _tiled_map(map_to_use, rows, cols, y_offset, pixels.dtype)
+
+    old_matrix = pixels + pixels * tiled_map[:, :, numpy.newaxis]
+    indices, new_matrix = utils.quantize(old_matrix, palette_name, metric=metric)
+    return indices
+
+def _ordered_dither(image_matrix, palette_name, map_to_use, return_indices=False, metric=color_metrics.default_metric):
+    indices = _ordered_quantize(image_matrix, palette_name, map_to_use, metric=metric)
+    return utils.dither_result(indices, palette_name, image_matrix, return_indices)
+
+def _ordered_strips(width, palette_name, map_to_use, metric=color_metrics.default_metric):
+    y_offset = 0
+    def process(rows):
+        nonlocal y_offset
+        indices = _ordered_quantize(rows, palette_name, map_to_use, y_offset, metric)
+        y_offset += rows.shape[0]
+        return indices
+    return process
 
 _method_names = [
         'bayer4x4', 'bayer8x8',
         'cluster4x4', 'cluster8x8',
-]
+] + list(_generated_maps)
 _available_methods = OrderedDict(
-        [(mn, (lambda name: (lambda im, pal: _ordered_dither(im, pal, _diffusion_matrices[name])))(mn)) for mn in _method_names]
+        [(mn, (lambda name: (lambda im, pal, **kwargs: _ordered_dither(im, pal, threshold_map(name), **kwargs)))(mn)) for mn in _method_names]
+)
+_strip_methods = OrderedDict(
+        [(mn, (lambda name: (lambda width, pal, **kwargs: _ordered_strips(width, pal, threshold_map(name), **kwargs)))(mn)) for mn in _method_names]
+)
+_tile_methods = OrderedDict(
+        [(mn, (lambda name: (lambda im, pal, y_offset=0, **kwargs: _ordered_quantize(im, pal, threshold_map(name), y_offset, **kwargs)))(mn)) for mn in _method_names]
 )
 
 if __name__ == '__main__':
@@ -78,12 +213,13 @@ if __name__ == '__main__':
     parser.add_argument('-b', '--bit-depth', type=int, default=1, help='Number of bits in dithered image')
     palette_help_str = 'Name of palette to use. Can be one of: ' + ', '.join(palette.available_palettes)
     parser.add_argument('-p', '--palette', type=str, default=default_palette, help=palette_help_str)
+    parser.add_argument('-m', '--map', type=str, default='bayer8x8', help='Threshold map to use. Can be one of: ' + ', '.join(_method_names))
     args = parser.parse_args()
 
     image = utils.open_image(args.image_filename)
     image_matrix = utils.pil2numpy(image)
 
-    dither_matrix = bayer8x8(image_matrix, args.palette)
+    dither_matrix = _available_methods[args.map](image_matrix, args.palette)
     dither_image = utils.numpy2pil(dither_matrix)
 
     dither_image.show()
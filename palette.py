@@ -1,13 +1,34 @@
 from collections import OrderedDict
-import json,os
+from collections.abc import Mapping
+import os, tempfile
+import numpy
 
-palettes = OrderedDict()
-available_palettes = []
+DEBUGMODE = False
 
-def _build_c64_palettes():
-    global palettes
+# bump this whenever a palette definition or the cache layout changes; every
+# version gets its own directory so that old caches are simply ignored
+PALETTE_CACHE_VERSION = 1
+
+_cache_directory = None
+
+def cache_directory():
+    # where the palette arrays and lookup tables are cached: set_cache_directory,
+    # else $DITHER_CACHE_DIR, else $XDG_CACHE_HOME/dither (~/.cache/dither)
+    if _cache_directory is not None:
+        return _cache_directory
+    directory = os.environ.get('DITHER_CACHE_DIR')
+    if directory:
+        return directory
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'dither')
 
-    print('building C64 palette')
+def set_cache_directory(directory):
+    global _cache_directory
+    _cache_directory = directory
+
+def _build_c64_palettes():
+    if DEBUGMODE:
+        print('building C64 palette')
 
     # gamma corrected colors from
     # http://unusedino.de/ec64/technical/misc/vic656x/colors/
@@ -29,29 +50,28 @@ def _build_c64_palettes():
             [107.797780127,  94.106015515, 180.927622164],
             [149.480882981, 149.480882981, 149.480882981],
     ]
-    palettes['c64'] = [[c/255. for c in color] for color in palette]
+    return {'c64': [[c/255. for c in color] for color in palette]}
 
 def _build_websafe_palettes():
     # note that there is only an _accepted_ set of 216 "websafe" colors, but
     # there is no fully standardized set
     # this is using the common set of 216 6-bit colors
 
-    global palettes
-
-    print('building websafe palette')
+    if DEBUGMODE:
+        print('building websafe palette')
 
     palette = []
     for r in range(6):
         for g in range(6):
             for b in range(6):
                 palette.append([r/5.0, g/5.0, b/5.0])
-    palettes['websafe'] = palette
+    return {'websafe': palette}
 
 def _build_grayscale_palettes():
-    global palettes
-
-    print('building grayscale palettes')
+    if DEBUGMODE:
+        print('building grayscale palettes')
 
+    palettes = {}
     for bit_depth in range(1, 8):
         levels = 2**bit_depth - 1
         pname = '{}bit_gray'.format(bit_depth)
@@ -60,14 +80,14 @@ def _build_grayscale_palettes():
             val = float(l+1)/(levels)
             palette.append([val, val, val])
         palettes[pname] = palette
+    return palettes
 
 def _build_cga_palettes():
     # this actually builds all possible colors based on rgb combinations of
     # on/off, though some of the colors were not available on CGA
 
-    global palettes
-
-    print('building cga palettes')
+    if DEBUGMODE:
+        print('building cga palettes')
 
     # generate all the low/dark colors
     low = []
@@ -89,6 +109,7 @@ def _build_cga_palettes():
 
     # add the colors to their respective palettes
 
+    palettes = {}
     palettes['cga_mode4_1'] = [ low[0],  # black
                                 low[3],  # low cyan
                                 low[5],  # low magenta
@@ -113,11 +134,11 @@ def _build_cga_palettes():
                                    high[3],  # high cyan
                                    high[4],  # high red
                                    high[7] ] # high white
+    return palettes
 
 def _build_ega_palettes():
-    global palettes
-
-    print('building ega palettes')
+    if DEBUGMODE:
+        print('building ega palettes')
 
     # generate all the low/dark colors
     low = []
@@ -137,41 +158,159 @@ def _build_ega_palettes():
             for b in off_on:
                 high.append([r, g, b])
 
-    palettes['ega_default'] = low + high # how convenient
-
-def _build_palettes():
-    print('building palettes')
-    _build_grayscale_palettes()
-    _build_cga_palettes()
-    _build_ega_palettes()
-    _build_websafe_palettes()
-    _build_c64_palettes()
-
-    global palettes
-
-    with open('palettes.cache', 'w') as pf:
-        json.dump(palettes, pf)
-
-    global available_palettes
-    available_palettes = palettes.keys()
-
-# check if a palette file exists
-if os.access('palettes.cache', os.R_OK):
-    # check its mtime
-    me = os.path.realpath(__file__)
-    my_mtime = os.stat(me).st_mtime
-    cache_mtime = os.stat('palettes.cache').st_mtime
-
-    if my_mtime > cache_mtime:
-        # rebuild cache
-        _build_palettes()
-    else:
-        # read in the cache
-        with open('palettes.cache', 'r') as pf:
-            palettes = json.load(pf, object_pairs_hook=OrderedDict)
-        available_palettes = palettes.keys()
-else:
-    _build_palettes()
+    return {'ega_default': low + high} # how convenient
+
+# every palette name, in display order, with the builder that makes it;
+# builders only run when one of their palettes is first used
+_palette_builders = OrderedDict(
+        [('{}bit_gray'.format(bit_depth), _build_grayscale_palettes) for bit_depth in range(1, 8)] +
+        [(name, _build_cga_palettes) for name in (
+            'cga_mode4_1', 'cga_mode4_2', 'cga_mode4_1_high', 'cga_mode4_2_high',
+            'cga_mode5', 'cga_mode5_high')] +
+        [('ega_default', _build_ega_palettes),
+         ('websafe', _build_websafe_palettes),
+         ('c64', _build_c64_palettes)]
+)
+
+def _palette_directory():
+    return os.path.join(cache_directory(), 'palettes.v{}'.format(PALETTE_CACHE_VERSION))
+
+def _cache_path(palette_name):
+    return os.path.join(_palette_directory(), palette_name + '.npy')
+
+def save_array(path, array):
+    # write an .npy file through a temporary file so that concurrent
+    # processes never see a half written array; utils hands this out to
+    # the other caches
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            numpy.save(f, array)
+        os.replace(tmp_path, path)
+    except OSError:
+        os.unlink(tmp_path)
+        raise
+
+def _valid_name(palette_name):
+    # registered names become file names, so they are kept to a safe set
+    return bool(palette_name) and all(c.isalnum() or c in '_-' for c in palette_name)
+
+def _registered_path(palette_name):
+    if not _valid_name(palette_name):
+        raise ValueError('palette names may only hold letters, digits, _ and -, not {!r}'.format(palette_name))
+    return os.path.join(_palette_directory(), 'registered', palette_name + '.npy')
+
+class _PaletteRegistry(Mapping):
+    # read-only mapping of palette name to a (K, 3) float64 array in [0, 1];
+    # each palette is memory mapped from the cache, or built (and cached) the
+    # first time it is looked up
+    #
+    # palettes made at run time (see register_palette) follow the built-in
+    # ones; they are also written to the cache so that other processes can
+    # look them up by name
+
+    def __init__(self, builders):
+        self._builders = builders
+        self._arrays = {}
+        self._registered = OrderedDict()
+
+    def __getitem__(self, palette_name):
+        if palette_name in self._registered:
+            return self._registered[palette_name]
+        if palette_name not in self._arrays:
+            if palette_name not in self._builders:
+                return self._load_registered(palette_name)
+            self._arrays[palette_name] = self._load(palette_name)
+        return self._arrays[palette_name]
+
+    def __iter__(self):
+        yield from self._builders
+        yield from self._registered
+
+    def __len__(self):
+        return len(self._builders) + len(self._registered)
+
+    def __contains__(self, palette_name):
+        try:
+            self[palette_name]
+        except KeyError:
+            return False
+        return True
+
+    def builtin(self, palette_name):
+        return palette_name in self._builders
+
+    def loaded(self, palette_name):
+        # built in, or registered or looked up in this process, without
+        # going to the cache for it
+        return palette_name in self._builders or palette_name in self._registered
+
+    def register(self, palette_name, colors):
+        colors = numpy.array(colors, dtype=numpy.float64).reshape(-1, 3)
+        if palette_name in self._builders:
+            raise ValueError('{} is a built-in palette'.format(palette_name))
+        if not _valid_name(palette_name):
+            raise ValueError('palette names may only hold letters, digits, _ and -, not {!r}'.format(palette_name))
+        if palette_name in self._registered:
+            if not numpy.array_equal(self._registered[palette_name], colors):
+                raise ValueError('a different palette is already registered as {}'.format(palette_name))
+            return
+        colors.flags.writeable = False
+        self._registered[palette_name] = colors
+        try:
+            os.makedirs(os.path.dirname(_registered_path(palette_name)), exist_ok=True)
+            save_array(_registered_path(palette_name), colors)
+        except OSError:
+            pass
+
+    def _load_registered(self, palette_name):
+        # only names register() accepts can be looked up on disk
+        if not isinstance(palette_name, str) or not _valid_name(palette_name):
+            raise KeyError(palette_name)
+        try:
+            colors = numpy.load(_registered_path(palette_name))
+        except (OSError, ValueError):
+            raise KeyError(palette_name)
+        colors.flags.writeable = False
+        self._registered[palette_name] = colors
+        return colors
+
+    def _load(self, palette_name):
+        path = _cache_path(palette_name)
+        try:
+            # cached arrays older than this file may hold old definitions
+            if os.stat(path).st_mtime >= os.stat(os.path.realpath(__file__)).st_mtime:
+                return numpy.load(path, mmap_mode='r')
+        except (OSError, ValueError):
+            pass
+        return self._build(palette_name)
+
+    def _build(self, palette_name):
+        built = self._builders[palette_name]()
+        try:
+            os.makedirs(_palette_directory(), exist_ok=True)
+        except OSError:
+            pass
+        for name, colors in built.items():
+            colors = numpy.array(colors, dtype=numpy.float64)
+            colors.flags.writeable = False
+            try:
+                save_array(_cache_path(name), colors)
+            except OSError:
+                # read-only cache location, keep the palette in memory only
+                pass
+            self._arrays.setdefault(name, colors)
+        return self._arrays[palette_name]
+
+palettes = _PaletteRegistry(_palette_builders)
+available_palettes = palettes.keys()
+
+def register_palette(palette_name, colors):
+    # make a (K, 3) array of colors in [0, 1] available to every method
+    # under palette_name; names are never reused for different colors, since
+    # indices and lookup tables are kept per name
+    palettes.register(palette_name, colors)
 
 if __name__ == '__main__':
     print(available_palettes)
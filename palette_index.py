@@ -0,0 +1,179 @@
+import hashlib
+import numpy
+
+import color_metrics
+import instrument
+import lut
+import palette
+import utils
+
+DEBUGMODE = False
+
+# palettes this small are cheaper to scan than to look up
+BRUTE_FORCE_COLORS = 4
+
+# pixels this close to a decision boundary of the analytic paths are checked
+# with a full search so that ties resolve exactly like the brute force scan;
+# float32 queries need a wider margin
+TIE_EPSILON = 1e-9
+TIE_EPSILON_32 = 1e-4
+
+# rough budget of cell x color pairs for lookup tables built on the fly for
+# palettes that are not registered by name
+_COMPILE_PAIRS = 2 * 10**7
+
+_indices = {}
+
+
+def _nearest_level(values, levels, epsilon):
+    # index into the sorted 1D levels of the level nearest each value, and a
+    # mask of values that sit on (or next to) a midpoint between two levels
+    mids = (levels[1:] + levels[:-1]) / 2.
+    positions = numpy.searchsorted(mids, values, side='left')
+    if mids.size == 0:
+        return positions, numpy.zeros(values.shape, dtype=bool)
+    lower = mids[numpy.clip(positions - 1, 0, mids.size - 1)]
+    upper = mids[numpy.clip(positions, 0, mids.size - 1)]
+    near = (numpy.abs(values - lower) < epsilon) | (numpy.abs(values - upper) < epsilon)
+    return positions, near
+
+
+class PaletteIndex(object):
+    # nearest color index for one palette, built once and then queried with
+    # (N, 3) arrays of pixels
+    #
+    # lattice: the palette is the full product of per-channel levels (websafe)
+    #          so the nearest color is the nearest level on each channel
+    # gray:    every color lies on the gray diagonal, so the nearest color is
+    #          the level nearest the projection (r + g + b) / 3
+    # lut:     a compiled 3D lookup table with per-cell candidate lists
+    # brute:   a plain scan over the palette, for tiny palettes
+    #
+    # under a color metric other than rgb, colors and queries are both in
+    # that metric's space (see color_metrics.to_space)
+
+    def __init__(self, colors, palette_name=None, metric=color_metrics.default_metric):
+        self.colors = numpy.asarray(colors, dtype=numpy.float64)
+        self.palette_name = palette_name
+        self.metric = metric
+        self.n_colors = self.colors.shape[0]
+
+        if self._build_gray() or self._build_lattice():
+            pass
+        elif self.n_colors <= BRUTE_FORCE_COLORS:
+            self.strategy = 'brute'
+        else:
+            self.strategy = 'lut'
+            if palette_name is not None:
+                self.table = lut.load_lut(palette_name, metric=metric)
+            else:
+                resolution = int(numpy.clip((_COMPILE_PAIRS / self.n_colors) ** (1./3.),
+                    8, lut.default_resolution))
+                self.table = lut.compile_lut(self.colors, resolution)
+
+        if DEBUGMODE:
+            print(f'palette index for {palette_name}: {self.strategy}')
+
+    def _first_occurrence(self, keys, n_keys):
+        # palette index of the first color for every key, -1 where unused
+        table = numpy.full(n_keys, -1, dtype=numpy.int64)
+        table[keys[::-1]] = numpy.arange(self.n_colors)[::-1]
+        return table
+
+    def _build_gray(self):
+        colors = self.colors
+        if not (numpy.all(colors[:, 0] == colors[:, 1]) and numpy.all(colors[:, 1] == colors[:, 2])):
+            return False
+        self.levels = numpy.unique(colors[:, 0])
+        keys = numpy.searchsorted(self.levels, colors[:, 0])
+        self.level_index = self._first_occurrence(keys, self.levels.size)
+        self.strategy = 'gray'
+        return True
+
+    def _build_lattice(self):
+        colors = self.colors
+        self.channel_levels = [numpy.unique(colors[:, c]) for c in range(3)]
+        shape = tuple(levels.size for levels in self.channel_levels)
+        if self.n_colors < shape[0] * shape[1] * shape[2]:
+            return False
+        keys = [numpy.searchsorted(levels, colors[:, c])
+                for c, levels in enumerate(self.channel_levels)]
+        keys = numpy.ravel_multi_index(keys, shape)
+        self.lattice_index = self._first_occurrence(keys, shape[0] * shape[1] * shape[2])
+        if numpy.any(self.lattice_index < 0):
+            return False
+        self.lattice_shape = shape
+        self.strategy = 'lattice'
+        return True
+
+    def _query_gray(self, pixels, epsilon):
+        projection = (pixels[:, 0] + pixels[:, 1] + pixels[:, 2]) / 3.
+        positions, near = _nearest_level(projection, self.levels, epsilon)
+        return self.level_index[positions], near
+
+    def _query_lattice(self, pixels, epsilon):
+        keys = []
+        near = numpy.zeros(pixels.shape[0], dtype=bool)
+        for c, levels in enumerate(self.channel_levels):
+            positions, channel_near = _nearest_level(pixels[:, c], levels, epsilon)
+            keys.append(positions)
+            near |= channel_near
+        keys = numpy.ravel_multi_index(keys, self.lattice_shape)
+        return self.lattice_index[keys], near
+
+    def query(self, pixels, memory_budget=None):
+        # float32 pixels are matched in float32, anything else in float64
+        pixels = numpy.asarray(pixels).reshape(-1, 3)
+        if pixels.dtype != numpy.float32:
+            pixels = pixels.astype(numpy.float64, copy=False)
+        instrument.count('palette_lookups', pixels.shape[0])
+        colors = self.colors.astype(pixels.dtype, copy=False)
+        epsilon = TIE_EPSILON_32 if pixels.dtype == numpy.float32 else TIE_EPSILON
+
+        if self.strategy == 'brute':
+            return utils.nearest_indices(pixels, colors, memory_budget)
+        if self.strategy == 'lut':
+            return lut.lookup_table(self.table, pixels, colors, True, memory_budget)
+
+        if self.strategy == 'gray':
+            indices, near = self._query_gray(pixels, epsilon)
+        else:
+            indices, near = self._query_lattice(pixels, epsilon)
+        indices = indices.astype(utils.index_dtype(self.n_colors))
+        if numpy.any(near):
+            instrument.count('palette_ties_refined', int(numpy.count_nonzero(near)))
+            indices[near] = utils.nearest_indices(pixels[near], colors, memory_budget)
+        return indices
+
+
+def get_index(palette_colors, metric=color_metrics.default_metric):
+    # palette_colors is a palette name or a (K, 3) array of colors; indices
+    # are built once per palette and metric and reused for the life of the
+    # process. the index expects its queries in the metric's space
+    if isinstance(palette_colors, str):
+        key = (palette_colors, metric)
+        if key not in _indices:
+            instrument.count('palette_index_builds')
+            if metric == color_metrics.default_metric:
+                colors = utils.palette_array(palette_colors)
+            else:
+                colors = color_metrics.palette_in_space(palette_colors, metric)
+            _indices[key] = PaletteIndex(colors, palette_colors, metric)
+        else:
+            instrument.count('palette_index_hits')
+        return _indices[key]
+
+    colors = color_metrics.to_space(numpy.asarray(palette_colors, dtype=numpy.float64), metric)
+    colors = numpy.ascontiguousarray(colors, dtype=numpy.float64)
+    key = hashlib.sha1(colors.tobytes()).hexdigest()
+    if key not in _indices:
+        instrument.count('palette_index_builds')
+        _indices[key] = PaletteIndex(colors, metric=metric)
+    else:
+        instrument.count('palette_index_hits')
+    return _indices[key]
+
+
+if __name__ == '__main__':
+    for pname in palette.available_palettes:
+        print('{}: {}'.format(pname, get_index(pname).strategy))
@@ -0,0 +1,284 @@
+import numpy
+import threading
+
+import color_metrics
+import dither
+import error_diffusion
+import instrument
+import ordered_dithering
+import palette
+import randomized
+import utils
+
+DEBUGMODE = False
+
+# the proxy fits in this many pixels when no viewport is given
+default_viewport = (512, 512)
+
+# rows the full resolution refinement is worked through and delivered in
+REFINE_ROWS = 256
+
+
+def parse_size(text):
+    # 'WxH' from the command line
+    width, height = text.lower().split('x')
+    return (int(width), int(height))
+
+
+def parse_box(text):
+    # 'X0,Y0,X1,Y1' from the command line, the right and bottom edges
+    # excluded as in PIL's crop boxes
+    return tuple(int(n) for n in text.split(','))
+
+
+def fit_size(width, height, viewport):
+    # the size of a width x height area scaled down, never up, to fit in
+    # the viewport with its aspect ratio kept
+    scale = min(1.0, viewport[0] / width, viewport[1] / height)
+    return (max(1, int(round(width * scale))), max(1, int(round(height * scale)))), scale
+
+
+def proxy_matrix(matrix, viewport=default_viewport, box=None):
+    # the box of an (H, W, 3) matrix scaled to fit the viewport, by taking
+    # the pixel under the center of every proxy pixel; only those pixels are
+    # read, so the cost follows the viewport size and not the source size,
+    # memory mapped sources included
+    height, width = matrix.shape[:2]
+    x0, y0, x1, y1 = box if box is not None else (0, 0, width, height)
+    (proxy_width, proxy_height), scale = fit_size(x1 - x0, y1 - y0, viewport)
+    ys = y0 + ((numpy.arange(proxy_height) + 0.5) * (y1 - y0) / proxy_height).astype(numpy.intp)
+    xs = x0 + ((numpy.arange(proxy_width) + 0.5) * (x1 - x0) / proxy_width).astype(numpy.intp)
+    return numpy.asarray(matrix[ys[:, numpy.newaxis], xs])
+
+
+class RegionDitherer(object):
+    # the full resolution output of a method over any box of an image,
+    # identical to the same box of dither.dither_image's result
+    #
+    # threshold, ordered and random dithering are per pixel, so a box is
+    # dithered on its own with the threshold map and the noise in the phase
+    # they have at the box's position. an error diffused pixel depends on
+    # every pixel before it in scan order, so the error carried into a box
+    # is found by diffusing full rows from the top down to the box's bottom
+    # edge; the rows diffused so far are kept and the diffusion only ever
+    # moves on, so boxes further down resume where the last one stopped and
+    # boxes above it cost nothing. any other method dithers the whole image
+    # once and keeps it
+    #
+    # source is anything dither.dither_array takes; uint8 pixels are
+    # converted to dtype a band at a time, as dither_image converts images
+
+    def __init__(self, source, method, palette_name, dtype='float64', seed=None,
+            metric=color_metrics.default_metric, workers=1, block_size=None):
+        self.matrix = dither._as_image_matrix(source)
+        self.height, self.width = self.matrix.shape[:2]
+        self.method = method
+        self.palette_name = palette_name
+        self.dtype = dtype
+        self.metric = metric
+        self.workers = workers
+        self.block_size = block_size
+        # random dithering without a seed still has to draw the same noise
+        # for the proxy, every box and the refinement
+        if seed is None and method in randomized._available_methods:
+            seed = numpy.random.SeedSequence().entropy
+        self.seed = seed
+
+        # the palette indices of rows 0 .. rows_done, for the methods that
+        # cannot dither a box on its own, or once refine has gone past them
+        self.indices = None
+        self.rows_done = 0
+        self.diffuser = None
+        if method in error_diffusion._available_methods:
+            self.diffuser = error_diffusion.make_diffuser(self.width, palette_name, method, metric=metric)
+
+    def _method_args(self):
+        method_args = {}
+        if self.method in randomized._available_methods:
+            method_args['seed'] = self.seed
+        if self.diffuser is not None and self.workers > 1:
+            method_args['workers'] = self.workers
+        if self.block_size is not None and self.method == 'block_random':
+            method_args['block_size'] = self.block_size
+        if self.metric != color_metrics.default_metric:
+            method_args['metric'] = self.metric
+        return method_args
+
+    def _working(self, pixels):
+        if pixels.dtype == numpy.uint8:
+            return utils.pil2numpy(pixels, self.dtype)
+        return pixels
+
+    def _allocate(self):
+        if self.indices is None:
+            self.indices = numpy.empty((self.height, self.width),
+                    dtype=utils.index_dtype(len(palette.palettes[self.palette_name])))
+        return self.indices
+
+    def _check_box(self, box):
+        x0, y0, x1, y1 = box
+        if not (0 <= x0 < x1 <= self.width and 0 <= y0 < y1 <= self.height):
+            raise ValueError('box {} is not inside the {}x{} image'.format(box, self.width, self.height))
+        return box
+
+    def _pointwise(self, box):
+        x0, y0, x1, y1 = box
+        pixels = utils.unit_float(self._working(self.matrix[y0:y1, x0:x1]))
+        if self.method in ordered_dithering._available_methods:
+            tiled_map = ordered_dithering._tiled_map(ordered_dithering.threshold_map(self.method),
+                    y1 - y0, x1, y0, pixels.dtype)[:, x0:]
+            pixels = pixels + pixels * tiled_map[:, :, numpy.newaxis]
+        elif self.method == 'random':
+            # noise is drawn for full rows, as the full render draws it
+            noise = randomized._Noise(self.seed).rows(y0, (y1 - y0, self.width, 3), pixels.dtype)
+            pixels = numpy.clip(pixels + noise[:, x0:x1], 0.0, 1.0)
+        indices, new_matrix = utils.quantize(pixels, self.palette_name, metric=self.metric)
+        return indices
+
+    def _is_pointwise(self):
+        return (self.method in ('threshold', 'random')
+                or self.method in ordered_dithering._available_methods)
+
+    def _diffuse_to(self, y_end):
+        indices = self._allocate()
+        for y in range(self.rows_done, y_end, REFINE_ROWS):
+            stop = min(y + REFINE_ROWS, y_end)
+            indices[y:stop] = self.diffuser.process(self._working(self.matrix[y:stop]), self.workers)
+            self.rows_done = stop
+
+    def _dither_whole(self):
+        indices = self._allocate()
+        indices[:] = dither.available_methods[self.method](self._working(self.matrix),
+                self.palette_name, return_indices=True, **self._method_args())
+        self.rows_done = self.height
+
+    def proxy(self, viewport=default_viewport, box=None):
+        # the palette indices of the box scaled to fit the viewport; a
+        # preview only, dithered at the proxy's own resolution
+        if box is not None:
+            self._check_box(box)
+        matrix = self._working(proxy_matrix(self.matrix, viewport, box))
+        with instrument.stage('dither', matrix.shape[0] * matrix.shape[1]):
+            return dither.available_methods[self.method](matrix, self.palette_name,
+                    return_indices=True, **self._method_args())
+
+    def render(self, box):
+        # the (y1 - y0, x1 - x0) palette indices of the box, at full
+        # resolution
+        x0, y0, x1, y1 = self._check_box(box)
+        with instrument.stage('dither', (y1 - y0) * (x1 - x0)):
+            if y1 <= self.rows_done:
+                pass
+            elif self.diffuser is not None:
+                self._diffuse_to(y1)
+            elif self._is_pointwise():
+                return self._pointwise(box)
+            else:
+                self._dither_whole()
+        return self.indices[y0:y1, x0:x1]
+
+    def refine(self, band_height=REFINE_ROWS):
+        # the whole image at full resolution, top down: yields every band
+        # of rows as ((0, y0, width, y1), indices) as soon as it is known,
+        # rows that were dithered already included; afterwards indices holds
+        # the full index map
+        indices = self._allocate()
+        for y in range(0, self.height, band_height):
+            stop = min(y + band_height, self.height)
+            if stop > self.rows_done:
+                with instrument.stage('dither', (stop - self.rows_done) * self.width):
+                    if self.diffuser is not None:
+                        self._diffuse_to(stop)
+                    elif self._is_pointwise():
+                        indices[self.rows_done:stop] = self._pointwise((0, self.rows_done, self.width, stop))
+                        self.rows_done = stop
+                    else:
+                        self._dither_whole()
+            yield (0, y, self.width, stop), indices[y:stop]
+
+    def full(self):
+        for band in self.refine(self.height):
+            pass
+        return self.indices
+
+
+def progressive(source, method, palette_name, viewport=default_viewport, box=None, dtype='float64',
+        band_height=REFINE_ROWS, **method_args):
+    # every stage of a preview, as (stage, box, indices), best first:
+    #
+    #   'proxy'   the box (or the whole image) scaled to fit the viewport
+    #   'region'  the box at full resolution, when a box is given
+    #   'rows'    the whole image at full resolution, a band of rows at a time
+    #   'full'    the whole index map, the same as dither_image's result
+    #
+    # method_args are seed, metric, workers and block_size
+    region = RegionDitherer(source, method, palette_name, dtype, **method_args)
+    yield ('proxy', box, region.proxy(viewport, box))
+    if box is not None:
+        yield ('region', box, region.render(box))
+    for band_box, indices in region.refine(band_height):
+        yield ('rows', band_box, indices)
+    yield ('full', (0, 0, region.width, region.height), region.indices)
+
+
+class Refinement(threading.Thread):
+    # hands the stages of a preview after the first to callback(stage, box,
+    # indices) from a background thread; cancel stops it before the next
+    # stage, and an exception raised by a stage is kept in error
+
+    def __init__(self, stages, callback):
+        threading.Thread.__init__(self, daemon=True)
+        self.stages = stages
+        self.callback = callback
+        self.stopped = threading.Event()
+        self.error = None
+
+    def run(self):
+        try:
+            for stage, box, indices in self.stages:
+                if self.stopped.is_set():
+                    break
+                self.callback(stage, box, indices)
+        except Exception as e:
+            self.error = e
+            if DEBUGMODE:
+                print(f'refinement failed: {e}')
+        finally:
+            self.stages.close()
+
+    def cancel(self):
+        self.stopped.set()
+
+
+def preview(source, method, palette_name, callback, viewport=default_viewport, box=None, dtype='float64',
+        band_height=REFINE_ROWS, **method_args):
+    # dither the proxy right away and return its palette indices together
+    # with the started Refinement, which goes on with the full resolution
+    # stages of progressive in the background
+    stages = progressive(source, method, palette_name, viewport, box, dtype, band_height, **method_args)
+    stage, box, indices = next(stages)
+    refinement = Refinement(stages, callback)
+    refinement.start()
+    return indices, refinement
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('image_filename', help='Path to an image file to dither')
+    palette_help_str = 'Name of palette to use. Can be one of: ' + ', '.join(palette.available_palettes)
+    method_help_str = 'Method to use. Can be one of: ' + ', '.join(dither.available_methods)
+    parser.add_argument('-p', '--palette', type=str, default=dither.default_palette, help=palette_help_str)
+    parser.add_argument('-m', '--method', type=str, default=dither.default_method, help=method_help_str)
+    parser.add_argument('--viewport', type=parse_size, default=default_viewport, help='Size the proxy fits in, as WxH')
+    parser.add_argument('--roi', type=parse_box, default=None, help='Box to dither at full resolution first, as X0,Y0,X1,Y1')
+    args = parser.parse_args()
+
+    image = utils.open_image(args.image_filename)
+    for stage, box, indices in progressive(image, args.method, args.palette, args.viewport, args.roi):
+        if stage != 'rows':
+            print(f'{stage}: {box} {indices.shape[1]}x{indices.shape[0]}')
+        if stage == 'proxy':
+            utils.indices2pil(indices, args.palette).show()
+    utils.indices2pil(indices, args.palette).show()
@@ -1,61 +1,160 @@
 from PIL import Image
 from collections import OrderedDict
 import numpy
-import random
 import sys
 
+import color_metrics
 import palette
 import utils
 
 DEBUGMODE = False
 default_palette = 'cga_mode_4_2_hi'
 
-def block_randomized(image_matrix, palette_name):
-    new_matrix = numpy.copy(image_matrix)
-    cols, rows, depth = image_matrix.shape
-    
-    block_width, block_height = (max(1, cols/50), max(1, rows/50))
-
-    for by in range(0, rows, block_height):
-        for bx in range(0, cols, block_width):
-            block = new_matrix[bx:bx+block_width,by:by+block_height,:]
-            avg_color = numpy.sum(block, axis=(0,1))/(block_width*block_height)
-            for y in range(block_height):
-                for x in range(block_width):
-                    ar, ag, ab = avg_color
-                    ar = utils.clamp(ar + random.gauss(0.0, 1./6.))
-                    ab = utils.clamp(ag + random.gauss(0.0, 1./6.))
-                    ag = utils.clamp(ab + random.gauss(0.0, 1./6.))
-                    new_pixel = numpy.array(utils.closest_palette_color([ar, ag, ab],
-                        palette_name), dtype=numpy.float)
-                    new_matrix[bx+x][by+y] = new_pixel
-    return new_matrix
-
-def randomized(image_matrix, palette_name):
-    new_matrix = numpy.copy(image_matrix)
-    cols, rows, depth = image_matrix.shape
-    for y in range(rows):
-        for x in range(cols):
-            if DEBUGMODE:
-                print(f'<{x}, {y}>')
-                print(f'old = {new_matrix[{x}][{y}]}')
-
-            old_pixel = numpy.array(new_matrix[x][y], dtype=numpy.float)
-            opr, opg, opb = old_pixel
-            # add a random value in [-0.5, 0.5]
-            opr = utils.clamp(opr + random.gauss(0.0, 1./6.))
-            opg = utils.clamp(opg + random.gauss(0.0, 1./6.))
-            opb = utils.clamp(opb + random.gauss(0.0, 1./6.))
-            new_pixel = numpy.array(utils.closest_palette_color([opr, opg, opb],
-                palette_name), dtype=numpy.float)
-            new_matrix[x][y] = new_pixel
-    return new_matrix
+# standard deviation of the added noise: nearly all of it is in [-0.5, 0.5]
+NOISE_SIGMA = 1./6.
+
+# blocks of block_random, by default, split the image into a grid of this
+# many blocks each way
+BLOCK_GRID = 50
+
+# size, in bytes, of the float64 copy of the rows block_random expands the
+# block means over and adds noise to at once
+BLOCK_BAND_MEMORY = 32 * 1024 * 1024
+
+# noise is drawn in bands of this many rows, each from its own substream of
+# the seed, so the noise of a row never depends on how the image is split
+# into strips or tiles and bands can be drawn independently of each other
+NOISE_BAND = 64
+
+class _Noise(object):
+    # gaussian noise for an image, row by row, reproducible from a seed; a
+    # seed of None draws fresh entropy
+
+    def __init__(self, seed=None):
+        self.root = numpy.random.SeedSequence(seed)
+        self.band = None
+        self.generator = None
+        self.drawn = 0
+
+    def _band_generator(self, band):
+        sequence = numpy.random.SeedSequence(self.root.entropy, spawn_key=self.root.spawn_key + (band,))
+        return numpy.random.Generator(numpy.random.PCG64(sequence))
+
+    def rows(self, y_offset, shape, dtype):
+        # noise for rows y_offset .. y_offset + shape[0] of the image; strips
+        # asked for in order keep drawing from the current band's generator
+        noise = numpy.empty(shape, dtype=dtype)
+        y, y_end = y_offset, y_offset + shape[0]
+        while y < y_end:
+            band = y // NOISE_BAND
+            band_start = band * NOISE_BAND
+            stop = min(band_start + NOISE_BAND, y_end)
+            if band != self.band or y < band_start + self.drawn:
+                self.band = band
+                self.generator = self._band_generator(band)
+                self.drawn = 0
+            skip = y - band_start - self.drawn
+            if skip:
+                self.generator.standard_normal((skip,) + shape[1:], dtype=dtype)
+            noise[y-y_offset:stop-y_offset] = self.generator.standard_normal((stop - y,) + shape[1:], dtype=dtype)
+            self.drawn = stop - band_start
+            y = stop
+        noise *= noise.dtype.type(NOISE_SIGMA)
+        return noise
+
+def block_shape(height, width, block_size=None):
+    # (block_height, block_width) for an int or (height, width) block_size,
+    # or for the default grid of BLOCK_GRID x BLOCK_GRID blocks
+    if block_size is None:
+        return (max(1, height // BLOCK_GRID), max(1, width // BLOCK_GRID))
+    sides = [int(n) for n in numpy.ravel(block_size)]
+    block_height, block_width = sides * 2 if len(sides) == 1 else sides
+    if block_height < 1 or block_width < 1:
+        raise ValueError('blocks must be at least one pixel, not {}'.format(block_size))
+    return (min(block_height, height), min(block_width, width))
+
+def _block_means(image_matrix, block_height, block_width):
+    # (rows, cols, 3) float64 mean color of every block, in [0, 1]; blocks at
+    # the bottom and right edges may be smaller. every block row is summed
+    # down its rows and then across the block columns, one pass over the
+    # pixels whatever the block size, without a float copy of the image
+    height, width = image_matrix.shape[:2]
+    xs = numpy.arange(0, width, block_width)
+    block_cols = numpy.diff(numpy.append(xs, width))
+    scale = 255. if image_matrix.dtype == numpy.uint8 else 1.
+    means = numpy.empty((-(-height // block_height), xs.size, 3))
+    for b_i, y in enumerate(range(0, height, block_height)):
+        rows = image_matrix[y:y+block_height]
+        column_sums = rows.sum(axis=0, dtype=numpy.float64)
+        means[b_i] = numpy.add.reduceat(column_sums, xs, axis=0) / (block_cols * rows.shape[0] * scale)[:, numpy.newaxis]
+    return means
+
+def _noisy_quantize(pixels, palette_name, noise, y_offset=0, metric=color_metrics.default_metric):
+    old_matrix = numpy.clip(pixels + noise.rows(y_offset, pixels.shape, pixels.dtype), 0.0, 1.0)
+    indices, new_matrix = utils.quantize(old_matrix, palette_name, metric=metric)
+    return indices
+
+def block_randomized(image_matrix, palette_name, return_indices=False, seed=None, block_size=None,
+        metric=color_metrics.default_metric):
+    # every pixel gets the mean color of its block plus its own noise; the
+    # blocks are block_size pixels (an int or (height, width)), by default
+    # those of a BLOCK_GRID x BLOCK_GRID grid over the image
+    #
+    # the means are expanded back to pixels and dithered a band of rows at a
+    # time, so the temporaries stay bounded on any image size
+    image_matrix = numpy.asarray(image_matrix)
+    height, width = image_matrix.shape[:2]
+    block_height, block_width = block_shape(height, width, block_size)
+    means = _block_means(image_matrix, block_height, block_width)
+    dtype = utils.unit_float(image_matrix[:1, :1]).dtype
+    means = means.astype(dtype, copy=False)
+
+    noise = _Noise(seed)
+    block_of_col = numpy.arange(width) // block_width
+    indices = numpy.empty((height, width), dtype=utils.index_dtype(len(palette.palettes[palette_name])))
+    step = max(1, BLOCK_BAND_MEMORY // (width * 3 * 8))
+    for y in range(0, height, step):
+        rows = min(step, height - y)
+        band = means[numpy.arange(y, y + rows) // block_height][:, block_of_col]
+        indices[y:y+rows] = _noisy_quantize(band, palette_name, noise, y, metric)
+    return utils.dither_result(indices, palette_name, image_matrix, return_indices)
+
+def _randomized_quantize(image_matrix, palette_name, noise, y_offset=0, metric=color_metrics.default_metric):
+    # add gaussian noise to every channel of every pixel at once
+    return _noisy_quantize(utils.unit_float(image_matrix), palette_name, noise, y_offset, metric)
+
+def randomized(image_matrix, palette_name, return_indices=False, seed=None, metric=color_metrics.default_metric):
+    indices = _randomized_quantize(image_matrix, palette_name, _Noise(seed), metric=metric)
+    return utils.dither_result(indices, palette_name, image_matrix, return_indices)
+
+def _randomized_strips(width, palette_name, seed=None, metric=color_metrics.default_metric):
+    noise = _Noise(seed)
+    y_offset = 0
+    def process(rows):
+        nonlocal y_offset
+        indices = _randomized_quantize(rows, palette_name, noise, y_offset, metric)
+        y_offset += rows.shape[0]
+        return indices
+    return process
+
+def _randomized_tile(image_matrix, palette_name, y_offset=0, seed=None, metric=color_metrics.default_metric):
+    # the noise of a row only depends on the seed, so blocks of rows can be
+    # dithered in any order
+    return _randomized_quantize(image_matrix, palette_name, _Noise(seed), y_offset, metric)
 
 _available_methods = OrderedDict([
         ('random' , randomized),
         ('block_random' , block_randomized),
 ])
 
+_strip_methods = OrderedDict([
+        ('random' , _randomized_strips),
+])
+
+_tile_methods = OrderedDict([
+        ('random' , _randomized_tile),
+])
+
 if __name__ == '__main__':
     import argparse
 
@@ -64,12 +163,17 @@ if __name__ == '__main__':
     parser.add_argument('-b', '--bit-depth', type=int, default=1, help='Number of bits in dithered image')
     palette_help_str = 'Name of palette to use. Can be one of: ' + ', '.join(palette.available_palettes)
     parser.add_argument('-p', '--palette', type=str, default=default_palette, help=palette_help_str)
+    parser.add_argument('--seed', type=int, default=None, help='Seed for reproducible noise')
+    parser.add_argument('--block-size', type=int, default=None, help='Dither with block_random, in blocks of this many pixels')
     args = parser.parse_args()
 
     image = utils.open_image(args.image_filename)
     image_matrix = utils.pil2numpy(image)
 
-    dither_matrix = randomized(image_matrix, args.palette)
+    if args.block_size is not None:
+        dither_matrix = block_randomized(image_matrix, args.palette, seed=args.seed, block_size=args.block_size)
+    else:
+        dither_matrix = randomized(image_matrix, args.palette, seed=args.seed)
     dither_image = utils.numpy2pil(dither_matrix)
 
     dither_image.show()
@@ -0,0 +1,414 @@
+from collections import OrderedDict
+import concurrent.futures
+import json
+import os
+import tempfile
+import time
+import numpy
+
+import accel
+import error_diffusion
+import instrument
+import ordered_dithering
+import palette
+import randomized
+import streaming
+import threshold
+import utils
+
+DEBUGMODE = False
+
+# bump this whenever the calibration runs change so that old costs are
+# measured again
+COST_MODEL_VERSION = 1
+
+# size, in bytes, of the temporaries a method may make over the whole image
+# before the dispatcher goes strip by strip instead
+MEMORY_BUDGET = 512 * 1024 * 1024
+
+# share of the ideal speedup threads get on row blocks and on the wavefront,
+# and the fixed cost of starting a parallel run
+PARALLEL_EFFICIENCY = 0.8
+WAVEFRONT_EFFICIENCY = 0.6
+PARALLEL_OVERHEAD = 2e-3
+
+# rows of a block handed to one thread by the parallel engine, at least
+PARALLEL_ROWS = 64
+
+# side of the calibration image, and the palettes it is dithered to; costs
+# for other palette sizes are interpolated on the log of the color count
+CALIBRATION_SIZE = 128
+calibration_palettes = ['cga_mode4_2_high', 'ega_default', 'websafe']
+
+# the ways a method can be run:
+#
+#   vectorized  the method on the whole image at once with numpy
+#   jit         the same through numba's compiled loops (error diffusion)
+#   parallel    row blocks on a thread pool for tileable methods, the
+#               wavefront scheduler for error diffusion
+#   streaming   the method's strip function over blocks of rows, which
+#               bounds the temporaries whatever the image size
+engines = ['vectorized', 'jit', 'parallel', 'streaming']
+
+# seconds per pixel with the 4 color palette and growth per doubling of the
+# palette size, used until the machine is calibrated
+_default_costs = {
+        'threshold': (2e-8, 4e-9),
+        'ordered': (4e-8, 4e-9),
+        'random': (8e-8, 4e-9),
+        'block_random': (1e-7, 4e-9),
+        'error_diffusion': (3e-8, 1e-8),
+}
+
+# the method every family is calibrated with
+_representatives = OrderedDict([
+        ('threshold', 'threshold'),
+        ('ordered', 'bayer4x4'),
+        ('random', 'random'),
+        ('block_random', 'block_random'),
+        ('error_diffusion', 'floyd_steinberg'),
+])
+
+# full size float copies of the image a whole image run makes, roughly
+_temporaries = {
+        'threshold': 1,
+        'ordered': 3,
+        'random': 3,
+        'block_random': 1,
+        'error_diffusion': 1,
+}
+
+
+class Method(object):
+    # a dithering method and what it can do:
+    #
+    #   tileable        any block of rows can be dithered on its own (tile)
+    #   neighbor_state  a pixel depends on pixels dithered before it
+    #   stochastic      the output depends on a seed
+    #   index_output    return_indices gives the palette index map
+    #   streamable      the method has a strip function (strip)
+    #   any_palette     every palette can be dithered to; otherwise palettes
+    #                   is a function telling which palette names can
+    #
+    # family names the calibrated cost the method shares, and weight is the
+    # method's cost relative to its family's representative
+
+    def __init__(self, name, function, family, tile=None, strip=None, neighbor_state=False,
+            stochastic=False, index_output=True, wavefront=False, weight=1.0, palettes=None):
+        self.name = name
+        self.function = function
+        self.family = family
+        self.tile = tile
+        self.strip = strip
+        self.neighbor_state = neighbor_state
+        self.stochastic = stochastic
+        self.index_output = index_output
+        self.wavefront = wavefront
+        self.weight = weight
+        self.palettes = palettes
+
+    @property
+    def tileable(self):
+        return self.tile is not None
+
+    @property
+    def streamable(self):
+        return self.strip is not None
+
+    @property
+    def any_palette(self):
+        return self.palettes is None
+
+    def accepts(self, palette_name):
+        return self.palettes is None or self.palettes(palette_name)
+
+    def capabilities(self):
+        return OrderedDict([
+                ('tileable', self.tileable),
+                ('neighbor_state', self.neighbor_state),
+                ('stochastic', self.stochastic),
+                ('index_output', self.index_output),
+                ('streamable', self.streamable),
+                ('wavefront', self.wavefront),
+                ('any_palette', self.any_palette),
+        ])
+
+    def engines(self):
+        # the engines that can run this method here
+        found = ['jit'] if self.neighbor_state and accel.available else ['vectorized']
+        if self.tileable or (self.wavefront and accel.available):
+            found.append('parallel')
+        if self.streamable:
+            found.append('streaming')
+        return found
+
+
+methods = OrderedDict()
+
+# name -> function, the plain call of every registered method; dither.py
+# hands this out as available_methods
+available_methods = OrderedDict()
+
+
+def register_method(name, function, family, **capabilities):
+    # add a method, or replace one; function takes (image_matrix,
+    # palette_name, return_indices=False, **kwargs) like the built in ones.
+    # a family that is not calibrated costs like error diffusion
+    methods[name] = Method(name, function, family, **capabilities)
+    available_methods[name] = function
+    return methods[name]
+
+
+def _register_module(module, family, **capabilities):
+    tiles = getattr(module, '_tile_methods', {})
+    for name, function in module._available_methods.items():
+        register_method(name, function, family, tile=tiles.get(name),
+                strip=module._strip_methods.get(name), **capabilities)
+
+def _diffusion_weight(method):
+    # the kernel's taps plus the palette match, next to floyd_steinberg's
+    kernel_name, options = error_diffusion._method_kernels[method]
+    taps = numpy.count_nonzero(error_diffusion._stencils[kernel_name][0])
+    return (4. + taps) / 8.
+
+_register_module(threshold, 'threshold')
+_register_module(randomized, 'random', stochastic=True)
+methods['block_random'].family = 'block_random'
+_register_module(ordered_dithering, 'ordered')
+_register_module(error_diffusion, 'error_diffusion', neighbor_state=True)
+for name in error_diffusion._method_names:
+    methods[name].wavefront = not error_diffusion._method_kernels[name][1].get('serpentine', False)
+    methods[name].weight = _diffusion_weight(name)
+    if error_diffusion._method_kernels[name][1].get('per_channel', False):
+        methods[name].palettes = error_diffusion.channel_palette
+
+
+def _cost_path():
+    return os.path.join(palette.cache_directory(), 'costs.v{}.json'.format(COST_MODEL_VERSION))
+
+
+def _cost_key():
+    # compiled and numpy runs are calibrated apart
+    return 'jit' if accel.available else 'numpy'
+
+
+def calibrate(size=CALIBRATION_SIZE, palettes=None, repeat=3):
+    # seconds per pixel of every family's representative on a random
+    # size x size image, for every calibration palette, as
+    # {family: [[n_colors, seconds], ...]}; the first run of every case is
+    # not timed, so palette, lookup table and jit compilation costs are left
+    # out
+    palettes = palettes or calibration_palettes
+    image_matrix = numpy.random.default_rng(0).random((size, size, 3))
+    costs = {}
+    for family, method in _representatives.items():
+        function = available_methods[method]
+        method_args = {'seed': 0} if methods[method].stochastic else {}
+        points = []
+        for palette_name in palettes:
+            function(image_matrix, palette_name, return_indices=True, **method_args)
+            best = float('inf')
+            for r in range(repeat):
+                start = time.perf_counter()
+                function(image_matrix, palette_name, return_indices=True, **method_args)
+                best = min(best, time.perf_counter() - start)
+            points.append([len(palette.palettes[palette_name]), best / (size * size)])
+        costs[family] = points
+        if DEBUGMODE:
+            print(f'{family}: {points}')
+    return costs
+
+
+def save_costs(costs):
+    # next to the palettes; a read-only cache location keeps them in memory
+    path = _cost_path()
+    try:
+        saved = json.load(open(path))
+    except (OSError, ValueError):
+        saved = {}
+    saved[_cost_key()] = costs
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(saved, f, indent=1)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+
+_costs = None
+
+def recalibrate():
+    # measure the costs of this machine now and keep them, in this process
+    # and in the cache
+    global _costs
+    with instrument.stage('calibrate'):
+        _costs = calibrate()
+    save_costs(_costs)
+    return _costs
+
+
+def cost_model(calibrate_missing=False):
+    # the calibrated costs of this machine from the cache; when nothing was
+    # calibrated yet, None, which stands for the defaults, or with
+    # calibrate_missing set the costs measured now. calibrating takes
+    # seconds, so it is only done when asked for (--calibrate)
+    global _costs
+    if _costs is None:
+        try:
+            _costs = json.load(open(_cost_path()))[_cost_key()]
+        except (OSError, ValueError, KeyError):
+            if not calibrate_missing:
+                return None
+            recalibrate()
+    return _costs
+
+
+def pixel_cost(method, n_colors, costs=None):
+    # estimated serial seconds per pixel of method with a palette of
+    # n_colors colors
+    info = methods[method]
+    points = (costs or {}).get(info.family)
+    if points:
+        sizes, seconds = zip(*points)
+        cost = numpy.interp(numpy.log2(n_colors), numpy.log2(sizes), seconds)
+    else:
+        base, growth = _default_costs.get(info.family, _default_costs['error_diffusion'])
+        cost = base + growth * max(0.0, numpy.log2(n_colors) - 2)
+    return float(cost) * info.weight
+
+
+def estimate(method, palette_name, width, height, cores=None, itemsize=8, costs=None):
+    # {engine: (seconds, bytes of temporaries)} for every engine that can
+    # run method on a width x height image here
+    info = methods[method]
+    cores = cores or os.cpu_count() or 1
+    n_pixels = width * height
+    serial = n_pixels * pixel_cost(method, len(palette.palettes[palette_name]), costs)
+    whole = n_pixels * 3 * itemsize * _temporaries.get(info.family, 1)
+    found = OrderedDict()
+    for engine in info.engines():
+        if engine == 'parallel':
+            if info.tileable:
+                threads = min(cores, max(1, height // PARALLEL_ROWS))
+                seconds = serial / (threads * PARALLEL_EFFICIENCY) + PARALLEL_OVERHEAD
+                size = min(whole, threads * _block_rows(height, threads) * width * 3 * itemsize * _temporaries.get(info.family, 1))
+            else:
+                threads = min(cores, max(1, width // error_diffusion.WAVEFRONT_BLOCK))
+                seconds = serial / (threads * WAVEFRONT_EFFICIENCY) + PARALLEL_OVERHEAD
+                size = whole
+            if threads < 2:
+                continue
+            found[engine] = (seconds, size)
+        elif engine == 'streaming':
+            found[engine] = (serial * 1.05, min(whole, streaming.STRIP_MEMORY * _temporaries.get(info.family, 1)))
+        else:
+            found[engine] = (serial, whole)
+    return found
+
+
+def select_engine(method, palette_name, width, height, cores=None, itemsize=8,
+        memory_budget=MEMORY_BUDGET, costs=None):
+    # the fastest engine whose temporaries fit in memory_budget; streaming
+    # always fits when the method has it
+    found = estimate(method, palette_name, width, height, cores, itemsize, costs)
+    fitting = [(seconds, engine) for engine, (seconds, size) in found.items() if size <= memory_budget]
+    if not fitting:
+        fitting = [(seconds, engine) for engine, (seconds, size) in found.items()]
+    return min(fitting)[1]
+
+
+def _block_rows(height, threads):
+    # about four blocks per thread, so a slow block does not hold up the rest
+    return max(PARALLEL_ROWS, -(-height // (4 * threads)))
+
+
+def _run_parallel(info, image_matrix, palette_name, cores, method_args):
+    if not info.tileable:
+        return info.function(image_matrix, palette_name, return_indices=True, workers=cores, **method_args)
+    height = image_matrix.shape[0]
+    out = numpy.empty(image_matrix.shape[:2], dtype=utils.index_dtype(len(palette.palettes[palette_name])))
+    step = _block_rows(height, cores)
+
+    def work(y):
+        out[y:y+step] = info.tile(image_matrix[y:y+step], palette_name, y, **method_args)
+
+    with concurrent.futures.ThreadPoolExecutor(cores) as pool:
+        for done in pool.map(work, range(0, height, step)):
+            pass
+    return out
+
+
+def _run_streaming(info, image_matrix, palette_name, method_args):
+    height, width = image_matrix.shape[:2]
+    process = info.strip(width, palette_name, **method_args)
+    out = numpy.empty((height, width), dtype=utils.index_dtype(len(palette.palettes[palette_name])))
+    step = max(1, streaming.STRIP_MEMORY // (width * 3 * 8))
+    for y in range(0, height, step):
+        out[y:y+step] = process(image_matrix[y:y+step])
+    return out
+
+
+def run(image_matrix, method, palette_name, return_indices=False, engine='auto', workers=None,
+        memory_budget=MEMORY_BUDGET, **method_args):
+    # dither image_matrix with method through the given engine, or the one
+    # select_engine picks for it with 'auto'; every engine gives the same
+    # result. workers is the number of cores to use, all of them by default
+    info = methods[method]
+    if not info.accepts(palette_name):
+        raise ValueError('{} cannot dither to {}'.format(method, palette_name))
+    height, width = image_matrix.shape[:2]
+    cores = workers or os.cpu_count() or 1
+    if engine == 'auto':
+        engine = select_engine(method, palette_name, width, height, cores,
+                numpy.dtype(image_matrix.dtype).itemsize, memory_budget, cost_model())
+    elif engine not in info.engines():
+        raise ValueError('{} cannot run on the {} engine here, only on {}'.format(method, engine, ', '.join(info.engines())))
+    if DEBUGMODE:
+        print(f'{method} on {width}x{height} with {palette_name}: {engine}')
+    instrument.count('engine_' + engine)
+
+    # blocks of a randomized method all draw from one seed
+    if info.stochastic and method_args.get('seed') is None and engine in ('parallel', 'streaming'):
+        method_args['seed'] = numpy.random.SeedSequence().entropy
+
+    if engine == 'parallel':
+        indices = _run_parallel(info, image_matrix, palette_name, cores, method_args)
+    elif engine == 'streaming':
+        indices = _run_streaming(info, image_matrix, palette_name, method_args)
+    else:
+        indices = info.function(image_matrix, palette_name, return_indices=True, **method_args)
+    return utils.dither_result(indices, palette_name, image_matrix, return_indices)
+
+
+def method_function(method, engine='auto'):
+    # run as a function with the signature of the plain method
+    def function(image_matrix, palette_name, return_indices=False, **kwargs):
+        return run(image_matrix, method, palette_name, return_indices, engine, **kwargs)
+    return function
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calibrate', action='store_true', help='Measure the per pixel costs of this machine again')
+    parser.add_argument('-s', '--size', type=str, default='3840x2160', help='Image size to pick engines for, as WxH')
+    parser.add_argument('-p', '--palette', type=str, default='cga_mode4_2_high', help='Palette to pick engines for')
+    parser.add_argument('-c', '--cores', type=int, default=None, help='Cores to pick engines for')
+    args = parser.parse_args()
+
+    if args.calibrate:
+        recalibrate()
+    costs = cost_model()
+    width, height = (int(n) for n in args.size.lower().split('x'))
+
+    flags = ['tileable', 'neighbor_state', 'stochastic', 'streamable', 'wavefront', 'any_palette']
+    print('{:<28} {:>12} {:<10} {}'.format('method', 'ns/pixel', 'engine', ' '.join(flags)))
+    for name, info in methods.items():
+        capabilities = info.capabilities()
+        print('{:<28} {:>12.1f} {:<10} {}'.format(name,
+            pixel_cost(name, len(palette.palettes[args.palette]), costs) * 1e9,
+            select_engine(name, args.palette, width, height, args.cores, costs=costs),
+            ' '.join('{:<{}}'.format('x' if capabilities[flag] else '.', len(flag)) for flag in flags)))
@@ -0,0 +1,153 @@
+import hashlib
+import os
+import numpy
+
+import instrument
+import palette
+import randomized
+import utils
+
+DEBUGMODE = False
+
+# bump this whenever a method's output changes so that old results are not
+# served any more
+RESULT_CACHE_VERSION = 2
+
+# total size, in bytes, the cached index maps may take before the least
+# recently used ones are evicted
+default_max_bytes = 256 * 1024 * 1024
+
+# method arguments that change how the work is done but not its result
+_ignored_args = ('workers',)
+
+
+def default_directory():
+    return os.path.join(palette.cache_directory(), 'results.v{}'.format(RESULT_CACHE_VERSION))
+
+
+def cacheable(method, method_args):
+    # randomized methods are only repeatable with a seed
+    return method not in randomized._available_methods or method_args.get('seed') is not None
+
+
+def result_key(image_matrix, method, palette_name, method_args=None):
+    # hash of everything the index map depends on: the pixels and their
+    # type, the method, the palette colors and the method arguments
+    image_matrix = numpy.ascontiguousarray(image_matrix)
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update('{}:{}:{}:{}:'.format(RESULT_CACHE_VERSION, method, image_matrix.dtype.str,
+        image_matrix.shape).encode('ascii'))
+    digest.update(numpy.ascontiguousarray(utils.palette_array(palette_name)).tobytes())
+    args = sorted((k, v) for k, v in (method_args or {}).items() if k not in _ignored_args)
+    digest.update(repr(args).encode('utf-8'))
+    digest.update(memoryview(image_matrix).cast('B'))
+    return digest.hexdigest()
+
+
+class ResultCache(object):
+    # palette index maps on disk, one .npy file per key, evicted least
+    # recently used first once they take more than max_bytes
+    #
+    # several processes can share a directory: files are written to a
+    # temporary name and renamed into place, a hit bumps the file's mtime,
+    # and a file that disappears under a reader is just a miss
+
+    def __init__(self, directory=None, max_bytes=default_max_bytes):
+        self.directory = directory or default_directory()
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            indices = numpy.load(path)
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            instrument.count('result_cache_misses')
+            return None
+        self.hits += 1
+        instrument.count('result_cache_hits')
+        return indices
+
+    def put(self, key, indices):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            utils.save_array(self._path(key), indices)
+        except OSError:
+            # read-only cache location, nothing is kept
+            return
+        self.evict()
+
+    def _entries(self):
+        entries = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.npy'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, filename))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        return entries
+
+    def size(self):
+        try:
+            return sum(size for mtime, size, filename in self._entries())
+        except OSError:
+            return 0
+
+    def evict(self, max_bytes=None):
+        # drop the least recently used results until the rest fit
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        try:
+            entries = sorted(self._entries())
+        except OSError:
+            return
+        total = sum(size for mtime, size, filename in entries)
+        for mtime, size, filename in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.unlink(os.path.join(self.directory, filename))
+            except OSError:
+                pass
+            total -= size
+            if DEBUGMODE:
+                print(f'evicted {filename}')
+
+    def clear(self):
+        self.evict(0)
+
+    def indices(self, method_function, image_matrix, method, palette_name, **method_args):
+        # the palette indices of method_function(image_matrix, palette_name),
+        # from the cache when this exact call was made before
+        if not cacheable(method, method_args):
+            return method_function(image_matrix, palette_name, return_indices=True, **method_args)
+        key = result_key(image_matrix, method, palette_name, method_args)
+        indices = self.get(key)
+        if indices is None:
+            indices = method_function(image_matrix, palette_name, return_indices=True, **method_args)
+            self.put(key, indices)
+        return indices
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('action', choices=['size', 'clear', 'evict'], help='Report the cache size, empty it, or evict down to --max-mb')
+    parser.add_argument('-d', '--directory', type=str, default=None, help='Cache directory')
+    parser.add_argument('--max-mb', type=float, default=default_max_bytes / 2**20, help='Size to evict down to')
+    args = parser.parse_args()
+
+    cache = ResultCache(args.directory, int(args.max_mb * 2**20))
+    if args.action == 'clear':
+        cache.clear()
+    elif args.action == 'evict':
+        cache.evict()
+    print('{}: {:.1f} MB'.format(cache.directory, cache.size() / 2**20))
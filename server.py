@@ -0,0 +1,455 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import http.client
+import io
+import json
+import numpy
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+import urllib.parse
+
+import batch
+import color_metrics
+import dither
+import palette
+import randomized
+import registry
+import utils
+
+DEBUGMODE = False
+default_host = '127.0.0.1'
+default_port = 8765
+
+# requests waiting for a worker; once full, new requests are turned away
+# with 503 so that clients back off instead of piling up
+default_max_queue = 64
+
+# requests handed to a worker process at once, and how long the first one
+# may wait for others to fill its batch
+default_batch_size = 8
+default_batch_wait = 0.005
+
+# largest image, in bytes, a request may send
+default_max_body = 64 * 1024 * 1024
+
+# output formats and their content types
+_formats = {
+        'png': ('PNG', 'image/png'),
+        'gif': ('GIF', 'image/gif'),
+        'webp': ('WEBP', 'image/webp'),
+        'bmp': ('BMP', 'image/bmp'),
+        'tiff': ('TIFF', 'image/tiff'),
+}
+
+# responses are written in pieces of this many bytes
+_CHUNK = 64 * 1024
+
+
+def parse_params(query):
+    # the dither parameters of a request from its parsed query string,
+    # checked before the request is queued; raises ValueError
+    def get(name, default=None):
+        values = query.get(name)
+        return values[-1] if values else default
+
+    params = {
+        'method': get('method', dither.default_method),
+        'palette': get('palette', dither.default_palette),
+        'dtype': get('dtype', 'float64'),
+        'format': get('format', 'png').lower(),
+        'indexed': get('indexed', '0').lower() in ('1', 'true', 'yes'),
+        'method_args': {},
+    }
+    if params['method'] not in dither.available_methods:
+        raise ValueError('unknown method {}'.format(params['method']))
+    # palettes come from the query string, so only the built in ones and
+    # those registered in this process are served, never any other file
+    if not palette.palettes.loaded(params['palette']):
+        raise ValueError('unknown palette {}'.format(params['palette']))
+    if not registry.methods[params['method']].accepts(params['palette']):
+        raise ValueError('{} cannot dither to {}'.format(params['method'], params['palette']))
+    if params['dtype'] not in ('float64', 'float32', 'uint8'):
+        raise ValueError('unknown dtype {}'.format(params['dtype']))
+    if params['format'] not in _formats:
+        raise ValueError('unknown format {}'.format(params['format']))
+    metric = get('metric', color_metrics.default_metric)
+    if metric not in color_metrics.metric_ids:
+        raise ValueError('unknown metric {}'.format(metric))
+    if metric != color_metrics.default_metric:
+        params['method_args']['metric'] = metric
+    seed = get('seed')
+    if seed is not None and params['method'] in randomized._available_methods:
+        params['method_args']['seed'] = int(seed)
+    return params
+
+
+def _warm_worker(palette_names, method):
+    # load the palettes and their tables, and compile the method's kernels,
+    # before the worker takes its first request
+    for palette_name in palette_names:
+        batch._warm(palette_name)
+        dither.available_methods[method](numpy.zeros((8, 8, 3)), palette_name)
+
+
+def _dither_one(data, params):
+    image = utils.open_image(io.BytesIO(data))
+    result = dither.dither_image(image, params['method'], params['palette'], params['dtype'],
+            params['indexed'], **params['method_args'])
+    encoded = io.BytesIO()
+    result.save(encoded, format=_formats[params['format']][0])
+    width, height = image.size
+    return encoded.getvalue(), width * height
+
+
+def _dither_batch(jobs):
+    # runs in a worker: dither every (data, params) job of a batch, giving
+    # (True, encoded image, pixels) or (False, error message, 0) for each
+    results = []
+    for data, params in jobs:
+        try:
+            results.append((True,) + _dither_one(data, params))
+        except Exception as e:
+            results.append((False, '{}: {}'.format(type(e).__name__, e), 0))
+    return results
+
+
+class RequestError(Exception):
+    # the request itself was bad, e.g. data that is not an image
+    pass
+
+
+class DitherService(object):
+    # a pool of warm worker processes fed from a bounded queue
+    #
+    # submit() queues a request and returns a Future; a dispatcher thread
+    # takes up to batch_size queued requests at a time, waiting at most
+    # batch_wait for a batch to fill, and hands every batch to a worker.
+    # at most two batches per worker are in flight, so a busy pool leaves
+    # requests in the queue and a full queue rejects new ones
+
+    def __init__(self, workers=None, max_queue=default_max_queue, batch_size=default_batch_size,
+            batch_wait=default_batch_wait, preload=(dither.default_palette,),
+            method=dither.default_method):
+        self.workers = workers or os.cpu_count()
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.queue = queue.Queue(max_queue)
+        self.slots = threading.Semaphore(2 * self.workers)
+
+        # the parent warms first so that lookup tables are compiled and
+        # cached once rather than by every worker at the same time
+        for palette_name in preload:
+            batch._warm(palette_name)
+        self.pool = ProcessPoolExecutor(self.workers, initializer=_warm_worker,
+                initargs=(tuple(preload), method))
+
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counts = dict.fromkeys(['requests', 'rejected', 'completed', 'failed', 'batches',
+            'batched_requests', 'pixels', 'in_flight'], 0)
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def _count(self, **counts):
+        with self.lock:
+            for name, n in counts.items():
+                self.counts[name] += n
+
+    def submit(self, data, params):
+        # queue one encoded image; raises queue.Full when the queue is full
+        future = Future()
+        try:
+            self.queue.put_nowait((data, params, future, time.perf_counter()))
+        except queue.Full:
+            self._count(rejected=1)
+            raise
+        self._count(requests=1)
+        return future
+
+    def _next_batch(self):
+        first = self.queue.get()
+        if first is None:
+            return None
+        jobs = [first]
+        deadline = time.perf_counter() + self.batch_wait
+        while len(jobs) < self.batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                job = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is None:
+                # stop after this batch
+                self.queue.put(None)
+                break
+            jobs.append(job)
+        return jobs
+
+    def _dispatch(self):
+        while True:
+            self.slots.acquire()
+            jobs = self._next_batch()
+            if jobs is None:
+                self.slots.release()
+                return
+            self._count(batches=1, batched_requests=len(jobs), in_flight=len(jobs))
+            if DEBUGMODE:
+                print(f'batch of {len(jobs)} requests, {self.queue.qsize()} queued')
+            try:
+                task = self.pool.submit(_dither_batch, [(data, params) for data, params, future, t in jobs])
+            except RuntimeError as e:
+                self._finish_failed(jobs, e)
+                continue
+            task.add_done_callback(lambda task, jobs=jobs: self._finish(task, jobs))
+
+    def _finish_failed(self, jobs, error):
+        self.slots.release()
+        self._count(failed=len(jobs), in_flight=-len(jobs))
+        for data, params, future, t in jobs:
+            future.set_exception(error)
+
+    def _finish(self, task, jobs):
+        try:
+            results = task.result()
+        except Exception as e:
+            # the worker died; none of the batch has a result
+            self._finish_failed(jobs, e)
+            return
+        self.slots.release()
+        now = time.perf_counter()
+        with self.lock:
+            self.counts['in_flight'] -= len(jobs)
+            for (ok, value, pixels), (data, params, future, start) in zip(results, jobs):
+                self.counts['completed' if ok else 'failed'] += 1
+                self.counts['pixels'] += pixels
+                self.latency_total += now - start
+                self.latency_max = max(self.latency_max, now - start)
+        for (ok, value, pixels), (data, params, future, start) in zip(results, jobs):
+            if ok:
+                future.set_result((value, pixels))
+            else:
+                future.set_exception(RequestError(value))
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+            finished = stats['completed'] + stats['failed']
+            stats['mean_latency_ms'] = 1000 * self.latency_total / finished if finished else 0.0
+            stats['max_latency_ms'] = 1000 * self.latency_max
+        uptime = time.time() - self.started
+        stats.update({
+            'uptime_s': uptime,
+            'workers': self.workers,
+            'queued': self.queue.qsize(),
+            'max_queue': self.max_queue,
+            'batch_size': self.batch_size,
+            'mean_batch': stats['batched_requests'] / stats['batches'] if stats['batches'] else 0.0,
+            'mpx_per_s': stats['pixels'] / 1e6 / max(uptime, 1e-9),
+        })
+        return stats
+
+    def close(self):
+        self.queue.put(None)
+        self.dispatcher.join()
+        self.pool.shutdown()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # POST /dither?method=...&palette=... with an encoded image as the body
+    # answers with the dithered image; GET /stats gives the service's
+    # counters and GET /methods what can be asked for
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        # unix socket peers have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if DEBUGMODE:
+            super().log_message(format, *args)
+
+    def _send(self, code, body, content_type, headers=()):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        view = memoryview(body)
+        for start in range(0, len(view), _CHUNK):
+            self.wfile.write(view[start:start + _CHUNK])
+
+    def _send_json(self, code, value, headers=()):
+        self._send(code, json.dumps(value).encode('utf-8'), 'application/json', headers)
+
+    def _error(self, code, message, headers=()):
+        self._send_json(code, {'error': message}, headers)
+
+    def do_GET(self):
+        path = urllib.parse.urlparse(self.path).path
+        if path == '/stats':
+            self._send_json(200, self.server.service.stats())
+        elif path == '/methods':
+            self._send_json(200, {'methods': list(dither.available_methods),
+                'palettes': list(palette.available_palettes), 'metrics': color_metrics.available_metrics,
+                'formats': list(_formats)})
+        else:
+            self._error(404, 'not found')
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path != '/dither':
+            self.close_connection = True
+            self._error(404, 'not found')
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        if length <= 0 or length > self.server.max_body:
+            # the body is not read, so the connection cannot be reused
+            self.close_connection = True
+            self._error(411 if length <= 0 else 413, 'image body missing or too large')
+            return
+        data = self.rfile.read(length)
+        try:
+            params = parse_params(urllib.parse.parse_qs(url.query))
+        except ValueError as e:
+            self._error(400, str(e))
+            return
+
+        try:
+            future = self.server.service.submit(data, params)
+        except queue.Full:
+            self._error(503, 'queue full', [('Retry-After', '1')])
+            return
+        try:
+            body, pixels = future.result()
+        except RequestError as e:
+            self._error(400, str(e))
+            return
+        except Exception as e:
+            self._error(500, '{}: {}'.format(type(e).__name__, e))
+            return
+        self._send(200, body, _formats[params['format']][1], [('X-Dither-Pixels', str(pixels))])
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    # connections wait in the listen backlog until a handler thread takes
+    # them; backpressure proper comes from the service's queue
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class _UnixHTTPServer(_HTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        # HTTPServer.server_bind looks up a host name and port
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def make_server(service, host=default_host, port=default_port, unix_socket=None,
+        max_body=default_max_body):
+    # an HTTP server for the service on a TCP port, or on a unix socket
+    # when unix_socket is a path; call serve_forever() to run it
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.unlink(unix_socket)
+        server = _UnixHTTPServer(unix_socket, _Handler)
+    else:
+        server = _HTTPServer((host, port), _Handler)
+    server.service = service
+    server.max_body = max_body
+    return server
+
+
+def serve(host=default_host, port=default_port, unix_socket=None, workers=None,
+        max_queue=default_max_queue, batch_size=default_batch_size, batch_wait=default_batch_wait,
+        preload=(dither.default_palette,), method=dither.default_method, max_body=default_max_body):
+    service = DitherService(workers, max_queue, batch_size, batch_wait, preload, method)
+    server = make_server(service, host, port, unix_socket, max_body)
+    print('serving on {}'.format(unix_socket or 'http://{}:{}'.format(host, server.server_port)), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if unix_socket is not None and os.path.exists(unix_socket):
+            os.unlink(unix_socket)
+
+
+class _UnixConnection(http.client.HTTPConnection):
+    def __init__(self, unix_socket, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.unix_socket = unix_socket
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_socket)
+
+
+def _connection(host, port, unix_socket, timeout):
+    if unix_socket is not None:
+        return _UnixConnection(unix_socket, timeout)
+    return http.client.HTTPConnection(host, port, timeout=timeout)
+
+
+def request_dither(data, host=default_host, port=default_port, unix_socket=None, timeout=60, **params):
+    # send encoded image bytes to a running service and return the encoded
+    # result; params are the query parameters (method, palette, format, ...)
+    connection = _connection(host, port, unix_socket, timeout)
+    try:
+        connection.request('POST', '/dither?' + urllib.parse.urlencode(params), body=data,
+                headers={'Content-Type': 'application/octet-stream'})
+        response = connection.getresponse()
+        body = response.read()
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise RuntimeError('{} {}: {}'.format(response.status, response.reason, body.decode('utf-8', 'replace')))
+    return body
+
+
+def request_stats(host=default_host, port=default_port, unix_socket=None, timeout=10):
+    connection = _connection(host, port, unix_socket, timeout)
+    try:
+        connection.request('GET', '/stats')
+        return json.loads(connection.getresponse().read())
+    finally:
+        connection.close()
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='dither serve')
+    parser.add_argument('--host', type=str, default=default_host, help='Address to listen on')
+    parser.add_argument('--port', type=int, default=default_port, help='TCP port to listen on')
+    parser.add_argument('--unix-socket', type=str, default=None, help='Listen on this unix socket path instead of TCP')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Worker processes (default: all cores)')
+    parser.add_argument('--max-queue', type=int, default=default_max_queue, help='Requests queued before new ones get 503')
+    parser.add_argument('--batch-size', type=int, default=default_batch_size, help='Requests handed to a worker at once')
+    parser.add_argument('--batch-wait', type=float, default=default_batch_wait * 1000, help='Milliseconds to wait for a batch to fill')
+    preload_help_str = 'Comma separated palettes to load in every worker before serving'
+    parser.add_argument('--preload', type=str, default=dither.default_palette, help=preload_help_str)
+    parser.add_argument('-m', '--method', type=str, default=dither.default_method, help='Method whose kernels are compiled before serving')
+    parser.add_argument('--max-mb', type=float, default=default_max_body / 2**20, help='Largest image upload in MB')
+    args = parser.parse_args(argv)
+
+    serve(args.host, args.port, args.unix_socket, args.jobs, args.max_queue, args.batch_size,
+            args.batch_wait / 1000, [p for p in args.preload.split(',') if p], args.method,
+            int(args.max_mb * 2**20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,344 @@
+from PIL import Image
+from collections import OrderedDict
+import numpy
+import os
+import struct
+import zlib
+
+import color_metrics
+import error_diffusion
+import instrument
+import ordered_dithering
+import palette
+import randomized
+import threshold
+import utils
+
+DEBUGMODE = False
+
+# size, in bytes, of the float64 copy of one strip when no strip height is
+# given; peak memory stays a small multiple of this whatever the image size,
+# plus the decoded uint8 image for inputs read through PILReader
+STRIP_MEMORY = 32 * 1024 * 1024
+
+# files holding plain arrays rather than encoded images; they are memory
+# mapped, so only the strip being dithered is ever paged in
+array_extensions = ('.npy', '.raw')
+
+# methods that can dither an image strip by strip; each entry builds, for an
+# image width and a palette, a function taking the next (h, width, 3) block of
+# rows and returning its (h, width) palette indices
+strip_methods = OrderedDict()
+
+strip_methods.update(threshold._strip_methods)
+strip_methods.update(randomized._strip_methods)
+strip_methods.update(ordered_dithering._strip_methods)
+strip_methods.update(error_diffusion._strip_methods)
+
+
+def _palette_bytes(colors):
+    # same rounding as utils.numpy2pil
+    return numpy.uint8(colors * 255)
+
+
+class PPMReader(object):
+    # binary netpbm (P6 color, P5 gray) files, read one strip at a time
+
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        magic = self._token()
+        if magic not in (b'P5', b'P6'):
+            raise ValueError('{} is not a binary PPM/PGM file'.format(filename))
+        self.channels = 3 if magic == b'P6' else 1
+        self.width = int(self._token())
+        self.height = int(self._token())
+        if int(self._token()) != 255:
+            raise ValueError('only 8 bit PPM/PGM files can be streamed')
+
+    def _token(self):
+        token = b''
+        while True:
+            c = self.file.read(1)
+            if c == b'#':
+                self.file.readline()
+            elif c.isspace() or c == b'':
+                if token:
+                    return token
+            else:
+                token += c
+
+    def strips(self, strip_height):
+        row_bytes = self.width * self.channels
+        for y0 in range(0, self.height, strip_height):
+            h = min(strip_height, self.height - y0)
+            data = self.file.read(h * row_bytes)
+            strip = numpy.frombuffer(data, dtype=numpy.uint8).reshape(h, self.width, self.channels)
+            if self.channels == 1:
+                strip = numpy.repeat(strip, 3, axis=2)
+            yield strip
+
+    def close(self):
+        self.file.close()
+
+
+class PILReader(object):
+    # any other format PIL can open, PNG and JPEG included; PIL decodes these
+    # in one go, so the whole uint8 image is held in memory and only the
+    # float conversion and dithering go one strip at a time
+
+    def __init__(self, filename):
+        self.image = utils.open_image(filename)
+        self.width, self.height = self.image.size
+
+    def strips(self, strip_height):
+        for y0 in range(0, self.height, strip_height):
+            h = min(strip_height, self.height - y0)
+            yield numpy.asarray(self.image.crop((0, y0, self.width, y0 + h)))
+
+    def close(self):
+        self.image.close()
+
+
+class ArrayReader(object):
+    # .npy files and raw dumps through numpy.memmap; a strip is a view of
+    # the mapped file, so the page cache does the reading
+    # arrays are (H, W) gray, (H, W, 3) or (H, W, 4) (alpha ignored) of
+    # uint8, uint16, or float32/float64 values in [0, 1]
+
+    def __init__(self, filename, shape=None, dtype=numpy.uint8):
+        if shape is None:
+            self.array = numpy.load(filename, mmap_mode='r')
+        else:
+            self.array = numpy.memmap(filename, dtype=dtype, mode='r', shape=tuple(shape))
+        if self.array.ndim not in (2, 3) or (self.array.ndim == 3 and self.array.shape[2] not in (1, 3, 4)):
+            raise ValueError('{} holds a {} array, not an image'.format(filename, self.array.shape))
+        if self.array.dtype not in (numpy.uint8, numpy.uint16, numpy.float32, numpy.float64):
+            raise ValueError('{} holds {} values, not uint8, uint16 or floats'.format(filename, self.array.dtype))
+        self.height, self.width = self.array.shape[:2]
+
+    def strips(self, strip_height):
+        for y0 in range(0, self.height, strip_height):
+            strip = self.array[y0:y0+strip_height]
+            if strip.ndim == 2:
+                strip = strip[:, :, numpy.newaxis]
+            if strip.shape[2] == 1:
+                strip = numpy.repeat(strip, 3, axis=2)
+            yield strip[:, :, :3]
+
+    def close(self):
+        # the mapping goes away with the last view of it
+        self.array = None
+
+
+def open_reader(filename, raw_shape=None, raw_dtype=numpy.uint8):
+    # raw files carry no header, so they need raw_shape, e.g. (H, W, 3)
+    extension = os.path.splitext(filename)[1].lower()
+    if raw_shape is not None:
+        return ArrayReader(filename, raw_shape, raw_dtype)
+    if extension == '.raw':
+        raise ValueError('{} is a raw file, its shape must be given'.format(filename))
+    if extension == '.npy':
+        return ArrayReader(filename)
+    if extension in ('.ppm', '.pgm', '.pnm'):
+        return PPMReader(filename)
+    return PILReader(filename)
+
+
+def _strip_rows(strip, dtype):
+    # the working rows of a strip: uint8 strips as utils.pil2numpy converts
+    # images, uint16 strips scaled from 0-65535, float strips taken to be in
+    # [0, 1] already
+    if strip.dtype == numpy.uint8:
+        return utils.pil2numpy(strip, dtype)
+    with instrument.stage('convert', strip.shape[0] * strip.shape[1]):
+        values = strip / 65535. if strip.dtype == numpy.uint16 else strip
+        if numpy.dtype(dtype) == numpy.uint8:
+            return numpy.uint8(numpy.clip(values, 0.0, 1.0) * 255 + 0.5)
+        return numpy.asarray(values, dtype=dtype)
+
+
+class PNGWriter(object):
+    # writes a png one strip at a time: an 8 bit palette image when the
+    # palette has at most 256 colors, rgb otherwise
+
+    def __init__(self, filename, width, height, colors):
+        self.file = open(filename, 'wb')
+        self.width = width
+        self.colors = _palette_bytes(colors)
+        self.indexed = colors.shape[0] <= 256
+        self.compressor = zlib.compressobj(6)
+        self.pending = b''
+
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        color_type = 3 if self.indexed else 2
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0))
+        if self.indexed:
+            self._chunk(b'PLTE', self.colors.tobytes())
+
+    def _chunk(self, kind, data):
+        self.file.write(struct.pack('>I', len(data)))
+        self.file.write(kind)
+        self.file.write(data)
+        self.file.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    def _flush(self, force=False):
+        if len(self.pending) >= 65536 or (force and self.pending):
+            self._chunk(b'IDAT', self.pending)
+            self.pending = b''
+
+    def write(self, indices):
+        if self.indexed:
+            rows = indices.astype(numpy.uint8)
+        else:
+            rows = self.colors[indices].reshape(indices.shape[0], -1)
+        # every scanline starts with filter type 0 (none)
+        filtered = numpy.zeros((rows.shape[0], rows.shape[1] + 1), dtype=numpy.uint8)
+        filtered[:, 1:] = rows
+        self.pending += self.compressor.compress(filtered.tobytes())
+        self._flush()
+
+    def close(self):
+        self.pending += self.compressor.flush()
+        self._flush(force=True)
+        self._chunk(b'IEND', b'')
+        self.file.close()
+
+
+class PPMWriter(object):
+
+    def __init__(self, filename, width, height, colors):
+        self.file = open(filename, 'wb')
+        self.colors = _palette_bytes(colors)
+        self.file.write('P6\n{} {}\n255\n'.format(width, height).encode('ascii'))
+
+    def write(self, indices):
+        self.file.write(self.colors[indices].tobytes())
+
+    def close(self):
+        self.file.close()
+
+
+class PILWriter(object):
+    # formats without a streaming writer: the palette indices are collected,
+    # at one or two bytes per pixel, and handed to PIL at the end
+
+    def __init__(self, filename, width, height, colors):
+        self.filename = filename
+        self.colors = colors
+        self.indices = numpy.empty((height, width), dtype=utils.index_dtype(colors.shape[0]))
+        self.y = 0
+
+    def write(self, indices):
+        self.indices[self.y:self.y+indices.shape[0]] = indices
+        self.y += indices.shape[0]
+
+    def close(self):
+        colors = _palette_bytes(self.colors)
+        if self.colors.shape[0] <= 256:
+            image = Image.fromarray(self.indices.astype(numpy.uint8), mode='P')
+            image.putpalette(colors.tobytes())
+        else:
+            image = Image.fromarray(colors[self.indices])
+        image.save(self.filename)
+
+
+class ArrayWriter(object):
+    # the palette index map itself, written into a memory mapped .npy file
+    # (or a headerless raw file) one strip at a time; the page cache writes
+    # the pages back
+
+    def __init__(self, filename, width, height, colors, raw=False):
+        dtype = utils.index_dtype(colors.shape[0])
+        if raw:
+            self.indices = numpy.memmap(filename, dtype=dtype, mode='w+', shape=(height, width))
+        else:
+            self.indices = numpy.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=(height, width))
+        self.y = 0
+
+    def write(self, indices):
+        self.indices[self.y:self.y+indices.shape[0]] = indices
+        self.y += indices.shape[0]
+
+    def close(self):
+        self.indices.flush()
+        self.indices = None
+
+
+def open_writer(filename, width, height, colors):
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in array_extensions:
+        return ArrayWriter(filename, width, height, colors, raw=extension == '.raw')
+    if extension == '.png':
+        return PNGWriter(filename, width, height, colors)
+    if extension in ('.ppm', '.pnm'):
+        return PPMWriter(filename, width, height, colors)
+    return PILWriter(filename, width, height, colors)
+
+
+def parse_shape(text):
+    # 'H,W' or 'H,W,C' from the command line
+    return tuple(int(n) for n in text.split(','))
+
+
+def dither_file(input_filename, output_filename, method, palette_name, strip_height=None,
+        dtype=numpy.float64, metric=color_metrics.default_metric, raw_shape=None, raw_dtype=numpy.uint8,
+        **method_args):
+    # dither input_filename strip by strip into output_filename; .npy and
+    # raw inputs are memory mapped, and .npy or .raw outputs receive the
+    # palette index map. method_args go to the strip function, e.g. seed,
+    # with which the output is the same as the whole image's
+    strip_method = strip_methods[method]
+    reader = open_reader(input_filename, raw_shape, raw_dtype)
+    writer = None
+    try:
+        colors = utils.palette_array(palette_name)
+        if strip_height is None:
+            strip_height = max(1, STRIP_MEMORY // (reader.width * 3 * 8))
+
+        if DEBUGMODE:
+            print(f'streaming {reader.width}x{reader.height} in strips of {strip_height} rows')
+
+        process = strip_method(reader.width, palette_name, metric=metric, **method_args)
+        writer = open_writer(output_filename, reader.width, reader.height, colors)
+        strips = reader.strips(strip_height)
+        while True:
+            with instrument.stage('decode') as s:
+                strip = next(strips, None)
+                if s is not None and strip is not None:
+                    s.pixels = strip.shape[0] * strip.shape[1]
+            if strip is None:
+                break
+            rows = _strip_rows(strip, dtype)
+            with instrument.stage('dither', rows.shape[0] * rows.shape[1]):
+                indices = process(rows)
+            with instrument.stage('encode', indices.shape[0] * indices.shape[1]):
+                writer.write(indices)
+    finally:
+        reader.close()
+        if writer is not None:
+            writer.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('image_filename', help='Path to an image file to dither')
+    parser.add_argument('output', help='Path to write the dithered image to')
+    palette_help_str = 'Name of palette to use. Can be one of: ' + ', '.join(palette.available_palettes)
+    method_help_str = 'Method to use. Can be one of: ' + ', '.join(strip_methods)
+    parser.add_argument('-p', '--palette', type=str, default='cga_mode4_2_high', help=palette_help_str)
+    parser.add_argument('-m', '--method', type=str, default='bayer4x4', help=method_help_str)
+    parser.add_argument('-s', '--strip-height', type=int, default=None, help='Rows per strip')
+    parser.add_argument('--dtype', type=str, default='float64', choices=['float64', 'float32', 'uint8'], help='Pixel type to dither in')
+    parser.add_argument('--metric', type=str, default=color_metrics.default_metric, choices=color_metrics.available_metrics, help='Color distance used to pick palette colors')
+    parser.add_argument('--raw-shape', type=parse_shape, default=None, help='Shape of a raw input file, as H,W or H,W,C')
+    parser.add_argument('--raw-dtype', type=str, default='uint8', choices=['uint8', 'uint16', 'float32', 'float64'], help='Value type of a raw input file')
+    parser.add_argument('--seed', type=int, default=None, help='Seed for the randomized methods')
+    args = parser.parse_args()
+
+    if args.method not in strip_methods:
+        parser.error('method {} cannot be streamed, use one of: {}'.format(args.method, ', '.join(strip_methods)))
+    method_args = {'seed': args.seed} if args.seed is not None and args.method in randomized._available_methods else {}
+    dither_file(args.image_filename, args.output, args.method, args.palette, args.strip_height, args.dtype,
+            args.metric, args.raw_shape, args.raw_dtype, **method_args)
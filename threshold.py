@@ -3,27 +3,43 @@ from collections import OrderedDict
 import numpy
 import sys
 
+import color_metrics
 import palette
 import utils
 
 DEBUGMODE = False
 default_palette = 'cga_mode_4_2_hi'
 
-def threshold(image_matrix, palette_name):
-    new_matrix = numpy.copy(image_matrix)
-    cols, rows, depth = image_matrix.shape
-    for y in range(rows):
-        for x in range(cols):
-            old_pixel = numpy.array(new_matrix[x][y], dtype=numpy.float)
-            new_pixel = numpy.array(utils.closest_palette_color(old_pixel,
-                palette_name), dtype=numpy.float)
-            new_matrix[x][y] = new_pixel
-    return new_matrix
+def threshold(image_matrix, palette_name, return_indices=False, metric=color_metrics.default_metric):
+    indices, new_matrix = utils.quantize(image_matrix, palette_name, metric=metric)
+    return indices if return_indices else new_matrix
+
+def _threshold_strips(width, palette_name, metric=color_metrics.default_metric):
+    # threshold keeps no state between strips
+    def process(rows):
+        indices, new_matrix = utils.quantize(rows, palette_name, metric=metric)
+        return indices
+    return process
+
+def _threshold_tile(image_matrix, palette_name, y_offset=0, metric=color_metrics.default_metric):
+    # threshold does not depend on where the rows are
+    indices, new_matrix = utils.quantize(image_matrix, palette_name, metric=metric)
+    return indices
 
 _available_methods = OrderedDict([
         ('threshold' , threshold),
 ])
 
+_strip_methods = OrderedDict([
+        ('threshold' , _threshold_strips),
+])
+
+# methods that can dither any block of rows on its own, given the scanline
+# y_offset the block starts at; they return the block's palette indices
+_tile_methods = OrderedDict([
+        ('threshold' , _threshold_tile),
+])
+
 if __name__ == '__main__':
     import argparse
 
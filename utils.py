@@ -1,51 +1,168 @@
 from PIL import Image
-import math, numpy, sys
+import numpy, sys
 
+import color_metrics
+import instrument
 import palette
+import palette_index
 
 DEBUGMODE = False
 
+# upper bound, in bytes, for the pixels x colors distance block that quantize
+# builds at once; larger images are processed in chunks of rows
+QUANTIZE_MEMORY_BUDGET = 64 * 1024 * 1024
+
 def open_image(image_filename):
-    return Image.open(image_filename).convert('RGB')
+    with instrument.stage('decode') as s:
+        image = Image.open(image_filename).convert('RGB')
+        if s is not None:
+            s.pixels = image.size[0] * image.size[1]
+    return image
 
 
-def pil2numpy(image):
-    matrix = numpy.asarray(image, dtype=numpy.float)
-    return matrix/255. 
+def pil2numpy(image, dtype=numpy.float64):
+    # uint8 matrices keep the 0-255 values, float matrices are scaled to [0, 1]
+    with instrument.stage('convert') as s:
+        if numpy.dtype(dtype) == numpy.uint8:
+            matrix = numpy.asarray(image, dtype=numpy.uint8)
+        else:
+            matrix = numpy.asarray(image, dtype=dtype)
+            matrix = matrix/matrix.dtype.type(255.)
+        if s is not None:
+            s.pixels = matrix.shape[0] * matrix.shape[1]
+    return matrix
 
 
 def numpy2pil(matrix):
-    image = Image.fromarray(numpy.uint8(matrix*255))
+    with instrument.stage('encode', matrix.shape[0] * matrix.shape[1]):
+        if matrix.dtype == numpy.uint8:
+            return Image.fromarray(matrix)
+        image = Image.fromarray(numpy.uint8(matrix*255))
     return image
 
 
+def indices2pil(indices, palette_name):
+    # palette index map to a "P" mode image with the palette attached, or to
+    # an rgb image when the palette has more than 256 colors
+    colors = palette_array(palette_name, numpy.uint8)
+    with instrument.stage('encode', indices.shape[0] * indices.shape[1]):
+        if colors.shape[0] > 256:
+            return Image.fromarray(colors[indices])
+        image = Image.fromarray(numpy.asarray(indices, dtype=numpy.uint8), mode='P')
+        image.putpalette(colors.tobytes())
+    return image
+
+
+def unit_float(matrix):
+    # working copy of an image matrix in [0, 1]: uint8 matrices become
+    # float32, float32 and float64 matrices are used as they are
+    matrix = numpy.asarray(matrix)
+    if matrix.dtype == numpy.uint8:
+        return matrix / numpy.float32(255.)
+    if matrix.dtype in (numpy.float32, numpy.float64):
+        return matrix
+    return matrix.astype(numpy.float64)
+
+
+def output_dtype(matrix):
+    # dithered matrices come back in the dtype of the input matrix
+    dtype = numpy.asarray(matrix).dtype
+    if dtype in (numpy.uint8, numpy.float32):
+        return dtype
+    return numpy.dtype(numpy.float64)
+
+
+def dither_result(indices, palette_name, image_matrix, return_indices=False):
+    # what a dithering method hands back: the palette index map itself, or
+    # the palette colors in the dtype of the matrix that was dithered
+    if return_indices:
+        return indices
+    return palette_array(palette_name, output_dtype(image_matrix))[indices]
+
+
+# write an .npy file without concurrent processes ever seeing half of it
+save_array = palette.save_array
+
+
 def clamp(val):
     return max(0.0, min(1.0, val))
 
 
-def closest_palette_color(value, palette_name, bit_depth=1):
+def palette_array(palette_name, dtype=numpy.float64):
+    colors = numpy.asarray(palette.palettes[palette_name], dtype=numpy.float64)
+    if numpy.dtype(dtype) == numpy.uint8:
+        # same rounding as numpy2pil
+        return numpy.uint8(colors*255)
+    return colors.astype(dtype, copy=False)
+
+
+def index_dtype(n_colors):
+    # smallest unsigned type that can hold an index into the palette
+    if n_colors <= 256:
+        return numpy.uint8
+    return numpy.uint16 if n_colors <= 65536 else numpy.uint32
+
+
+def _as_palette(palette_colors, dtype=numpy.float64):
+    if isinstance(palette_colors, str):
+        return palette_array(palette_colors, dtype)
+    colors = numpy.asarray(palette_colors, dtype=numpy.float64)
+    if numpy.dtype(dtype) == numpy.uint8:
+        return numpy.uint8(colors*255)
+    return colors.astype(dtype, copy=False)
+
+
+def nearest_indices(pixels, colors, memory_budget=None):
+    # brute force nearest palette index for an (N, 3) array of pixels
+    # ties go to the lowest palette index, like the old per-pixel scan
+    # distances are computed in the pixels' float type
+    if memory_budget is None:
+        memory_budget = QUANTIZE_MEMORY_BUDGET
+    n_pixels = pixels.shape[0]
+    n_colors = colors.shape[0]
+    colors = colors.astype(pixels.dtype, copy=False)
+    indices = numpy.empty(n_pixels, dtype=index_dtype(n_colors))
+
+    # two (chunk, n_colors) float64 temporaries live at the same time
+    chunk = max(1, memory_budget // (n_colors * 8 * 2))
+    for start in range(0, n_pixels, chunk):
+        block = pixels[start:start+chunk]
+        dist = numpy.subtract.outer(block[:, 0], colors[:, 0])
+        dist *= dist
+        for c in (1, 2):
+            diff = numpy.subtract.outer(block[:, c], colors[:, c])
+            diff *= diff
+            dist += diff
+        indices[start:start+chunk] = numpy.argmin(dist, axis=1)
+    return indices
+
+
+def quantize(image_matrix, palette_colors, memory_budget=None, metric=color_metrics.default_metric):
+    # map every pixel of an (H, W, 3) matrix to its closest palette color
+    # under the given color metric
+    # palette_colors is a palette name or a (K, 3) array of colors
+    # returns the (H, W) index map and the (H, W, 3) quantized matrix, in the
+    # dtype of image_matrix (uint8, float32 or float64)
+    pixels = unit_float(image_matrix)
+    colors = _as_palette(palette_colors, output_dtype(image_matrix))
+    shape = pixels.shape[:-1]
+    pixels = pixels.reshape(-1, 3)
+
     if DEBUGMODE:
-        print('\tvalue = {value}')
-
-    # compute distance to colors in palette
-    # TODO make this naive method more sophisticated
-    min_dist = 10000.
-    ci_use = -1
-    for ci, color in enumerate(palette.palettes[palette_name]):
-        pr, pg, pb = color
-        vr, vg, vb = value
-        dist = math.sqrt((vr-pr)*(vr-pr)+(vg-pg)*(vg-pg)+(vb-pb)*(vb-pb))
-
-        if DEBUGMODE:
-            print('\tcolor = {color}')
-            print('\tdist = {dist}, min_dist = {min_dist}')
-
-        if dist < min_dist:
-            ci_use = ci
-            min_dist = dist
-
-    if ci == -1:
-        return [0.0, 0.0, 0.0]
-    else:
-        return palette.palettes[palette_name][ci_use]
+        print(f'quantizing {pixels.shape[0]} pixels to {colors.shape[0]} colors')
+
+    with instrument.stage('quantize', pixels.shape[0]):
+        pixels = color_metrics.to_space(pixels, metric)
+        index = palette_index.get_index(palette_colors, metric)
+        indices = index.query(pixels, memory_budget).reshape(shape)
+        return indices, colors[indices]
+
+
+def closest_palette_color(value, palette_name, bit_depth=1, metric=color_metrics.default_metric):
+    # single pixel version of quantize, kept for existing callers
+    colors = _as_palette(palette_name)
+    value = numpy.asarray(value, dtype=numpy.float64).reshape(1, 3)
+    if metric != color_metrics.default_metric:
+        return colors[palette_index.get_index(palette_name, metric).query(color_metrics.to_space(value, metric))[0]].tolist()
+    return colors[nearest_indices(value, colors)[0]].tolist()
 